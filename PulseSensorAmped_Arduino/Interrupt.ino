@@ -27,6 +27,9 @@ void interruptSetup(){
 ISR(TIMER2_COMPA_vect){                         // triggered when Timer2 counts to 124
   cli();                                      // disable interrupts while we do this
   Signal = analogRead(pulsePin);              // read the Pulse Sensor 
+#if BINARY_PROTOCOL
+  storeSample(Signal);                        // every sample goes into the binary frame
+#endif
   sampleCounter += 2;                         // keep track of the time in mS with this variable
   int N = sampleCounter - lastBeatTime;       // monitor the time since the last beat to avoid noise
 
@@ -60,6 +63,9 @@ ISR(TIMER2_COMPA_vect){                         // triggered when Timer2 counts
       if(firstBeat){                         // if it's the first time we found a beat, if firstBeat == TRUE
         firstBeat = false;                   // clear firstBeat flag
         secondBeat = true;                   // set the second beat flag
+#if BINARY_PROTOCOL
+        finishSample();
+#endif
         sei();                               // enable interrupts again
         return;                              // IBI value is unreliable so discard it
       }   
@@ -79,6 +85,9 @@ ISR(TIMER2_COMPA_vect){                         // triggered when Timer2 counts
       BPM = 60000/runningTotal;               // how many beats can fit into a minute? that's BPM!
       QS = true;                              // set Quantified Self flag 
       // QS FLAG IS NOT CLEARED INSIDE THIS ISR
+#if BINARY_PROTOCOL
+      storeBeat(BPM, IBI);
+#endif
     }                       
   }
 
@@ -100,6 +109,9 @@ ISR(TIMER2_COMPA_vect){                         // triggered when Timer2 counts
     secondBeat = false;                    // when we get the heartbeat back
   }
 
+#if BINARY_PROTOCOL
+  finishSample();
+#endif
   sei();                                   // enable interrupts when youre done!
 }// end isr
 
@@ -28,8 +28,25 @@ This update fixes the firstBeat and secondBeat flag usage so that realistic BPM
 
 
 Adapted by A. Riss, 2015: handling of button (so that you need to press a button to turn on the LED)
+
+Optional binary protocol (set BINARY_PROTOCOL to 1, and CFG_binary_protocol = True in heartex.py):
+every sample taken in the interrupt (500Hz) is sent, in fixed-size frames of 32 bytes (little endian):
+  0-1    sync bytes 0xA5 0x5A
+  2      sequence number (counts up, wraps at 256)
+  3-6    timestamp of the first sample in microseconds (micros())
+  7-26   16 sensor samples (10 bit), packed in groups of 4 samples into 5 bytes:
+         4 bytes with the lower 8 bits, 1 byte with the upper 2 bits (first sample in the lowest bits)
+  27     index of the sample at which a beat was detected (0xFF: no beat in this frame)
+  28     BPM
+  29-30  IBI in ms
+  31     checksum: sum of bytes 2 to 30 (modulo 256)
 */
 
+#define BINARY_PROTOCOL 0             // 0: text lines ("S512"), 1: binary frames (see above)
+#define FRAME_SAMPLES 16              // sensor samples per binary frame
+#define FRAME_SIZE 32                 // bytes per binary frame
+#define FRAME_BUFFERS 4               // number of frames that can be queued between the interrupt and loop()
+
 
 //  VARIABLES
 int pulsePin = 0;                 // Pulse Sensor purple wire connected to analog pin 0
@@ -49,11 +66,20 @@ volatile int IBI = 600;             // holds the time between beats, must be see
 volatile boolean Pulse = false;     // true when pulse wave is high, false when it's low
 volatile boolean QS = false;        // becomes true when Arduoino finds a beat.
 
+#if BINARY_PROTOCOL
+// frames are filled in the interrupt and sent in loop()
+byte frames[FRAME_BUFFERS][FRAME_SIZE];
+volatile byte frame_write = 0;          // frame that is currently filled by the interrupt
+volatile byte frame_read = 0;           // next frame to send
+volatile byte frame_sample = 0;         // next sample index within the current frame
+byte frame_seq = 0;                     // sequence number of the next queued frame
+#endif
+
 // for switching on/off via button
 enum { EV_NONE=0, EV_SHORTPRESS, EV_LONGPRESS };
 boolean button_was_pressed; // previous state
 int button_pressed_counter; // press running duration
-boolean sensor_is_running;  // sensor on?
+volatile boolean sensor_is_running;  // sensor on? (also read in the interrupt)
 
 
 void setup(){
@@ -103,6 +129,19 @@ int handle_button()
 
 
 void loop(){
+#if BINARY_PROTOCOL
+  while (frame_read != frame_write) {      // send all completed frames (only frames of a running sensor are queued)
+    sendFrame(frames[frame_read]);
+    frame_read = (frame_read + 1) % FRAME_BUFFERS;
+  }
+  if (sensor_is_running) {
+    if (QS == true){
+      fadeRate = 255;
+      QS = false;
+    }
+    ledFadeToBeat();
+  }
+#else
   if (sensor_is_running) {
     sendDataToProcessing('S', Signal);     // send Processing the raw Pulse Sensor data
     if (QS == true){                       // Quantified Self flag is true when arduino finds a heartbeat
@@ -114,6 +153,7 @@ void loop(){
     
     ledFadeToBeat();
   }
+#endif
   
   boolean event = handle_button();
   if (event==EV_LONGPRESS) {  // toggle state of 
@@ -144,8 +184,53 @@ void sendDataToProcessing(char symbol, int data ){
   }
 
 
+#if BINARY_PROTOCOL
+// called from the interrupt for every sample
+void storeSample(int value){
+  byte *frame = frames[frame_write];
+  byte i = frame_sample;
+  if (i == 0) {
+    unsigned long t = micros();
+    frame[0] = 0xA5;
+    frame[1] = 0x5A;
+    frame[2] = frame_seq;                   // only used up when the frame is queued
+    for (byte j=0; j<4; j++) frame[3+j] = (t >> (8*j)) & 0xFF;
+    for (byte j=0; j<4; j++) frame[7+5*j+4] = 0;      // upper bits are or-ed in below
+    frame[27] = 0xFF;
+  }
+  byte *group = &frame[7 + 5*(i/4)];
+  group[i%4] = value & 0xFF;
+  group[4] |= ((value >> 8) & 0x03) << (2*(i%4));
+  frame_sample = i + 1;
+}
 
+// called from the interrupt when a beat was found (after the sample of the beat was stored)
+void storeBeat(int bpm, int ibi){
+  byte *frame = frames[frame_write];
+  frame[27] = frame_sample - 1;
+  frame[28] = constrain(bpm, 0, 255);
+  frame[29] = ibi & 0xFF;
+  frame[30] = (ibi >> 8) & 0xFF;
+}
 
+// called from the interrupt after each sample, closes the frame when it is full
+void finishSample(){
+  if (frame_sample < FRAME_SAMPLES) return;
+  frame_sample = 0;
+  if (!sensor_is_running) return;               // the frame is dropped without using up a sequence number, so the host sees no lost frames
+  byte *frame = frames[frame_write];
+  if (frame[27] == 0xFF) {
+    frame[28] = 0; frame[29] = 0; frame[30] = 0;
+  }
+  byte checksum = 0;
+  for (byte j=2; j<FRAME_SIZE-1; j++) checksum += frame[j];
+  frame[FRAME_SIZE-1] = checksum;
+  frame_seq++;
+  byte next = (frame_write + 1) % FRAME_BUFFERS;
+  if (next != frame_read) frame_write = next;   // otherwise loop() is too slow, the frame is overwritten (the host sees the gap in the sequence numbers)
+}
 
-
-
+void sendFrame(byte *frame){
+  Serial.write(frame, FRAME_SIZE);
+}
+#endif
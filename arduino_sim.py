@@ -0,0 +1,434 @@
+####
+#
+# arduino simulator: a pseudo-terminal that speaks the protocol of PulseSensorAmped_Arduino (for tests without hardware, linux and mac only)
+#
+# the pulse wave and the inter-beat-intervals are generated from simple models (PulseModel): the IBIs are modulated by breathing
+# (respiratory sinus arrhythmia) and slower waves (0.1 Hz) and have a correlated random part, the pulse wave is a systolic peak with
+# a dicrotic wave on a baseline that wanders with the breathing. every sample is sent (text: S lines, with B and Q after the sample
+# at which the beat is detected; binary: frames, see protocol.py), at any sample rate for the text protocol, at 500 Hz for the binary one.
+# faults can be injected:
+#   noise:    sensor noise (standard deviation)
+#   garbage:  corrupted bytes on the line (fraction of the bytes)
+#   dropouts: the sensor sends nothing for a while (per minute, CFG_dropout_length seconds each)
+#   bursts:   the data is held back and arrives at once (per minute, CFG_burst_length seconds each), like with a busy USB bus
+# the arduino cannot wait for the host, data that the host does not read in time is dropped (and counted as overflow).
+#
+# with --soak the simulator is connected to the serial ingestion of heartex.py (the real serial port, reader thread, ring buffer and
+# HRVplot frames) and the throughput, backlog and lost samples are reported every CFG_report_every seconds, e.g. over hours.
+#
+# examples:
+#   python arduino_sim.py                                                 # prints the name of the pty (e.g. /dev/pts/5), use it as CFG_comport
+#   python arduino_sim.py --rate 20000 --noise 20 --dropouts 0.5 --bursts 2
+#   python arduino_sim.py --soak 3600 --rate 10000 --log soak.tsv         # one hour against HRVplot (without window)
+#   python arduino_sim.py --soak 600 --binary --plot                      # with the live plot
+#
+####
+
+
+# config
+
+CFG_sample_rate = 500       # samples per second (the arduino sketch samples at 500 Hz)
+CFG_tick = 0.005            # seconds between two writes to the pty
+
+CFG_heart_rate = 70         # beats per minute (mean)
+CFG_rsa = 0.04              # relative amplitude of the IBI modulation at the breathing rate (respiratory sinus arrhythmia)
+CFG_breathing_rate = 0.25   # Hz
+CFG_mayer = 0.03            # relative amplitude of the IBI modulation by the slower (Mayer) waves
+CFG_mayer_rate = 0.1        # Hz
+CFG_ibi_noise = 0.02        # relative standard deviation of the random part of the IBIs
+CFG_ibi_correlation = 0.7   # correlation between the random parts of successive IBIs
+CFG_ectopic = 0.0           # probability of a premature beat (followed by a compensatory pause)
+
+CFG_baseline = 512          # sensor values (0..1023)
+CFG_amplitude = 250
+CFG_wander = 20             # amplitude of the baseline wander with the breathing
+CFG_noise = 3               # standard deviation of the sensor noise
+
+CFG_garbage = 0.0           # fraction of the sent bytes that are corrupted
+CFG_dropouts = 0.0          # dropouts per minute
+CFG_dropout_length = 2.0    # seconds
+CFG_bursts = 0.0            # bursts per minute
+CFG_burst_length = 1.0      # seconds
+CFG_device_buffer = 2**16   # bytes that wait for the host, newer data is dropped when they do not fit
+
+CFG_report_every = 10       # seconds between two reports of the soak test
+
+
+import numpy as np
+import argparse
+import os
+import pty
+import resource
+import threading
+import time
+import tty
+
+import protocol
+
+
+class PulseModel():
+    """generates the sensor samples and the beats, generate() continues where the last call stopped"""
+
+    def __init__(self, sample_rate=CFG_sample_rate, heart_rate=CFG_heart_rate, noise=CFG_noise, seed=None):
+        self.sample_rate = sample_rate
+        self.heart_rate = heart_rate
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.num = 0              # number of generated samples
+        self.beat_t = [0.0]       # times of the beats (seconds), the beats that are still needed
+        self.beat_IBI = [60000.0 / heart_rate]   # IBI that ends with the beat (ms)
+        self.beat_BPM = [heart_rate]
+        self.recent = [60000.0 / heart_rate] * 10   # last 10 IBIs (for the heart rate, like the arduino)
+        self.random = 0.0         # random part of the last IBI
+        self.premature = False    # the last beat was premature
+
+
+    def _next_beat(self):
+        t = self.beat_t[-1]
+        mean = 60000.0 / self.heart_rate
+        self.random = CFG_ibi_correlation * self.random + np.sqrt(1 - CFG_ibi_correlation**2) * self.rng.normal(0, CFG_ibi_noise)
+        IBI = mean * (1 + CFG_rsa * np.sin(2*np.pi*CFG_breathing_rate*t) + CFG_mayer * np.sin(2*np.pi*CFG_mayer_rate*t) + self.random)
+        if self.premature:
+            IBI *= 1.3   # compensatory pause
+            self.premature = False
+        elif self.rng.random() < CFG_ectopic:
+            IBI *= 0.7
+            self.premature = True
+        IBI = round(IBI)
+        self.recent = self.recent[1:] + [IBI]
+        self.beat_t.append(t + IBI / 1000.0)
+        self.beat_IBI.append(IBI)
+        self.beat_BPM.append(int(60000 / (sum(self.recent) // 10)))
+
+
+    @staticmethod
+    def shape(phase):
+        """pulse wave over the phase of a beat (0: detection of the beat on the upstroke, 1: next beat), about 0..1"""
+        return np.exp(-((phase - 0.04) / 0.04)**2) + 0.35*np.exp(-((phase - 0.3) / 0.07)**2)
+
+
+    def generate(self, num):
+        """returns the next num sensor values and the beats (index of the sample at which it is detected, heart rate, IBI in ms)"""
+        t = (self.num + np.arange(num)) / float(self.sample_rate)
+        self.num += num
+        while len(self.beat_t) < 3 or self.beat_t[-2] <= t[-1]: self._next_beat()   # the upstroke needs the beat after the next one
+
+        beat_t = np.array(self.beat_t)
+        i = np.searchsorted(beat_t, t, side='right') - 1
+        IBI = np.array(self.beat_IBI) / 1000.0
+        wave = self.shape((t - beat_t[i]) / IBI[i+1]) + self.shape((t - beat_t[i+1]) / IBI[i+2])
+        sensor = CFG_baseline + CFG_amplitude * (wave - 0.4) + CFG_wander * np.sin(2*np.pi*CFG_breathing_rate*t)
+        if self.noise: sensor += self.rng.normal(0, self.noise, num)
+        sensor = np.clip(np.round(sensor), 0, 1023).astype(np.int32)
+
+        # beats: at the first sample at (or after) the time of the beat
+        first = np.searchsorted(beat_t, t[0] - 1.0/self.sample_rate, side='right')
+        last = np.searchsorted(beat_t, t[-1], side='right')
+        pos = np.searchsorted(t, beat_t[first:last])
+        BPM = np.array(self.beat_BPM[first:last], dtype=np.int32)
+        IBI = np.array(self.beat_IBI[first:last], dtype=np.int32)
+
+        # forget the beats that are no longer needed
+        drop = max(last - 2, 0)
+        del self.beat_t[:drop], self.beat_IBI[:drop], self.beat_BPM[:drop]
+        return sensor, pos, BPM, IBI
+
+
+def encode_text(sensor, pos, BPM, IBI):
+    """the text protocol: an S line per sample, the B and Q lines after the sample of the beat"""
+    lines = ['S%d' % v for v in sensor.tolist()]
+    for p, b, q in zip(pos.tolist(), BPM.tolist(), IBI.tolist()):
+        lines[p] += '\r\nB%d\r\nQ%d' % (b, q)
+    return ('\r\n'.join(lines) + '\r\n').encode('ascii')
+
+
+class ArduinoSimulator():
+    """writes the simulated data to a pseudo-terminal in a background thread, the reading side is opened as a serial port (see port)"""
+
+    def __init__(self, sample_rate=CFG_sample_rate, binary=False, model=None, garbage=CFG_garbage, dropouts=CFG_dropouts, bursts=CFG_bursts, seed=None):
+        if binary and sample_rate * protocol.CFG_sample_us != 1000000:
+            raise ValueError('the binary protocol has a fixed sample rate of %g Hz' % (1e6 / protocol.CFG_sample_us))
+        self.sample_rate = sample_rate
+        self.binary = binary
+        self.model = model if model is not None else PulseModel(sample_rate, seed=seed)
+        self.garbage = garbage
+        self.dropouts = dropouts
+        self.bursts = bursts
+        self.rng = np.random.default_rng(None if seed is None else seed + 1)
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)   # no echo, no line editing, no conversion of \r and \n
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+
+        self.pending = bytearray()   # written, but not yet taken by the pty
+        self.held = []               # encoded chunks held back during a burst: (data, number of values)
+        self.frame_samples = np.zeros(0, dtype=np.int32)   # binary protocol: samples of the incomplete frame
+        self.frame_beat = (protocol.CFG_no_beat, 0, 0)     # and its beat
+        self.seq = 0
+        self.dropout_until = 0.0
+        self.burst_until = 0.0
+
+        self.samples = 0    # generated sensor samples
+        self.beats = 0      # generated beats
+        self.values = 0     # values (S, B, Q) sent
+        self.bytes = 0      # bytes taken by the pty
+        self.dropped = 0    # values not sent because of dropouts
+        self.overflow = 0   # values dropped because the host did not read them in time
+        self.corrupted = 0  # corrupted bytes
+        self.late = 0       # ticks that came too late (the simulation could not keep up)
+        self.running = False
+        self.thread = None
+
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None: self.thread.join()
+
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+    def _run(self):
+        start = time.monotonic()
+        tick = start
+        while self.running:
+            now = time.monotonic()
+            num = int((now - start) * self.sample_rate) - self.model.num
+            if num > 0: self._send(now, *self.model.generate(num))
+            self._write()
+            tick += CFG_tick
+            delay = tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.late += 1
+                tick = time.monotonic()
+
+
+    def _send(self, now, sensor, pos, BPM, IBI):
+        """encodes the new samples and queues them for writing (applies the faults)"""
+        self.samples += len(sensor)
+        self.beats += len(pos)
+
+        # dropouts: nothing is sent
+        if now >= self.dropout_until and self.rng.random() < self.dropouts / 60.0 * len(sensor) / self.sample_rate:
+            self.dropout_until = now + CFG_dropout_length
+        if now < self.dropout_until:
+            self.dropped += len(sensor) + 2*len(pos)
+            if self.binary:  # the incomplete frame is lost too
+                self.dropped += len(self.frame_samples) + 2*(self.frame_beat[0] != protocol.CFG_no_beat)
+                self.frame_samples = np.zeros(0, dtype=np.int32)
+                self.frame_beat = (protocol.CFG_no_beat, 0, 0)
+            return
+
+        if self.binary:
+            data, num = self._encode_binary(sensor, pos, BPM, IBI)
+        else:
+            data, num = encode_text(sensor, pos, BPM, IBI), len(sensor) + 2*len(pos)
+        if self.garbage and len(data):
+            arr = np.frombuffer(data, dtype=np.uint8).copy()
+            idx = np.flatnonzero(self.rng.random(len(arr)) < self.garbage)
+            arr[idx] = self.rng.integers(0, 256, len(idx))   # (the value can be the same by chance)
+            data = arr.tobytes()
+            self.corrupted += len(idx)
+
+        # bursts: held back and released at once
+        if now >= self.burst_until and self.rng.random() < self.bursts / 60.0 * len(sensor) / self.sample_rate:
+            self.burst_until = now + CFG_burst_length
+        self.held.append((data, num))
+        if now < self.burst_until: return
+        for data, num in self.held:
+            if len(self.pending) + len(data) > CFG_device_buffer:
+                self.overflow += num
+            else:
+                self.pending += data
+                self.values += num
+        self.held = []
+
+
+    def _encode_binary(self, sensor, pos, BPM, IBI):
+        """the binary protocol: whole frames, the rest of the samples waits for the next call, returns the frames and the number of values in them"""
+        first = len(self.frame_samples)
+        samples = np.concatenate([self.frame_samples, sensor])
+        num_frames = len(samples) // protocol.CFG_frame_samples
+        beat = np.full(num_frames + 1, protocol.CFG_no_beat)
+        bpm = np.zeros(num_frames + 1, dtype=np.int32)
+        ibi = np.zeros(num_frames + 1, dtype=np.int32)
+        beat[0], bpm[0], ibi[0] = self.frame_beat
+        frame, index = np.divmod(first + pos, protocol.CFG_frame_samples)
+        beat[frame], bpm[frame], ibi[frame] = index, BPM, IBI
+        self.frame_beat = (beat[-1], bpm[-1], ibi[-1])
+        self.frame_samples = samples[num_frames*protocol.CFG_frame_samples:]
+        if num_frames == 0: return b'', 0
+
+        seq = self.seq + np.arange(num_frames)
+        self.seq += num_frames
+        t_us = (self.model.num - len(sensor) - first + protocol.CFG_frame_samples*np.arange(num_frames)) * protocol.CFG_sample_us
+        data = protocol.encode_frames(seq, t_us, samples[:num_frames*protocol.CFG_frame_samples], beat[:-1], bpm[:-1], ibi[:-1])
+        return data, num_frames*protocol.CFG_frame_samples + 2*int(np.count_nonzero(beat[:-1] != protocol.CFG_no_beat))
+
+
+    def _write(self):
+        """writes as much as the pty takes without blocking"""
+        while self.pending:
+            try:
+                n = os.write(self.master, self.pending)
+            except BlockingIOError:
+                break
+            except OSError:   # the reading side was closed (and opened again)
+                break
+            self.bytes += n
+            del self.pending[:n]
+
+
+    def counters(self):
+        """returns a dictionary with statistics about the sent data"""
+        return {'samples': self.samples, 'beats': self.beats, 'values': self.values, 'bytes': self.bytes, 'dropped': self.dropped,
+                'overflow': self.overflow, 'corrupted': self.corrupted, 'pending': len(self.pending), 'late': self.late}
+
+
+# soak test
+
+def soak(sim, duration, plot=False, log=None, report_every=CFG_report_every):
+    """runs the serial ingestion of heartex.py (HRVplot) against the simulator, reports throughput, backlog and lost samples
+    returns the final counters of the simulator and of the serial reader"""
+    import heartex  # only needed for the soak test
+    import tempfile
+    store_directory = tempfile.TemporaryDirectory()
+    settings = {'CFG_comport': sim.port, 'CFG_binary_protocol': sim.binary, 'CFG_no_arduino': False, 'CFG_save_history': False, 'CFG_save_dump': False,
+                'CFG_instrument': True, 'CFG_instrument_file': None, 'CFG_max_runtime': duration + 60, 'CFG_max_measurement_runtime': duration + 60,
+                'CFG_maxpoints': {k: None for k in heartex.CFG_maxpoints},
+                'CFG_store_directory': store_directory.name}   # keeps the memory bounded
+    saved = {k: getattr(heartex, k) for k in settings}   # restored afterwards, heartex may be used again in the same process
+    saved_timings = heartex.instrument.timings.enabled
+    for k, v in settings.items(): setattr(heartex, k, v)
+    heartex.instrument.timings.enabled = True
+    try:
+        return _soak(heartex, sim, duration, plot, log, report_every)
+    finally:
+        for k, v in saved.items(): setattr(heartex, k, v)
+        heartex.instrument.timings.enabled = saved_timings
+        store_directory.cleanup()
+
+
+def _soak(heartex, sim, duration, plot, log, report_every):
+    if not plot:
+        import matplotlib
+        matplotlib.use('Agg')
+
+    hrvplot = heartex.HRVplot(heartex.CFG_comport, heartex.CFG_baudrate, heartex.CFG_serial_timeout)
+    sim.start()   # after the port is opened (opening it clears the input)
+    start = time.monotonic()
+    fields = ['time', 'sent', 'received', 'rate', 'port_backlog', 'buffer_backlog', 'high_water', 'overruns', 'decode_errors', 'overflow', 'dropped', 'late', 'frames', 'frame_p99', 'maxrss_mb']
+    f_log = open(log, 'w') if log is not None else None
+    if f_log is not None: f_log.write('\t'.join(fields) + '\n')
+    last = [start, 0]
+
+    def report():
+        s, r = sim.counters(), hrvplot.reader.counters()
+        now = time.monotonic()
+        try:
+            port_backlog = hrvplot.ser.in_waiting
+        except (OSError, ValueError):
+            port_backlog = -1
+        frame = heartex.instrument.timings.histograms.get('frame')
+        row = {'time': now - start, 'sent': s['values'], 'received': r['samples'], 'rate': (r['samples'] - last[1]) / max(now - last[0], 1e-9),
+               'port_backlog': port_backlog, 'buffer_backlog': hrvplot.buffer.written - hrvplot.buffer.read, 'high_water': r['high_water'], 'overruns': r['overruns'],
+               'decode_errors': r['decode_errors'], 'overflow': s['overflow'], 'dropped': s['dropped'], 'late': s['late'],
+               'frames': frame.count if frame is not None else 0, 'frame_p99': frame.percentile(99) if frame is not None else np.nan,
+               'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+        last[:] = [now, r['samples']]
+        print('%6.0f s  sent %d  received %d (%.0f/s)  backlog port %d bytes, buffer %d (max %d)  overruns %d  decode errors %d  overflow %d  frame p99 %.1f ms  rss %.0f MB' % (
+            row['time'], row['sent'], row['received'], row['rate'], row['port_backlog'], row['buffer_backlog'], row['high_water'], row['overruns'],
+            row['decode_errors'], row['overflow'], row['frame_p99'] * 1000, row['maxrss_mb']))
+        if f_log is not None:
+            f_log.write('\t'.join('%g' % row[k] for k in fields) + '\n')
+            f_log.flush()
+
+    if plot:
+        def monitor():  # in the GUI thread
+            report()
+            if time.monotonic() - start >= duration or hrvplot.run_ended: heartex.plt.close(hrvplot.fig)   # ends show()
+        timer = hrvplot.fig.canvas.new_timer(interval=report_every * 1000)
+        timer.add_callback(monitor)
+        timer.start()
+        heartex.show(hrvplot)
+    else:
+        next_report = start + report_every
+        while time.monotonic() - start < duration and not hrvplot.run_ended:
+            hrvplot.frame()
+            if time.monotonic() >= next_report:
+                report()
+                next_report += report_every
+            time.sleep(max(0.0, heartex.CFG_update_intervall / 1000.0 - (time.monotonic() - hrvplot.frame_last)))
+
+    # let the reader take the rest, then the sent and received values must match
+    sim.stop()
+    deadline = time.monotonic() + 5
+    while (sim.pending or hrvplot.ser.in_waiting) and time.monotonic() < deadline:
+        sim._write()
+        time.sleep(0.05)
+    time.sleep(0.2)
+    if not plot: hrvplot.frame()
+    report()
+    s, r = sim.counters(), hrvplot.reader.counters()
+    print('sent %d values (%d samples, %d beats), received %d, decode errors %d, ring buffer overruns %d, device overflow %d, not sent (dropouts) %d, corrupted bytes %d' % (
+        s['values'], s['samples'], s['beats'], r['samples'], r['decode_errors'], r['overruns'], s['overflow'], s['dropped'], s['corrupted']))
+    if f_log is not None: f_log.close()
+    hrvplot.close()
+    return s, r
+
+
+# main() function
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='simulates the arduino with the pulse sensor on a pseudo-terminal')
+    parser.add_argument('--rate', type=int, default=CFG_sample_rate, help='samples per second (default: %(default)s)')
+    parser.add_argument('--binary', action='store_true', help='send the binary protocol (500 Hz only)')
+    parser.add_argument('--heart-rate', type=float, default=CFG_heart_rate, help='mean heart rate in beats per minute (default: %(default)s)')
+    parser.add_argument('--noise', type=float, default=CFG_noise, help='standard deviation of the sensor noise (default: %(default)s)')
+    parser.add_argument('--garbage', type=float, default=CFG_garbage, help='fraction of corrupted bytes')
+    parser.add_argument('--dropouts', type=float, default=CFG_dropouts, help='dropouts per minute (%g s each)' % CFG_dropout_length)
+    parser.add_argument('--bursts', type=float, default=CFG_bursts, help='bursts per minute (%g s of data at once)' % CFG_burst_length)
+    parser.add_argument('--seed', type=int, help='seed of the random numbers (for reproducible runs)')
+    parser.add_argument('--duration', type=float, help='stop after so many seconds')
+    parser.add_argument('--soak', type=float, metavar='SECONDS', help='run the serial ingestion of heartex.py against the simulator for so many seconds')
+    parser.add_argument('--plot', action='store_true', help='show the live plot during the soak test')
+    parser.add_argument('--log', help='write the reports of the soak test to this file (tab-separated)')
+    args = parser.parse_args(argv)
+
+    model = PulseModel(args.rate, args.heart_rate, args.noise, seed=args.seed)
+    try:
+        sim = ArduinoSimulator(args.rate, args.binary, model, args.garbage, args.dropouts, args.bursts, seed=args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.soak is not None:
+        soak(sim, args.soak, args.plot, args.log)
+        sim.close()
+        return
+
+    print('simulating the arduino on %s (%d Hz, %s protocol)' % (sim.port, args.rate, 'binary' if args.binary else 'text'))
+    sim.start()
+    start = time.monotonic()
+    try:
+        while args.duration is None or time.monotonic() - start < args.duration:
+            time.sleep(min(CFG_report_every, args.duration or CFG_report_every))
+            print('  '.join('%s %d' % item for item in sim.counters().items()))
+    except KeyboardInterrupt:
+        pass
+    sim.close()
+
+
+# call main
+if __name__ == '__main__':
+    main()
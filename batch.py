@@ -0,0 +1,253 @@
+####
+#
+# batch reprocessing of recorded sessions: raw recordings (see recorder.py, also older dumps) and the sessions of a session store
+#
+# the HRV descriptors of all sessions are calculated in a pool of processes. the sessions are handed out in chunks (less
+# overhead per session, and the spectra of a chunk are calculated together, see HRVdescriptors.calculate_batch), the largest
+# first, and the progress is printed as the chunks finish. the results of every chunk are written to the output as soon as it
+# is finished. sessions that are already in the output are skipped, so an interrupted run can be continued (sessions that
+# failed, e.g. broken files or a worker process that died, are tried again).
+#
+# examples:
+#   python batch.py recordings/*.hrx --output results.db                  # SQLite (table results)
+#   python batch.py --history hrv_sessions.db --output results.tsv         # tab-separated
+#   python batch.py recordings --beats host --workers 4 --output results.db  # all files in the directory, beats detected on the host
+#   python batch.py recordings/*.hrx --nonlinear --output results.db      # also ApEn and FracDim (slow for long sessions)
+#
+####
+
+
+# config
+
+CFG_workers = None       # processes (None: number of cores)
+CFG_chunk_size = None    # sessions per chunk (None: about CFG_chunks_per_worker chunks per process, at most CFG_max_chunk_size sessions)
+CFG_chunks_per_worker = 4
+CFG_max_chunk_size = 64
+CFG_initial_wait = 5     # ignore the first seconds of a recording (like heartex.py)
+CFG_table = 'results'
+
+
+import numpy as np
+import argparse
+import concurrent.futures
+import datetime
+import os
+import sqlite3
+import sys
+import time
+
+import beat_detector
+import hrv_analysis
+import pipeline
+import protocol
+import recorder
+import session_store
+
+
+# jobs: (key, kind, filename, session id, start, size), kind is 'dump' or 'session'
+
+def find_jobs(paths, history=None, start=None, end=None):
+    """returns the jobs for the recordings (files, or all files in directories) and the sessions of the session store"""
+    jobs = []
+    for path in paths:
+        files = [os.path.join(path, f) for f in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+        for f in files:
+            if os.path.isfile(f):
+                f = os.path.abspath(f)
+                jobs.append(('dump:%s' % f, 'dump', f, None, None, os.path.getsize(f)))
+    if history is not None:
+        history = os.path.abspath(history)
+        for i, t, beats in session_store.list_sessions(history, start, end):
+            jobs.append(('session:%s:%d' % (history, i), 'session', history, i, t, beats * 4))
+    return jobs
+
+
+def read_dump_IBI(filename, binary=False, beats='device', initial_wait=CFG_initial_wait):
+    """returns the start time (datetime) and the IBIs of a recording (the same beats as in the live analysis)"""
+    parser = protocol.Parser(binary)
+    host = beat_detector.HostBeats(beats, binary) if beats != 'device' else None
+    analysis = pipeline.Analysis(update_every=sys.maxsize, initial_wait=initial_wait)  # only collects the IBIs
+    with open(filename, 'rb') as f:
+        is_recording = f.read(len(recorder.file_magic)) == recorder.file_magic
+    t_first = None
+    for data, t in recorder.read_dump(filename):
+        if t_first is None: t_first = t
+        syms, vals, times = parser.decode(data, t)
+        if host is not None: syms, vals, times = host.filter(syms, vals, times)
+        analysis.process(syms, vals, times)
+    start = datetime.datetime.fromtimestamp(t_first if is_recording and t_first is not None else os.path.getmtime(filename))  # older dumps have no times
+    return start, analysis.IBI.values().astype(float)
+
+
+def process_chunk(jobs, binary=False, beats='device', nonlinear=False):
+    """calculates the descriptors of a chunk of jobs (runs in a worker process), returns a list of result rows (dicts)"""
+    rows = []
+    IBIs = []
+    sessions = {}
+    for key, kind, filename, i, start, size in jobs:
+        if kind == 'session': sessions.setdefault(filename, []).append(i)
+    session_IBI = {}
+    for filename, ids in sessions.items():
+        try:
+            session_IBI.update({(filename, i): IBI for i, IBI in session_store.read_IBI(filename, ids).items()})
+        except Exception:  # read them one by one below, so only the broken sessions get an error
+            pass
+
+    for key, kind, filename, i, start, size in jobs:
+        row = {'key': key, 'source': filename, 'session': i, 'start': None, 'beats': 0, 'duration': None, 'error': None}
+        IBI = np.zeros(0)
+        try:
+            if kind == 'dump':
+                start, IBI = read_dump_IBI(filename, binary, beats)
+            else:
+                IBI = session_IBI[(filename, i)] if (filename, i) in session_IBI else session_store.read_IBI(filename, [i])[i]
+                IBI = IBI.astype(float)
+            row.update({'start': start.isoformat(' '), 'beats': len(IBI), 'duration': float(IBI.sum()) / 1000})
+        except Exception as e:  # a broken file must not stop the whole batch
+            row['error'] = '%s: %s' % (type(e).__name__, e)
+            IBI = np.zeros(0)
+        rows.append(row)
+        IBIs.append(IBI)
+
+    descriptors = hrv_analysis.HRVdescriptors().calculate_batch(IBIs, nonlinear=nonlinear)
+    for j, row in enumerate(rows):
+        row['descriptors'] = {k: float(v[j]) for k, v in descriptors.items()}
+    return rows
+
+
+def error_rows(jobs, error, nonlinear=False):
+    """result rows for jobs that could not be processed at all (e.g. the worker process died), the descriptors are NaN"""
+    keys = hrv_analysis.HRVdescriptors().calculate_batch([], nonlinear=nonlinear)
+    return [{'key': key, 'source': filename, 'session': i, 'start': None, 'beats': 0, 'duration': None, 'error': error, 'descriptors': {k: np.nan for k in keys}}
+            for key, kind, filename, i, start, size in jobs]
+
+
+def make_chunks(jobs, workers, chunk_size=CFG_chunk_size):
+    """splits the jobs into chunks, the largest jobs first (so the pool is not kept waiting by a large job at the end)"""
+    jobs = sorted(jobs, key=lambda job: -job[5])
+    if chunk_size is None:
+        chunk_size = min(max(len(jobs) // (workers * CFG_chunks_per_worker), 1), CFG_max_chunk_size)
+    return [jobs[i:i+chunk_size] for i in range(0, len(jobs), chunk_size)]
+
+
+# output: SQLite (one row per session, one column per descriptor) or tab-separated text (.tsv, .txt)
+
+class ResultFile():
+    """the results of the batch, done() returns the keys that are already in the file (without an error), write() adds rows"""
+
+    fields = ['key', 'source', 'session', 'start', 'beats', 'duration', 'error']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.is_text = os.path.splitext(filename)[1].lower() in ('.tsv', '.txt')
+
+
+    def done(self):
+        if not os.path.exists(self.filename): return set()
+        if self.is_text:
+            error = self.fields.index('error')
+            with open(self.filename) as f:
+                rows = [line.rstrip('\n').split('\t') for line in list(f)[1:]]
+            done = set()
+            for row in rows:  # a session that was tried again has several lines, the last one counts
+                if row[error]: done.discard(row[0])
+                else: done.add(row[0])
+            return done
+        db = sqlite3.connect(self.filename)
+        try:
+            return {row[0] for row in db.execute('SELECT key FROM %s WHERE error IS NULL' % CFG_table)}
+        except sqlite3.OperationalError:  # no table yet
+            return set()
+        finally:
+            db.close()
+
+
+    def write(self, rows):
+        if not rows: return
+        keys = list(rows[0]['descriptors'])
+        if self.is_text:
+            if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+                with open(self.filename) as f:
+                    keys = f.readline().rstrip('\n').split('\t')[len(self.fields):]   # the columns of the existing file
+                header = ''
+            else:
+                header = '\t'.join(self.fields + keys) + '\n'
+            lines = ['\t'.join(['' if row[k] is None else str(row[k]) for k in self.fields] + ['%g' % row['descriptors'].get(k, np.nan) for k in keys]) + '\n' for row in rows]
+            with open(self.filename, 'a') as f:
+                f.write(header + ''.join(lines))
+        else:
+            db = sqlite3.connect(self.filename)
+            db.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, source TEXT, session INTEGER, start TEXT, beats INTEGER, duration REAL, error TEXT)' % CFG_table)
+            columns = {row[1] for row in db.execute('PRAGMA table_info(%s)' % CFG_table)}
+            for k in keys:
+                if k not in columns: db.execute('ALTER TABLE %s ADD COLUMN "%s" REAL' % (CFG_table, k))
+            db.executemany('INSERT OR REPLACE INTO %s (%s%s) VALUES (%s)' % (CFG_table, ', '.join(self.fields), ''.join(', "%s"' % k for k in keys), ', '.join('?' * (len(self.fields) + len(keys)))),
+                           [[row[k] for k in self.fields] + [None if np.isnan(row['descriptors'].get(k, np.nan)) else row['descriptors'][k] for k in keys] for row in rows])
+            db.commit()
+            db.close()
+
+
+def run(chunks, workers=CFG_workers, progress=True, output=None, **kwargs):
+    """processes the chunks in a pool of processes, returns the result rows (also the finished ones if interrupted)
+    the sessions of a chunk that failed as a whole (e.g. its worker process died) get error rows,
+    with output (ResultFile) the rows of every chunk are written as soon as it is finished"""
+    rows = []
+    total = sum(len(c) for c in chunks)
+    start = time.time()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(process_chunk, chunk, **kwargs): chunk for chunk in chunks}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                chunk_rows = future.result()
+            except Exception as e:  # e.g. BrokenProcessPool
+                chunk_rows = error_rows(futures[future], '%s: %s' % (type(e).__name__, e), kwargs.get('nonlinear', False))
+            if output is not None: output.write(chunk_rows)
+            rows.extend(chunk_rows)
+            if progress:
+                elapsed = time.time() - start
+                rate = len(rows) / elapsed if elapsed > 0 else 0
+                print('\r%d/%d sessions, %.1f sessions/s, %.0f s left  ' % (len(rows), total, rate, (total - len(rows)) / rate if rate > 0 else 0), end='', file=sys.stderr)
+    except KeyboardInterrupt:
+        print('\ninterrupted, keeping the %d finished sessions' % len(rows), file=sys.stderr)
+        executor.shutdown(wait=False, cancel_futures=True)
+        return rows
+    executor.shutdown()
+    if progress: print(file=sys.stderr)
+    return rows
+
+
+# main() function
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='calculates the HRV descriptors of many recorded sessions in parallel')
+    parser.add_argument('paths', nargs='*', help='recordings (see recorder.py) or directories with recordings')
+    parser.add_argument('--history', help='also the sessions of this session store (SQLite)')
+    parser.add_argument('--start', type=datetime.datetime.fromisoformat, help='only sessions of the session store from this date on')
+    parser.add_argument('--end', type=datetime.datetime.fromisoformat, help='only sessions of the session store before this date')
+    parser.add_argument('--output', required=True, help='results (SQLite, or tab-separated for .tsv/.txt), sessions that are already in it are skipped')
+    parser.add_argument('--binary', action='store_true', help='the recordings contain the binary protocol')
+    parser.add_argument('--beats', choices=['device', 'host'], default='device', help='beats from the arduino or detected on the host (recordings only)')
+    parser.add_argument('--nonlinear', action='store_true', help='also calculate the non-linear descriptors (ApEn, FracDim), O(N^2) in the beats of a session')
+    parser.add_argument('--workers', type=int, default=CFG_workers, help='processes (default: number of cores)')
+    parser.add_argument('--chunk-size', type=int, default=CFG_chunk_size, help='sessions per chunk')
+    args = parser.parse_args(argv)
+    if not args.paths and args.history is None: parser.error('no recordings and no session store given')
+
+    output = ResultFile(args.output)
+    jobs = find_jobs(args.paths, args.history, args.start, args.end)
+    done = output.done()
+    todo = [job for job in jobs if job[0] not in done]
+    print('%d sessions, %d already done' % (len(jobs), len(jobs) - len(todo)), file=sys.stderr)
+    if not todo: return
+
+    workers = args.workers or os.cpu_count() or 1
+    chunks = make_chunks(todo, workers, args.chunk_size)
+    rows = run(chunks, workers, output=output, binary=args.binary, beats=args.beats, nonlinear=args.nonlinear)
+    print("Written %d results to file: %s" % (len(rows), args.output))
+    errors = [row for row in rows if row['error']]
+    for row in errors: print('error in %s: %s' % (row['key'], row['error']), file=sys.stderr)
+
+
+# call main
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+####
+# detection of the heart beats on the host, from the raw sensor samples (S)
+#
+# the arduino detects the beats itself (Interrupt.ino) and only sends the results (B and Q), the host cannot check them.
+# BeatDetector works on the sensor samples chunk by chunk as they arrive, the state (last sample, recent minima and
+# maxima, last beat) is carried over to the next chunk:
+#   threshold: half way between the minimum and the maximum of the last CFG_threshold_window seconds, taken per block of
+#              CFG_block_time from the complete blocks before the sample (adaptive like the threshold of the arduino)
+#   beat:      the signal crosses the threshold upwards, the time of the beat is interpolated linearly between the two samples
+#              (sub-sample timing). crossings within 3/5 of the mean IBI (at least CFG_min_IBI) after a beat are ignored
+#              (dicrotic notch, noise), after more than CFG_max_IBI without a beat the next beat has no IBI
+# all the work per sample is vectorised, there is only a python loop over the crossings of the threshold.
+#
+# HostBeats puts the beats detected on the host (B and Q) into the decoded samples instead of the ones from the arduino,
+# or keeps the ones from the arduino and compares both. a recording can be reanalysed with:
+#   python beat_detector.py temp.txt                 # compares the beats of the arduino with the ones detected on the host
+#   python beat_detector.py session.hrx --binary --output beats.tsv
+#
+####
+
+
+# config
+
+CFG_block_time = 0.25        # seconds, the minimum and the maximum of the signal are taken per block
+CFG_threshold_window = 1.5   # seconds, the threshold is taken from the blocks of the last so many seconds
+CFG_threshold = 0.5          # position of the threshold between the minimum and the maximum
+CFG_min_amplitude = 20       # no beats are detected while the maximum minus the minimum is smaller (sensor units, 0..1023)
+CFG_min_IBI = 250            # ms, crossings closer to the last beat are ignored (like the arduino)
+CFG_refractory = 0.6         # crossings within this fraction of the mean IBI are ignored (like the arduino, 3/5)
+CFG_max_IBI = 2500           # ms, after a longer gap the next beat has no IBI (like the arduino)
+CFG_bpm_beats = 10           # the heart rate (B) is the mean of the last so many IBIs (like the arduino)
+CFG_sample_rate = 500        # Hz, sensor samples of the binary protocol (protocol.CFG_sample_us)
+CFG_sample_rate_text = 49.3  # Hz, sensor samples of the text protocol (one per loop of the sketch: delay(20) and the serial output, about 20.3 ms)
+CFG_match_tolerance = 0.1    # seconds, a beat from the arduino and one from the host are the same beat if they are this close
+
+
+import numpy as np
+import argparse
+import collections
+import sys
+import time
+
+import protocol
+
+
+def _concatenate(chunks):
+    """concatenates a list of (times, IBIs) into two arrays"""
+    if not chunks: return np.zeros(0), np.zeros(0)
+    return np.concatenate([c[0] for c in chunks]).astype(float), np.concatenate([c[1] for c in chunks]).astype(float)
+
+
+class BeatDetector():
+    """streaming beat detector for the raw sensor samples, process() the chunks in order"""
+
+    def __init__(self, sample_rate=CFG_sample_rate):
+        self.sample_rate = sample_rate
+        self.block = max(int(round(CFG_block_time * sample_rate)), 1)   # samples per block
+        self.num_blocks = max(int(round(CFG_threshold_window / CFG_block_time)), 1)
+        self.reset()
+
+
+    def reset(self):
+        self.partial = np.zeros(0)   # samples of the incomplete block
+        self.block_max = np.full(self.num_blocks, np.nan)   # maximum and minimum of the last complete blocks
+        self.block_min = np.full(self.num_blocks, np.nan)
+        self.value_last = np.nan     # last sample of the previous chunk
+        self.time_last = np.nan
+        self.beat_last = None        # time of the last beat (s)
+        self.IBIs = collections.deque(maxlen=CFG_bpm_beats)
+        self.count = 0               # number of processed samples
+        self.beats = 0               # number of detected beats
+
+
+    def thresholds(self, x):
+        """returns the threshold for each sample of x (NaN where the amplitude is too small), updates the blocks"""
+        data = np.concatenate([self.partial, x])
+        num = -(-len(data) // self.block)   # blocks touched by this chunk
+        full = len(data) // self.block      # of these the complete ones
+        padded = np.full(num * self.block, np.nan)
+        padded[:len(data)] = data
+        blocks = padded.reshape(num, self.block)
+        all_max = np.concatenate([self.block_max, np.fmax.reduce(blocks, axis=1)])
+        all_min = np.concatenate([self.block_min, np.fmin.reduce(blocks, axis=1)])
+
+        # block j of this chunk uses the num_blocks blocks before it
+        hi = np.fmax.reduce(np.lib.stride_tricks.sliding_window_view(all_max, self.num_blocks)[:num], axis=1)
+        lo = np.fmin.reduce(np.lib.stride_tricks.sliding_window_view(all_min, self.num_blocks)[:num], axis=1)
+        thresh = lo + CFG_threshold * (hi - lo)
+        thresh[~(hi - lo >= CFG_min_amplitude)] = np.nan
+
+        self.block_max = all_max[:self.num_blocks+full][-self.num_blocks:]
+        self.block_min = all_min[:self.num_blocks+full][-self.num_blocks:]
+        self.partial = data[full*self.block:]
+        return np.repeat(thresh, self.block)[len(data)-len(x):len(data)]
+
+
+    def process(self, values, times):
+        """processes a chunk of sensor samples with their times (s), returns the times of the detected beats (s), their IBIs (ms, NaN for
+        the first beat after a gap) and the heart rate (beats per minute, mean of the last CFG_bpm_beats IBIs)"""
+        x = np.asarray(values, dtype=float)
+        times = np.asarray(times, dtype=float)
+        if len(x) == 0: return np.zeros(0), np.zeros(0), np.zeros(0)
+        thresh = self.thresholds(x)
+
+        # upward crossings of the threshold, the time is interpolated between the two samples
+        prev = np.concatenate([[self.value_last], x[:-1]])
+        prev_t = np.concatenate([[self.time_last], times[:-1]])
+        with np.errstate(invalid='ignore'):
+            cand = np.flatnonzero((prev <= thresh) & (x > thresh))
+        frac = (thresh[cand] - prev[cand]) / (x[cand] - prev[cand])
+        t_cand = prev_t[cand] + frac * (times[cand] - prev_t[cand])
+        self.value_last = x[-1]
+        self.time_last = times[-1]
+        self.count += len(x)
+
+        beat_t, IBI, BPM = [], [], []
+        for t in t_cand.tolist():
+            ibi = np.nan
+            if self.beat_last is not None:
+                dt = (t - self.beat_last) * 1000
+                if dt < max(CFG_min_IBI, CFG_refractory * (np.mean(self.IBIs) if self.IBIs else 0)): continue
+                if dt <= CFG_max_IBI: ibi = dt
+            if np.isnan(ibi):
+                self.IBIs.clear()
+            else:
+                self.IBIs.append(ibi)
+            self.beat_last = t
+            beat_t.append(t)
+            IBI.append(ibi)
+            BPM.append(60000.0 / np.mean(self.IBIs) if self.IBIs else np.nan)
+        self.beats += len(beat_t)
+        return np.array(beat_t), np.array(IBI), np.array(BPM)
+
+
+class HostBeats():
+    """beats detected on the host in the decoded samples (symbols, values and times from protocol.Parser)
+    mode 'host': the beats from the arduino (B and Q) are replaced by the ones detected on the host
+    mode 'check': the beats from the arduino are kept, both are collected for compare()"""
+
+    def __init__(self, mode='host', binary=False):
+        if mode not in ('host', 'check'): raise ValueError("unknown mode: %s" % mode)
+        self.mode = mode
+        self.binary = binary
+        self.detector = BeatDetector(CFG_sample_rate if binary else CFG_sample_rate_text)
+        self.time_start = None   # receive time of the first chunk (text protocol)
+        self.device = []         # (times, IBIs) of the beats from the arduino (mode 'check')
+        self.host = []           # (times, IBIs) of the beats detected on the host (mode 'check')
+
+
+    def _sample_times(self, times):
+        """times of the sensor samples for the detector: the device times of the binary protocol. the text protocol gives all samples
+        of a chunk its receive time, so the samples are counted instead (CFG_sample_rate_text)"""
+        if self.binary or len(times) == 0: return times
+        if self.time_start is None: self.time_start = times[0]
+        return self.time_start + (self.detector.count + np.arange(len(times))) / self.detector.sample_rate
+
+
+    def filter(self, syms, vals, times):
+        """runs the detector on the sensor samples, returns the symbols, values and times with the beats of the selected mode"""
+        is_sensor = syms == ord('S')
+        sensor_idx = np.flatnonzero(is_sensor)
+        sensor_t = self._sample_times(times[is_sensor])
+        beat_t, IBI, BPM = self.detector.process(vals[is_sensor], sensor_t)
+        # the beats belong to the sensor sample at which they were detected and get its time (like the beats from the arduino)
+        pos = sensor_idx[np.minimum(np.searchsorted(sensor_t, beat_t), len(sensor_idx) - 1)]
+        if self.mode == 'check':   # only kept for compare(), so 'host' mode runs in constant memory
+            if len(IBI): self.host.append((times[pos], IBI))
+            is_IBI = syms == ord('Q')
+            if is_IBI.any(): self.device.append((times[is_IBI], vals[is_IBI]))
+            return syms, vals, times
+
+        # like the arduino, the first beat after a gap is not sent
+        valid = ~np.isnan(IBI)
+        pos, IBI, BPM = pos[valid], IBI[valid], BPM[valid]
+        keep = np.flatnonzero((syms != ord('B')) & (syms != ord('Q')))
+        num = len(pos)
+        syms = np.concatenate([syms[keep], np.full(num, ord('B'), dtype=np.uint8), np.full(num, ord('Q'), dtype=np.uint8)])
+        vals = np.concatenate([vals[keep], np.round(BPM).astype(vals.dtype), np.round(IBI).astype(vals.dtype)])
+        times = np.concatenate([times[keep], times[pos], times[pos]])
+        order = np.argsort(np.concatenate([2*keep, 2*pos+1, 2*pos+1]), kind='stable')
+        return syms[order], vals[order], times[order]
+
+
+    def compare(self):
+        """compares the beats from the arduino with the ones detected on the host (mode 'check'), returns a dictionary"""
+        dev_t, dev_IBI = _concatenate(self.device)
+        host_t, host_IBI = _concatenate(self.host)
+        result = {'device_beats': len(dev_t), 'host_beats': len(host_t), 'matched': 0, 'missed': len(dev_t), 'extra': len(host_t),
+                  'time_offset_ms': np.nan, 'IBI_difference_ms': np.nan, 'IBI_difference_max_ms': np.nan}
+        if len(dev_t) == 0 or len(host_t) == 0: return result
+
+        # nearest host beat for every beat from the arduino
+        j = np.clip(np.searchsorted(host_t, dev_t), 1, len(host_t) - 1) if len(host_t) > 1 else np.zeros(len(dev_t), dtype=int)
+        if len(host_t) > 1: j -= np.abs(host_t[j-1] - dev_t) < np.abs(host_t[j] - dev_t)
+        dt = host_t[j] - dev_t
+        matched = np.abs(dt) <= CFG_match_tolerance
+        num_matched = len(np.unique(j[matched]))
+        diff = host_IBI[j[matched]] - dev_IBI[matched]
+        diff = diff[~np.isnan(diff)]
+        result.update({'matched': num_matched, 'missed': int(len(dev_t) - np.count_nonzero(matched)), 'extra': len(host_t) - num_matched,
+                       'time_offset_ms': float(np.median(dt[matched]) * 1000) if matched.any() else np.nan,
+                       'IBI_difference_ms': float(np.mean(np.abs(diff))) if len(diff) else np.nan,
+                       'IBI_difference_max_ms': float(np.max(np.abs(diff))) if len(diff) else np.nan})
+        return result
+
+
+    def report(self):
+        """the comparison as text"""
+        c = self.compare()
+        return ('beats from the arduino: %d, detected on the host: %d, matched: %d, missed by the host: %d, extra on the host: %d\n'
+                'time offset (host - arduino): %.1f ms, IBI difference: mean %.1f ms, max %.1f ms') % (
+                c['device_beats'], c['host_beats'], c['matched'], c['missed'], c['extra'], c['time_offset_ms'], c['IBI_difference_ms'], c['IBI_difference_max_ms'])
+
+
+# main() function
+def main(argv=None):
+    import recorder
+    parser = argparse.ArgumentParser(description='detects the heart beats in a recording from the raw sensor data and compares them with the ones from the arduino')
+    parser.add_argument('dump', help='recording (see recorder.py, also older dumps)')
+    parser.add_argument('--binary', action='store_true', help='the recording contains the binary protocol')
+    parser.add_argument('--output', help='write the detected beats (time, IBI, BPM) to this file (tab-separated)')
+    args = parser.parse_args(argv)
+
+    decoder = protocol.Parser(args.binary)
+    beats = HostBeats('check', args.binary)
+    duration = 0.0
+    for data, t in recorder.read_dump(args.dump):
+        syms, vals, times = decoder.decode(data, t)
+        start = time.perf_counter()
+        beats.filter(syms, vals, times)
+        duration += time.perf_counter() - start
+
+    count = beats.detector.count
+    print('%d samples in %.3f s (%.0f samples/s)' % (count, duration, count / duration if duration > 0 else np.inf), file=sys.stderr)
+    print(beats.report(), file=sys.stderr)
+    if args.output:
+        host_t, host_IBI = _concatenate(beats.host)
+        np.savetxt(args.output, np.column_stack([host_t, host_IBI, 60000.0 / host_IBI]), fmt='%.6f\t%.2f\t%.1f', header='time\tIBI\tBPM', comments='')
+        print("Written beats to file: %s" % args.output)
+
+
+# call main
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+####
+#
+# benchmarks for parsing, HRV calculation and rendering with synthetic data of different sizes
+#
+# for each benchmark and size the time per call is measured (median and percentiles), together with the throughput
+# (beats or samples per second) and the peak memory allocated during one call.
+# the results can be saved as a baseline (JSON) and compared with a later run:
+#   python benchmark.py --save baseline.json
+#   python benchmark.py --compare baseline.json           # marks the results that are slower than the baseline
+#   python benchmark.py --only parse_text,hrv --sizes 100,10000
+#
+####
+
+
+# config
+
+CFG_sizes = [10**2, 10**3, 10**4, 10**5, 10**6]  # number of beats or samples
+CFG_repeat = 50           # max number of timed calls per benchmark and size
+CFG_min_repeat = 3        # min number of timed calls
+CFG_min_time = 1.0        # stop timing after so many seconds (once CFG_min_repeat calls are done)
+CFG_max_call = 10.0       # skip the larger sizes of a benchmark when one call would take longer than this (seconds)
+CFG_max_memory = 2**31    # or would need more memory than this (bytes), both are extrapolated linearly from the last size
+CFG_regression_threshold = 1.2  # a result is a regression if its median time is this factor larger than in the baseline
+CFG_sample_rate = 500     # sensor samples per second (as sent by the arduino)
+
+
+import numpy as np
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import beat_detector
+import hrv_analysis
+import protocol
+
+
+# synthetic data
+
+def synthetic_IBI(num, seed=0):
+    """inter-beat-intervals in ms: around 800 ms, with respiratory (0.25 Hz) and slower (0.1 Hz) modulation and noise"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(num) * 0.8
+    IBI = 800 + 40*np.sin(2*np.pi*0.25*t) + 30*np.sin(2*np.pi*0.1*t) + rng.normal(0, 15, num)
+    return np.round(IBI)
+
+
+def synthetic_sensor(num, seed=0):
+    """raw sensor values (CFG_sample_rate, 0..1023) of a pulse with 75 beats per minute, returns the values and the indices of the beats"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(num) / CFG_sample_rate
+    phase = (t * 1.25) % 1
+    sensor = 512 + 300*np.exp(-((phase-0.2)/0.05)**2) + 80*np.exp(-((phase-0.45)/0.08)**2) + rng.normal(0, 5, num)
+    beats = np.flatnonzero(np.diff(np.floor(t * 1.25))) + 1
+    return np.clip(np.round(sensor), 0, 1023).astype(np.int32), beats
+
+
+def synthetic_text(num, seed=0):
+    """the text protocol (S/B/Q lines) for num sensor samples"""
+    sensor, beats = synthetic_sensor(num, seed)
+    lines = np.char.add('S', sensor.astype(str)).astype(object)
+    lines[beats] = lines[beats] + '\r\nB75\r\nQ800'
+    return ('\r\n'.join(lines.tolist()) + '\r\n').encode('ascii')
+
+
+def synthetic_frames(num, seed=0):
+    """the binary protocol for num sensor samples (rounded up to whole frames)"""
+    sensor, beats = synthetic_sensor(num, seed)
+    num_frames = -(-num // protocol.CFG_frame_samples)
+    samples = np.zeros(num_frames * protocol.CFG_frame_samples, dtype=np.int32)
+    samples[:num] = sensor
+    beat = np.full(num_frames, protocol.CFG_no_beat)
+    beat[beats // protocol.CFG_frame_samples] = beats % protocol.CFG_frame_samples
+    seq = np.arange(num_frames)
+    return protocol.encode_frames(seq, seq * protocol.CFG_frame_us, samples, beat, 75, 800)
+
+
+# benchmarks: each one takes the size and returns the function to time and the number of items (beats/samples) per call
+
+def bench_hrv(num):
+    IBI = synthetic_IBI(num)
+    hrv = hrv_analysis.HRVdescriptors()
+    return lambda: hrv.calculate(IBI), num
+
+
+def bench_hrv_nonlinear(num):
+    IBI = synthetic_IBI(num)
+    hrv = hrv_analysis.HRVdescriptors()
+    return lambda: hrv.calculate(IBI, nonlinear=True), num
+
+
+def bench_nonlinear(num):
+    IBI = synthetic_IBI(num)
+    hrv = hrv_analysis.HRVdescriptors()
+    return lambda: hrv.CalculateNonLinearAnalysis(IBI), num
+
+
+def bench_stream(num):
+    IBI = synthetic_IBI(num)
+    def run():
+        stream = hrv_analysis.HRVstream(window_beats=300)
+        stream.extend(IBI)
+        return stream.calculate()
+    return run, num
+
+
+def bench_parse_text(num):
+    data = synthetic_text(num)
+    return lambda: protocol.Parser(binary=False).decode(data, 0.0), num
+
+
+def bench_parse_binary(num):
+    data = synthetic_frames(num)
+    return lambda: protocol.Parser(binary=True).decode(data, 0.0), num
+
+
+def bench_beats(num):
+    """beat detection on the host, the sensor data in chunks of one binary frame"""
+    sensor, beats = synthetic_sensor(num)
+    times = np.arange(num) / CFG_sample_rate
+    def run():
+        detector = beat_detector.BeatDetector(CFG_sample_rate)
+        for i in range(0, num, protocol.CFG_frame_samples):
+            detector.process(sensor[i:i+protocol.CFG_frame_samples], times[i:i+protocol.CFG_frame_samples])
+        return detector.beats
+    return run, num
+
+
+def bench_beats_bulk(num):
+    """beat detection on the host, all sensor data at once (reanalysis of a recording)"""
+    sensor, beats = synthetic_sensor(num)
+    times = np.arange(num) / CFG_sample_rate
+    return lambda: beat_detector.BeatDetector(CFG_sample_rate).process(sensor, times), num
+
+
+def _hrvplot(num):
+    """a plot that takes its samples from a ring buffer (no serial port, no history file)"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import heartex
+    import serial_reader
+    heartex.CFG_save_history = False
+    heartex.CFG_initial_wait = 0
+    heartex.CFG_maxpoints = {'sensor': None, 'beats': None, 'IBI': None}
+    hrvplot = heartex.HRVplot(heartex.CFG_comport, heartex.CFG_baudrate, heartex.CFG_serial_timeout, buffer=serial_reader.SampleRingBuffer(num))
+    plots.append(hrvplot)
+    return hrvplot
+
+
+plots = []  # plots of the current benchmark, closed after it
+
+
+def _fill(hrvplot, num):
+    """appends num sensor samples (and the beats) that span the visible part of the x axis"""
+    import heartex
+    sensor, beats = synthetic_sensor(num)
+    span_ms = heartex.CFG_graph_span_min * 60 * 1000
+    t_ms = np.linspace(0, span_ms, num).astype(np.int64)
+    hrvplot._append('sensor', sensor, t_ms)
+    hrvplot._append('IBI', synthetic_IBI(len(beats)), t_ms[beats])
+    hrvplot.ax['sensor'].set_xlim(hrvplot._date_num([0, span_ms]))
+
+
+def bench_update(num):
+    """HRVplot.update with num new samples (sensor only) in the buffer"""
+    hrvplot = _hrvplot(num)
+    sensor, beats = synthetic_sensor(num)
+    syms = np.full(num, ord('S'), dtype=np.uint8)
+    def run():
+        hrvplot.buffer.put(syms, sensor, time.time() + np.arange(num) / CFG_sample_rate)
+        hrvplot.update(0)
+    return run, num
+
+
+def bench_xlim(num):
+    """HRVplot._on_xlim_changed (autoscaling of the y axes) with num samples in the channels"""
+    hrvplot = _hrvplot(num)
+    _fill(hrvplot, num)
+    def run():
+        for a in hrvplot.fig.axes: a.xlim = None  # forget that the axes were treated
+        hrvplot._on_xlim_changed(hrvplot.ax['sensor'])
+    return run, num
+
+
+def bench_draw(num):
+    """one full frame on the Agg backend (line data and drawing of the figure) with num visible samples"""
+    hrvplot = _hrvplot(num)
+    _fill(hrvplot, num)
+    def run():
+        hrvplot._set_line_data('sensor')
+        hrvplot._set_line_data('IBI')
+        hrvplot.fig.canvas.draw()
+    return run, num
+
+
+def bench_draw_blit(num):
+    """one blitted frame on the Agg backend (line data and drawing of the animated artists) with num visible samples"""
+    hrvplot = _hrvplot(num)
+    _fill(hrvplot, num)
+    hrvplot.render()
+    def run():
+        hrvplot._set_line_data('sensor')
+        hrvplot._set_line_data('IBI')
+        hrvplot.render()
+    return run, num
+
+
+def bench_draw_texts(num):
+    """refresh of the texts only, on top of the last drawn lines (between two redraws, see HRVplot.render_texts) with num visible samples"""
+    hrvplot = _hrvplot(num)
+    _fill(hrvplot, num)
+    hrvplot.render()
+    def run():
+        hrvplot.text_IBI.set_text(str(num))
+        hrvplot.render_texts()
+    return run, num
+
+
+benchmarks = {'hrv': bench_hrv, 'hrv_nonlinear': bench_hrv_nonlinear, 'nonlinear': bench_nonlinear, 'stream': bench_stream, 'parse_text': bench_parse_text, 'parse_binary': bench_parse_binary,
+              'beats': bench_beats, 'beats_bulk': bench_beats_bulk,
+              'update': bench_update, 'xlim': bench_xlim, 'draw': bench_draw, 'draw_blit': bench_draw_blit, 'draw_texts': bench_draw_texts}
+
+
+# measurement
+
+def measure(fn, items):
+    """times fn, returns a dict with the results"""
+    start = time.perf_counter()
+    fn()  # warm up
+    first = time.perf_counter() - start
+
+    times = []
+    start = time.perf_counter()
+    while len(times) < CFG_repeat and (len(times) < CFG_min_repeat or time.perf_counter() - start < CFG_min_time) and first < CFG_max_call:
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    if not times: times = [first]
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {'calls': len(times), 'mean': float(np.mean(times)), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+            'throughput': items / p50 if p50 > 0 else None, 'peak_memory': peak, 'first': first}
+
+
+def run(names, sizes):
+    """runs the benchmarks, the larger sizes of a benchmark are skipped when they would exceed CFG_max_call or CFG_max_memory"""
+    results = []
+    for name in names:
+        for i, size in enumerate(sizes):
+            fn, items = benchmarks[name](size)
+            r = measure(fn, items)
+            r.update({'benchmark': name, 'size': size})
+            results.append(r)
+            print_result(r)
+            if plots:
+                import matplotlib.pyplot as plt
+                while plots: plots.pop().close()
+                plt.close('all')
+            if i+1 < len(sizes):
+                factor = sizes[i+1] / size
+                if r['first'] * factor > CFG_max_call or r['peak_memory'] * factor > CFG_max_memory:
+                    print("%-12s skipping sizes > %d (one call would take about %.1f s and %.0f MB)" % (name, size, r['first'] * factor, r['peak_memory'] * factor / 2**20))
+                    break
+    return results
+
+
+def print_result(r, baseline=None):
+    line = "%-12s %8d  p50 %10.3f ms  p90 %10.3f ms  p99 %10.3f ms  %12.0f items/s  peak %8.2f MB" % (
+        r['benchmark'], r['size'], r['p50']*1000, r['p90']*1000, r['p99']*1000, r['throughput'] or 0, r['peak_memory']/2**20)
+    if baseline is not None:
+        ratio = r['p50'] / baseline['p50']
+        line += "  %5.2fx%s" % (ratio, '  REGRESSION' if ratio > CFG_regression_threshold else '')
+    print(line)
+
+
+def environment():
+    """versions and machine, stored with the results"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': datetime.datetime.now().isoformat(), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor()}
+
+
+def compare(results, filename):
+    """prints the results next to the baseline, returns the number of regressions"""
+    with open(filename) as f:
+        baseline = {(r['benchmark'], r['size']): r for r in json.load(f)['results']}
+    print("\ncompared to %s:" % filename)
+    regressions = 0
+    for r in results:
+        b = baseline.get((r['benchmark'], r['size']))
+        if b is None: continue
+        print_result(r, b)
+        if r['p50'] / b['p50'] > CFG_regression_threshold: regressions += 1
+    return regressions
+
+
+# main() function
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks for parsing, HRV calculation and rendering')
+    parser.add_argument('--only', help='comma-separated benchmarks (%s)' % ','.join(benchmarks))
+    parser.add_argument('--sizes', help='comma-separated sizes (default: %s)' % ','.join(str(s) for s in CFG_sizes))
+    parser.add_argument('--save', help='save the results as JSON (baseline)')
+    parser.add_argument('--compare', help='compare with a baseline (JSON), exits with 1 if there are regressions')
+    args = parser.parse_args(argv)
+
+    names = args.only.split(',') if args.only else list(benchmarks)
+    for name in names:
+        if name not in benchmarks: parser.error('unknown benchmark: %s' % name)
+    sizes = [int(float(s)) for s in args.sizes.split(',')] if args.sizes else CFG_sizes
+
+    results = run(names, sizes)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1)
+        print("Written results to file: %s" % args.save)
+    if args.compare and compare(results, args.compare):
+        sys.exit(1)
+
+
+# call main
+if __name__ == '__main__':
+    main()
@@ -16,8 +16,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
-# the x-axis is just taken from the current computer time.
-# this can be improved when ones takes the time from arduino (either by sending time date from the arduino, or just using the IBI values (they provide time deltas between data points))
+# the x-axis is just taken from the current computer time (the time the data was received).
+# with the binary protocol (CFG_binary_protocol and BINARY_PROTOCOL in the arduino sketch) the arduino sends timestamps, and every sample gets its own time.
 #
 # these are the things sent by Arduino:
 #   sensor: the raw sensor data
@@ -26,7 +26,7 @@
 #
 #
 # todo:
-#   - real time axis (plot/input of data is now tied to current local time, should be tied to microprocessor time)
+#   - real time axis for the text protocol (plot/input of data is tied to the receive time, should be tied to microprocessor time)
 #
 #
 ####
@@ -37,20 +37,40 @@
 CFG_comport = 'COM3'
 CFG_baudrate = 115200
 CFG_serial_timeout = 1
+CFG_ringbuffer_size = 100000   # number of decoded samples that can be buffered between two frames
+CFG_binary_protocol = False    # the arduino sends binary frames with timestamps (BINARY_PROTOCOL in the arduino sketch)
+CFG_beats = 'device'           # 'device': beats (B and Q) from the arduino, 'host': detected on the host from the sensor data, 'check': from the arduino, compared with the host (see beat_detector.py)
 
 
-CFG_maxpoints        = {'sensor': 50000, 'beats': 10000, 'IBI': 10000} # max data points for sensor data, heart beats, inter-beat distances
+CFG_maxpoints        = {'sensor': 50000, 'beats': 10000, 'IBI': 10000} # max data points for sensor data, heart beats, inter-beat distances (None: no limit, e.g. for overnight sessions)
+CFG_store_dtype      = {'sensor': 'int16', 'beats': 'int16', 'IBI': 'int32'}  # data types for the stored values
+CFG_store_directory  = None    # keep the data in memory-mapped files in this directory (None: keep everything in memory)
 CFG_default_y        = {'sensor': 500.007007, 'beats': 0.007007, 'IBI': 500.007007}   # i use some special values so that I know afterwards that these are the default values (a bit of a dirty hack)
 CFG_default_y        = {'sensor': None, 'beats': None, 'IBI': None}   # i use some special values so that I know afterwards that these are the default values (a bit of a dirty hack)
 
-CFG_update_intervall = 20          # updates the graph every .. milliseconds
+CFG_update_intervall = 20          # takes the new data every .. milliseconds (and redraws the graph at most this often)
+CFG_render_budget = 0.3            # fraction of the time that may be spent redrawing the lines and bars, the redraws are spaced according to their measured duration (frames are dropped, never data)
+CFG_render_max_intervall = 1000    # but the graph is redrawn at least every .. milliseconds
 CFG_max_runtime = 240              # stops after so many seconds
 CFG_max_measurement_runtime = 120  # stops after so many seconds (after first beat was detected)
 CFG_initial_wait = 5               # wait 5 seconds before doing anything
 CFG_update_hrv_every = 10          # update hrv descriptors every n hear beats
+CFG_hrv_window_beats = None        # calculate hrv descriptors only from the last n beats (None: all beats)
+CFG_hrv_window_ms = None           # calculate hrv descriptors only from the last n milliseconds, e.g. 5*60*1000 (None: all beats)
 
 CFG_graph_span_min   = 0.15   # x axis span of the graph in minutes
 
+CFG_render_decimate = True   # only pass the visible part of the data to the plots, reduced to the minimum and maximum per pixel
+CFG_render_blit = True       # only redraw the changing artists, the axes are redrawn only when their limits change
+CFG_blit_xstep = 0.1         # when blitting, the x axis moves in steps of this fraction of the span
+CFG_blit_yshrink = 3         # when blitting, the y axis only shrinks when it is this factor larger than needed
+
+CFG_serve = None                # publish the data to viewers on this port, e.g. 8765 (see stream_server.py, None: do not publish)
+
+CFG_instrument = False          # record the timings of the stages of each frame (see instrument.py)
+CFG_instrument_overlay = False  # show the timings in the figure
+CFG_instrument_file = 'timings.json'  # write the timings to this file when the program ends (None: do not write)
+
 CFG_figsize = (14,8)
 
 CFG_default_fontsize = 14
@@ -63,50 +83,171 @@ CFG_plot_color    = {'HR': '#A53935', 'IBI': '#00695C', 'HRV_descriptors': '#3F5
 CFG_title_fontsize = 16
 CFG_title_color = '#000000'
 
-CFG_hrv_descriptors = ['HRMean', 'HRSTD', 'rMSSD', 'pNN50', 'VLF', 'LF', 'HF', 'LFHF', 'Power']  # gives the order
-CFG_hrv_descriptors_labels = {'HRMean': 'HR Mean', 'HRSTD': 'HR STD', 'rMSSD': 'rMSSD', 'pNN50': 'pNN50', 'VLF': 'VLF', 'LF': 'LF', 'HF': 'HF', 'LFHF': 'LFHF', 'Power': 'Power'}
-CFG_hrv_descriptors_units = {'HRMean': 'Hz', 'HRSTD': 'Hz', 'rMSSD': 'ms', 'pNN50': '%', 'VLF': 'ms2', 'LF': 'ms2', 'HF': 'ms2', 'LFHF': '', 'Power': 'ms2'}
-CFG_hrv_descriptors_format = {'HRMean': '%0.1f', 'HRSTD': '%0.1f', 'rMSSD': '%0.1f', 'pNN50': '%0.1f', 'VLF': '%0.1f', 'LF': '%0.1f', 'HF': '%0.1f', 'LFHF': '%0.2f', 'Power': '%0.1f'}
-CFG_hrv_descriptors_standard = {'HRMean': 75, 'HRSTD': 4, 'rMSSD': 51.7, 'pNN50': 12.3, 'VLF': 2437.2, 'LF': 2234.3, 'HF': 1442.6, 'LFHF': 1.75, 'Power': 6120.2}  # standard values for hrv descriptors (from http://www.hrv24.de/HRV-Interpretation.htm), HRSTD is made up
+CFG_hrv_descriptors = ['HRMean', 'HRSTD', 'rMSSD', 'pNN50', 'SD1', 'SD2', 'VLF', 'LF', 'HF', 'LFHF', 'Power', 'DFA1', 'DFA2', 'ApEn', 'FracDim']  # gives the order
+CFG_hrv_descriptors_labels = {'HRMean': 'HR Mean', 'HRSTD': 'HR STD', 'rMSSD': 'rMSSD', 'pNN50': 'pNN50', 'SD1': 'SD1', 'SD2': 'SD2', 'VLF': 'VLF', 'LF': 'LF', 'HF': 'HF', 'LFHF': 'LFHF', 'Power': 'Power', 'DFA1': r'DFA $\alpha_1$', 'DFA2': r'DFA $\alpha_2$', 'ApEn': 'ApEn', 'FracDim': 'FracDim'}
+CFG_hrv_descriptors_units = {'HRMean': 'Hz', 'HRSTD': 'Hz', 'rMSSD': 'ms', 'pNN50': '%', 'SD1': 'ms', 'SD2': 'ms', 'VLF': 'ms2', 'LF': 'ms2', 'HF': 'ms2', 'LFHF': '', 'Power': 'ms2', 'DFA1': '', 'DFA2': '', 'ApEn': '', 'FracDim': ''}
+CFG_hrv_descriptors_format = {'HRMean': '%0.1f', 'HRSTD': '%0.1f', 'rMSSD': '%0.1f', 'pNN50': '%0.1f', 'SD1': '%0.1f', 'SD2': '%0.1f', 'VLF': '%0.1f', 'LF': '%0.1f', 'HF': '%0.1f', 'LFHF': '%0.2f', 'Power': '%0.1f', 'DFA1': '%0.2f', 'DFA2': '%0.2f', 'ApEn': '%0.2f', 'FracDim': '%0.2f'}
+CFG_hrv_descriptors_standard = {'HRMean': 75, 'HRSTD': 4, 'rMSSD': 51.7, 'pNN50': 12.3, 'SD1': 36.6, 'SD2': 80, 'VLF': 2437.2, 'LF': 2234.3, 'HF': 1442.6, 'LFHF': 1.75, 'Power': 6120.2, 'DFA1': 1.0, 'DFA2': 1.0, 'ApEn': 1.0, 'FracDim': 4.4}  # standard values for hrv descriptors (from http://www.hrv24.de/HRV-Interpretation.htm), HRSTD is made up, SD1 is rMSSD/sqrt(2), SD2, DFA, ApEn and FracDim are typical values
 
 CFG_hrv_descriptors_log_base = 4  # for dynamic adjustment of bar plot  for hrv descriptors
 
 CFG_save_history = True
-CFG_filename_history = "hrv_data.xlsx"
+CFG_filename_history = "hrv_sessions.db"   # session store (SQLite), export to excel with: python session_store.py hrv_sessions.db --export hrv_data.xlsx
 
 CFG_no_arduino = False   # do not connect to arduino, read data from file (for testing)
+CFG_replay_speed = 1      # speed of the replay without arduino (1: real time, None: as fast as possible)
 CFG_save_dump = False     # save arduino data to file (for later offline testing)
 CFG_temp_file = 'temp.txt'  # store temp data here (if we do not want to re-record from arduino)
+CFG_dump_compress = True  # compress the saved arduino data
 
 
-import serial
+import time
+time_import = time.perf_counter()   # start of the imports (for the startup timings)
 import numpy as np
-import matplotlib.pyplot as plt 
-import matplotlib.animation as animation
-import matplotlib.dates
 import datetime
-import pickle
 import math
 import os.path
 import threading
-import openpyxl
 
 
+import beat_detector
 import hrv_analysis
+import hrv_worker
+import instrument
+import pipeline
+import protocol
+import recorder
+import sample_store
+import serial_reader
+import session_store
+time_imported = time.perf_counter()
+
+# matplotlib takes most of the startup time, it is imported when the figure is built (after the serial port is opened, so the data is
+# already buffered), the serial module when the port is opened
+matplotlib = None
+plt = None
+
+
+def import_matplotlib():
+    """imports matplotlib (only the first time)"""
+    global matplotlib, plt
+    if plt is not None: return
+    import matplotlib
+    import matplotlib.dates
+    import matplotlib.gridspec
+    import matplotlib.pyplot as plt
+    matplotlib.rcParams.update({'font.size': CFG_default_fontsize})
+
+
+def decimate_minmax(x, y, xlim, width):
+    """reduces sorted data to the minimum and maximum within each of width equally sized bins in the range xlim"""
+    bins = np.clip(((x - xlim[0]) / (xlim[1] - xlim[0]) * width).astype(int), -1, width)
+    starts = np.flatnonzero(np.diff(bins, prepend=bins[0]-1))
+    x_dec = np.repeat(x[starts], 2)
+    y_dec = np.empty(2*len(starts))
+    y_dec[0::2] = np.minimum.reduceat(y, starts)
+    y_dec[1::2] = np.maximum.reduceat(y, starts)
+    return x_dec, y_dec
+
+
+class WindowExtrema:
+    """minimum and maximum of the samples of a channel from a start index on, both the appending of samples and the
+    advancing of the start are amortised O(1) per sample (monotonic queues, filled with numpy for whole batches)"""
+
+    def __init__(self, capacity=1024):
+        self.count = 0  # number of appended samples
+        self.start = 0  # first sample of the window
+        self.queues = {}
+        for k in ['min', 'max']:  # indices and values (the max queue holds negated values), increasing values from head to tail
+            self.queues[k] = {'idx': np.zeros(capacity, dtype=np.int64), 'val': np.zeros(capacity), 'head': 0, 'tail': 0}
+
+
+    def _push(self, q, idx, vals):
+        # new samples only survive if they are smaller than all later samples
+        after = np.empty(len(vals))
+        after[-1] = np.inf
+        after[:-1] = np.minimum.accumulate(vals[:0:-1])[::-1]
+        keep = vals < after
+        idx, vals = idx[keep], vals[keep]
+        # and they remove all older samples that are not smaller
+        q['tail'] = q['head'] + np.searchsorted(q['val'][q['head']:q['tail']], vals[0], side='left')
+        n = q['tail'] - q['head']
+        if q['tail'] + len(vals) > len(q['idx']):  # move to the front, grow if needed
+            size = max(len(q['idx']), 2*(n + len(vals)))
+            for k in ['idx', 'val']:
+                new = np.empty(size, dtype=q[k].dtype)
+                new[:n] = q[k][q['head']:q['tail']]
+                q[k] = new
+            q['head'], q['tail'] = 0, n
+        q['idx'][q['tail']:q['tail']+len(vals)] = idx
+        q['val'][q['tail']:q['tail']+len(vals)] = vals
+        q['tail'] += len(vals)
+
+
+    def append(self, vals):
+        """appends samples"""
+        if len(vals) == 0: return
+        vals = np.asarray(vals, dtype=float)
+        idx = self.count + np.arange(len(vals))
+        self._push(self.queues['min'], idx, vals)
+        self._push(self.queues['max'], idx, -vals)
+        self.count += len(vals)
+
+
+    def advance(self, start):
+        """moves the start of the window forward (to the sample with index start)"""
+        if start <= self.start: return
+        self.start = start
+        for q in self.queues.values():
+            q['head'] += np.searchsorted(q['idx'][q['head']:q['tail']], start, side='left')
+
+
+    def range(self):
+        """returns minimum and maximum within the window (NaN if the window is empty)"""
+        q_min, q_max = self.queues['min'], self.queues['max']
+        if q_min['head'] == q_min['tail']: return np.nan, np.nan
+        return q_min['val'][q_min['head']], -q_max['val'][q_max['head']]
+
+
+class RenderScheduler():
+    """decides when the graph is redrawn: the duration of each redraw is measured (and smoothed), the next redraw is due so much later
+    that redrawing takes at most the budget (fraction) of the time. intervals in seconds"""
+
+    def __init__(self, budget=CFG_render_budget, min_interval=CFG_update_intervall/1000.0, max_interval=CFG_render_max_intervall/1000.0, smoothing=0.3):
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+        self.cost = None               # smoothed duration of a redraw
+        self.interval = min_interval   # current interval between redraws
+        self.next = 0.0                # when the next redraw is due (perf_counter)
+        self.draws = 0
+        self.dropped = 0               # frames that were not redrawn
+
+
+    def due(self, now):
+        return now >= self.next - 0.5*self.min_interval   # the timer is not exact
+
+
+    def done(self, start, end):
+        """records a redraw from start to end (perf_counter)"""
+        cost = end - start
+        self.cost = cost if self.cost is None else self.cost + self.smoothing * (cost - self.cost)
+        self.interval = min(max(self.cost / self.budget, self.min_interval), self.max_interval)
+        self.next = start + self.interval
+        self.draws += 1
 
-matplotlib.rcParams.update({'font.size': CFG_default_fontsize})
     
 # plot class
 class HRVplot:
 
-    def __init__(self, comport, baudrate, timeout):
+    def __init__(self, comport, baudrate, timeout, buffer=None):
+        """opens the serial port and sets up the figure, if buffer (a serial_reader.SampleRingBuffer) is given, the decoded samples are taken from there instead (see PlotSink)"""
     
         # setup data
         
-        self.x = {}
-        self.y = {}
         self.date_start = datetime.datetime.now()
-        self.date_start_num = matplotlib.dates.date2num(self.date_start)
+        self.time_start = time.time()  # same as date_start, in seconds since the epoch (used for the receive times of the samples)
         self.date_start_measurement = datetime.datetime.now()  # start of the measurement (will be set when first inter-beat-distance is detected)
         
         self.run_ended = False  # will be set to true when the measurement is done
@@ -114,20 +255,67 @@ class HRVplot:
         self.hrv_descriptors = {}  # current set calculated of HRV descriptors
         self.hrv_descriptors_plot_norm2 = {}  # normalize bar width (for plotting), defined in powers of CFG_hrv_descriptors_log_base
         
-        self.thread_update_descriptors = threading.Thread(target=self.update_descriptors_thread)
+        self.hrv_worker = hrv_worker.HRVworker()  # calculates the HRV descriptors in another process
+        self.hrv_requests = {}  # id of a pending request: time-domain descriptors at the time of the request, and time of the request
+        self.save_request = None  # the session is saved when the result of this request arrives
+        self.hrv_stream = hrv_analysis.HRVstream(window_beats=CFG_hrv_window_beats, window_ms=CFG_hrv_window_ms)  # incremental time-domain descriptors (for the descriptor window)
+        self.hrv_stream_all = hrv_analysis.HRVstream()  # incremental time-domain descriptors over all beats
         
         self.num_points = {'sensor': 0, 'beats': 0, 'IBI': 0}
+        self.extrema = {'sensor': WindowExtrema(), 'IBI': WindowExtrema()}  # for autoscaling of the plots
+        self.autoscaled_points = None  # num_points at the last autoscaling of the y axes
 
+        self.store = {}  # the data of the channels, times in milliseconds since time_start
         for sym in ['sensor', 'beats', 'IBI']:
-            self.y[sym] = np.empty(CFG_maxpoints[sym])
-            self.y[sym].fill(CFG_default_y[sym])
-            self.x[sym] = np.empty(CFG_maxpoints[sym])
-            self.x[sym].fill(self.date_start_num)
+            filename = None
+            if CFG_store_directory is not None:
+                filename = os.path.join(CFG_store_directory, "%s_%s" % (self.date_start.strftime("%Y-%m-%d_%H-%M-%S"), sym))
+            self.store[sym] = sample_store.SampleStore(CFG_store_dtype[sym], filename)
         
-        # setup figure/plots
+        # setup input and output first, the data is buffered while the figure is built
+
+        self.startup = {'imports': time_imported - time_import}   # durations of the startup steps (s)
+        t_step = time.perf_counter()
+        self.session_store = session_store.SessionStore(CFG_filename_history) if CFG_save_history else None
+        self.recorder = recorder.Recorder(CFG_temp_file, compress=CFG_dump_compress) if CFG_save_dump else None
+
+        self.server = None
+        if CFG_serve is not None:
+            import stream_server
+            self.server = stream_server.StreamServer(port=CFG_serve)
+
+        self.reader = None
+        beats = beat_detector.HostBeats(CFG_beats, CFG_binary_protocol) if CFG_beats != 'device' else None
+        if buffer is not None:
+            self.buffer = buffer
+        elif not CFG_no_arduino:
+            import serial
+            print('reading from serial port %s...' % CFG_comport)
+            self.ser = serial.Serial(comport, baudrate, timeout=CFG_serial_timeout)    # open serial port
+            self.reader = serial_reader.SerialReader(self.ser, CFG_ringbuffer_size, on_raw=self.recorder.record if CFG_save_dump else None, binary=CFG_binary_protocol, beats=beats)
+            self.reader.start()
+            self.buffer = self.reader.buffer
+        else:
+            self.reader = serial_reader.SerialReader(None, CFG_ringbuffer_size, binary=CFG_binary_protocol, beats=beats)  # only used to decode the recorded data
+            self.buffer = self.reader.buffer
         
+        self.replay = None
+        if CFG_no_arduino and buffer is None:
+            self.replay = pipeline.DumpSource(CFG_temp_file, speed=CFG_replay_speed)
+            self.replay_done = False
+            threading.Thread(target=self._replay, daemon=True).start()
+
+        self.startup['input'] = time.perf_counter() - t_step
+
+        # setup figure/plots
+
+        t_step = time.perf_counter()
+        import_matplotlib()
+        self.date_start_num = matplotlib.dates.date2num(self.date_start)
+        self.startup['matplotlib'] = time.perf_counter() - t_step
+        t_step = time.perf_counter()
         self.fig = plt.figure(num=None, figsize=CFG_figsize, facecolor='w', edgecolor='k')
-        self.fig.canvas.set_window_title('HeartRateEx')
+        self.fig.canvas.manager.set_window_title('HeartRateEx')
         gs = matplotlib.gridspec.GridSpec(2, 2, width_ratios=[3,1.5], height_ratios=[1,1])
 
         self.ax = {}
@@ -139,9 +327,8 @@ class HRVplot:
         self.ax['HRV_descriptors'] = self.fig.add_subplot(gs[:,1])
         
         self.plots = {}
-        self.plots['sensor'], = self.ax['sensor'].plot(self.x['sensor'], self.y['sensor'], color=CFG_plot_color['HR'], linewidth=2)
-        #self.plots['beats'],  = self.ax['beats'].plot(self.x['beats'], self.y['beats'])
-        self.plots['IBI'],    = self.ax['IBI'].plot(self.x['IBI'], self.y['IBI'], color=CFG_plot_color['IBI'], linewidth=2)
+        self.plots['sensor'], = self.ax['sensor'].plot([], [], color=CFG_plot_color['HR'], linewidth=2)
+        self.plots['IBI'],    = self.ax['IBI'].plot([], [], color=CFG_plot_color['IBI'], linewidth=2)
         
         dummy_plot, = self.ax['sensor'].plot(self.date_start_num, 500)  # some dummy plot to prevent scaling errors before any real data exists, will be removed later
         dummy_plot2, = self.ax['IBI'].plot(self.date_start_num, 800)
@@ -186,6 +373,15 @@ class HRVplot:
         #self.text_time = self.ax['sensor'].text(1, 1.06, ' ', horizontalalignment='right', verticalalignment='bottom', transform=self.ax['sensor'].transAxes, fontsize=CFG_text_fontsize['time'], color=CFG_text_color['time'], fontweight='bold')
         #self.text_time = self.ax['HRV_descriptors'].text(1, 0.20, ' ', horizontalalignment='right', verticalalignment='bottom', transform=self.ax['HRV_descriptors'].transAxes, fontsize=CFG_text_fontsize['time'], color=CFG_text_color['time'], fontweight='normal')
         self.text_time = self.fig.text(0.99, 0.985, ' ', horizontalalignment='right', verticalalignment='top', fontsize=CFG_text_fontsize['time'], color=CFG_text_color['time'], fontweight='normal')
+        if CFG_instrument or CFG_instrument_overlay: instrument.timings.enabled = True
+        if CFG_instrument_overlay:
+            self.text_timings = self.fig.text(0.01, 0.01, '', horizontalalignment='left', verticalalignment='bottom', fontsize=8, family='monospace', color=CFG_text_color['time'])
+        self.frame_count = 0
+        self.frame_last = None      # time of the last frame (perf_counter)
+        self.frame_received = None  # receive time of the oldest sample since the last redraw
+        self.scheduler = RenderScheduler()
+        self.texts_changed = False  # the texts have to be refreshed
+
         self.text_title = self.fig.text(0.01, 0.985, 'Heart rate measurement', horizontalalignment='left', verticalalignment='top', fontsize=CFG_title_fontsize, color=CFG_title_color, fontweight='bold')
 
         self.ax['IBI'].xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%Mm %Ss'))
@@ -215,35 +411,189 @@ class HRVplot:
         self.ax['HRV_descriptors'].yaxis.set_ticks_position('right')
         
         gs.tight_layout(self.fig, rect=[0, 0, 1, 0.96], w_pad=3.2)
-        
-        # setup input and output
 
-        if not CFG_no_arduino:
-            print('reading from serial port %s...' % CFG_comport)
-            self.ser = serial.Serial(comport, baudrate, timeout=CFG_serial_timeout)    # open serial port
+        if CFG_render_blit:
+            # these are drawn every frame, everything else (including the HRV descriptors) only when the axes or the descriptors change
+            # the texts are also refreshed between the redraws of the lines, on top of the image of the last drawn lines
+            self.animated_lines = [self.plots['sensor'], self.plots['IBI']]
+            self.animated_texts = [self.text_IBI, self.text_HR, self.text_HR_mean_10, self.text_HR_mean_all, self.text_time]
+            if CFG_instrument_overlay: self.animated_texts.append(self.text_timings)
+            self.animated = self.animated_lines + self.animated_texts
+            for a in self.animated: a.set_animated(True)
+            self.background = None
+            self.background_limits = None
+            self.lines_image = None
+            self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self.startup['figure'] = time.perf_counter() - t_step
+        self.startup_reported = False
+
+
+    def report_startup(self):
+        """prints the durations of the startup steps and when the first sample arrived and the first frame was shown (since the start of the imports)"""
+        now = time.perf_counter()
+        first_data = self.reader.time_first_data if self.reader is not None and self.reader.time_first_data is not None else now
+        self.startup['first_sample'] = first_data - time_import
+        self.startup['first_frame'] = now - time_import
+        print('startup: imports %.2f s, input %.2f s, matplotlib %.2f s, figure %.2f s, first sample after %.2f s, first frame after %.2f s' % tuple(
+            self.startup[k] for k in ['imports', 'input', 'matplotlib', 'figure', 'first_sample', 'first_frame']))
+        for k, v in self.startup.items(): instrument.timings.add('startup_%s' % k, v)
+        self.startup_reported = True
+
+
+    def _replay(self):
+        """feeds the recorded data to the reader, as if it was received now (runs in a thread)"""
+        for data, t in self.replay:
+            self.reader.feed(data, time.time())
+        self.replay_done = True
+
+
+    def _append(self, name, vals, t_ms):
+        """appends data points (times in milliseconds since time_start) to a channel (as long as there is space), returns the number of appended points"""
+        n = len(vals)
+        if CFG_maxpoints[name] is not None: n = min(n, CFG_maxpoints[name] - self.num_points[name])
+        self.store[name].append(vals[:n], t_ms[:n])
+        self.num_points[name] += n
+        if name in self.extrema: self.extrema[name].append(vals[:n])
+        return n
+
+
+    def _set_line_data(self, name):
+        """passes the data of a channel to its plot, with CFG_render_decimate only the visible part, reduced to the width of the axes in pixels"""
+        t = self.store[name].times()
+        y = self.store[name].values()
+        if CFG_render_decimate:
+            xlim = self.ax[name].get_xlim()
+            start, stop = np.searchsorted(t, self._ms(xlim))
+            t = t[max(start-1,0):(stop+1)]
+            y = y[max(start-1,0):(stop+1)]
+            width = max(int(self.ax[name].bbox.width), 1)
+            if len(t) > 2*width:
+                x, y = decimate_minmax(self._date_num(t), y, xlim, width)
+                self.plots[name].set_data(x, y)
+                return
+        self.plots[name].set_data(self._date_num(t), y)
+
+
+    def _date_num(self, t_ms):
+        """converts times in milliseconds since time_start to matplotlib dates"""
+        return self.date_start_num + np.asarray(t_ms) / (24*60*60*1000.0)
+
+
+    def _ms(self, date_num):
+        """converts matplotlib dates to milliseconds since time_start"""
+        return (np.asarray(date_num) - self.date_start_num) * (24*60*60*1000.0)
+
+
+    def _on_draw(self, event):
+        """after a full redraw: keeps the background for blitting and draws the animated artists on top"""
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_animated()
+
+
+    def _draw_animated(self):
+        """draws the lines, keeps the image for refreshing the texts, draws the texts"""
+        for a in self.animated_lines: self.fig.draw_artist(a)
+        self.lines_image = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for a in self.animated_texts: self.fig.draw_artist(a)
+        self.texts_changed = False
+
+
+    def render(self):
+        """draws the figure, with CFG_render_blit only the animated artists are redrawn as long as the axes do not change"""
+        canvas = self.fig.canvas
+        if not CFG_render_blit:
+            canvas.draw()   # not draw_idle(), the render scheduler measures the duration
+            canvas.flush_events()
+            self.texts_changed = False
+            return
+        t = instrument.timings.now()
+        limits = [(ax.get_xlim(), ax.get_ylim()) for ax in self.fig.axes]
+        if self.background is None or limits != self.background_limits:
+            self.background_limits = limits
+            canvas.draw()  # calls _on_draw
+            instrument.timings.lap('draw', t)
+        else:
+            canvas.restore_region(self.background)
+            self._draw_animated()
+            canvas.blit(self.fig.bbox)
+            instrument.timings.lap('blit', t)
+        canvas.flush_events()
+
+
+    def render_texts(self):
+        """redraws only the texts, on top of the last drawn lines (only when blitting, otherwise they are shown with the next redraw)"""
+        if not CFG_render_blit or self.lines_image is None: return
+        t = instrument.timings.now()
+        canvas = self.fig.canvas
+        canvas.restore_region(self.lines_image)
+        for a in self.animated_texts: self.fig.draw_artist(a)
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+        self.texts_changed = False
+        instrument.timings.lap('texts', t)
+
+
+    def frame(self):
+        """one tick of the timer: always takes the new data, redraws the lines and bars only when the render scheduler says so
+        (once for the data of all ticks since the last redraw), in between only the texts are refreshed"""
+        tm = instrument.timings
+        t = time.perf_counter()
+        if tm.enabled:
+            if self.frame_last is not None:
+                interval = t - self.frame_last
+                tm.add('interval', interval)
+                if interval > 1.5 * CFG_update_intervall / 1000.0:
+                    tm.count('skipped_frames', int(interval / (CFG_update_intervall / 1000.0)) - 1)
+            self.frame_last = t
+        self.ingest()
+        if self.run_ended: return
+        if not self.scheduler.due(time.perf_counter()):
+            self.scheduler.dropped += 1
+            tm.count('dropped_frames')
+            if self.texts_changed: self.render_texts()
+            tm.lap('frame_texts', t)
+            return
+        t_draw = time.perf_counter()
+        self.update_lines()
+        self.render()
+        self.scheduler.done(t_draw, time.perf_counter())
+        if tm.enabled:
+            tm.lap('frame', t)
+            tm.add('render_interval', self.scheduler.interval)
+            if self.frame_received is not None:
+                tm.add('latency', time.time() - self.frame_received)  # from the arrival of the data until it is shown
+            self.frame_received = None
+            self.frame_count += 1
+            if CFG_instrument_overlay and self.frame_count % 25 == 0:
+                self.text_timings.set_text(tm.summary(['frame', 'frame_texts', 'buffer', 'append', 'lines', 'autoscale', 'blit', 'draw', 'texts', 'hrv', 'latency', 'interval', 'render_interval']))
+                self.texts_changed = True
+
 
-        if CFG_save_dump: self.lines = []
-        
-        if CFG_no_arduino:
-            self.no_arduino =  pickle.load(open(CFG_temp_file, "rb" ))
-            self.lines_sim_iter = iter(self.no_arduino['lines'])
-        
-   
     def _on_xlim_changed(self, ax, min_y=None, max_y=None):
-        """autoscale y-axis according to current x-axis limits, based on stackoverflow code"""
+        """autoscale y-axis according to current x-axis limits, based on stackoverflow code
+        the range of the data is taken from the incrementally updated extrema of the channels"""
         xlim = ax.get_xlim()
+        channels = {self.ax[name]: name for name in self.extrema}
         for a in ax.figure.axes:
             # shortcuts: last avoids n**2 behavior when each axis fires event
             if a is ax or len(a.lines) == 0 or getattr(a, 'xlim', None) == xlim:
                 continue
 
-            ylim = np.inf, -np.inf
+            ylim = [np.inf, -np.inf]
             for l in a.lines:
-                x, y = l.get_data()
-                # faster, but assumes that x is sorted
-                start, stop = np.searchsorted(x, xlim)
-                yc = y[max(start-1,0):(stop+1)]
-                ylim = min(ylim[0], np.nanmin(yc)), max(ylim[1], np.nanmax(yc))
+                if a in channels and l is self.plots[channels[a]]:
+                    name = channels[a]
+                    start = np.searchsorted(self.store[name].times(), self._ms(xlim[0]))  # assumes that the times are sorted
+                    self.extrema[name].advance(max(start-1,0))
+                    ymin, ymax = self.extrema[name].range()
+                    if np.isnan(ymin): continue
+                else:  # other lines (the dummy plots)
+                    x, y = l.get_data()
+                    start, stop = np.searchsorted(x, xlim)
+                    yc = y[max(start-1,0):(stop+1)]
+                    if len(yc) == 0: continue
+                    ymin, ymax = np.nanmin(yc), np.nanmax(yc)
+                ylim = [min(ylim[0], ymin), max(ylim[1], ymax)]
 
             # x axis: emit=False avoids infinite loop
             a.set_xlim(xlim, emit=False)
@@ -253,6 +603,12 @@ class HRVplot:
                 if ylim[1]>max_y: ylim[1]=max_y
             if min_y!=None:
                 if ylim[0]>min_y: ylim[0]=min_y
+            if CFG_render_blit:  # keep the current limits as long as they fit (each change needs a full redraw)
+                lo, hi = a.get_ylim()
+                span = (ylim[1]-ylim[0]) * (1 + 2*a.margins()[1])
+                if lo <= ylim[0] and ylim[1] <= hi and (hi-lo) <= CFG_blit_yshrink*span:
+                    a.xlim = xlim
+                    continue
             corners = (xlim[0], ylim[0]), (xlim[1], ylim[1])
             a.dataLim.update_from_data_xy(corners, ignore=True, updatex=False)
             a.autoscale(enable=True, axis='y', tight=True)
@@ -260,17 +616,23 @@ class HRVplot:
             a.xlim = xlim
             
 
-    def update_descriptors_thread(self):
-        """calculates and updates HRV descriptors"""
+    def apply_descriptors(self, r):
+        """updates the bars and texts of the HRV descriptors (in the GUI thread)"""
         
-        hrv = hrv_analysis.HRVdescriptors()
-        r = hrv.calculate(self.y['IBI'][:self.num_points['IBI']])
+        t = instrument.timings.now()
         self.hrv_descriptors = r  # this list is not used right now
+        if self.server is not None: self.server.descriptors(time.time(), r)
         
         pos = range(len(CFG_hrv_descriptors))
         vals = []
         for k in CFG_hrv_descriptors:
-            val = r[k] / CFG_hrv_descriptors_standard[k]
+            val = r.get(k, np.nan) / CFG_hrv_descriptors_standard[k]  # ApEn and FracDim are missing if the worker runs without the non-linear analysis
+            if np.isnan(val):  # e.g. DFA2 at the start of a session (not enough beats yet)
+                self.hrv_descriptors_plot_norm2[k] = 0
+                vals.append(0)
+                self.hrv_text[k].set_text('')
+                self.hrv_text_norm[k].set_text('')
+                continue
             if val>0:
                 self.hrv_descriptors_plot_norm2[k] = np.sign(math.log(val, CFG_hrv_descriptors_log_base)) * np.floor(np.abs(math.log(val, CFG_hrv_descriptors_log_base)))
             else:
@@ -282,165 +644,214 @@ class HRVplot:
     
         for rect, val in zip(self.plots['HRV_descriptors'], vals):
             rect.set_width(val)
+        if CFG_render_blit: self.background = None  # the descriptors are part of the background
+        instrument.timings.lap('hrv_apply', t)
     
     
     def update_descriptors(self):
-        """starts thread to calculate and update HRV descriptors"""
+        """requests the calculation of the HRV descriptors from the worker process (replaces a request that is not calculated yet), returns the id of the request"""
+        
+        request_id = self.hrv_worker.request(self.hrv_stream.count)
+        self.hrv_requests[request_id] = (self.hrv_stream.calculate(), time.perf_counter())
+        return request_id
         
-        if not self.thread_update_descriptors.isAlive():
-            self.thread_update_descriptors = threading.Thread(target=self.update_descriptors_thread)
-            self.thread_update_descriptors.start()
+    
+    def poll_descriptors(self):
+        """applies the newest finished HRV descriptors, the time-domain descriptors are taken from the incremental calculation"""
+        
+        results = self.hrv_worker.poll()
+        if not results: return
+        request_id, r = results[-1]
+        r_stream, t = self.hrv_requests[request_id]
+        for k in [k for k in self.hrv_requests if k <= request_id]: del self.hrv_requests[k]  # older requests were replaced
+        instrument.timings.add('hrv', time.perf_counter() - t)  # from the request until the result is there
+        if r and r_stream:   # the incremental calculation needs 2 beats in its window too
+            r.update(r_stream)
+            self.apply_descriptors(r)
+        if self.save_request is not None and request_id >= self.save_request:
+            self.save_request = None
+            self.save_history()
         
 
-    #@profile    # for line-profiling
     def update(self, frameNum):
-        """reads date from serial connection and updates the plot""" 
+        """takes the new data from the serial reader and updates the plot (without drawing it)"""
+        self.ingest()
+        return self.update_lines()
+
+
+    #@profile    # for line-profiling
+    def ingest(self):
+        """takes the new data from the serial reader, updates the texts and the HRV descriptors""" 
         
-        if self.run_ended: return False
+        self.poll_descriptors()
+        if self.run_ended: return
+        tm = instrument.timings
+        t = tm.now()
         
-        update_artists = [self.ax['sensor'], self.ax['IBI'], self.ax['HRV_descriptors']]  # will be return to the animation task, for update, we need a few more if we want to use blit
-
-        symbols = {"S":"sensor", "B":"beats", "Q":"IBI"}   # these are the symbols that come form the arduino program
-        try:
-            #line = self.ser.readline()
-            if not CFG_no_arduino: serialRead = self.ser.read(self.ser.inWaiting())
-            now = datetime.datetime.now()
-            now_num = matplotlib.dates.date2num(now)
-
-            if CFG_no_arduino:
-                try:
-                    arduino_input = next(self.lines_sim_iter)
-                except StopIteration:
-                    self.close()
-                    return update_artists
+        now = datetime.datetime.now()
+
+        if self.replay is not None and self.replay_done and self.buffer.written == self.buffer.read:  # all recorded data is shown
+            self.close()
+            self.run_ended = True
+            return
+
+        syms, vals, times = self.buffer.get()
+        if not self.startup_reported and len(times): self.report_startup()
+        if self.server is not None: self.server.samples(syms, vals, times)
+        keep = times - self.time_start >= CFG_initial_wait
+        syms, vals, t_ms = syms[keep], vals[keep], np.round((times[keep] - self.time_start) * 1000).astype(np.int64)  # milliseconds since time_start
+        elapsed = (now-self.date_start).seconds
+        if tm.enabled:
+            tm.add('backlog', len(times), 'samples')  # per frame
+            if self.frame_received is None and len(times): self.frame_received = times[0]
+            t = tm.lap('buffer', t)
+
+        # raw sensor data, all at once
+        is_sensor = syms == ord('S')
+        if self.num_points['sensor']==0 and is_sensor.any() and vals[is_sensor][0]==0:
+            is_sensor[np.argmax(is_sensor)] = False   # for some reason the first value is always 0, just want to ignore this one
+        self._append('sensor', vals[is_sensor], t_ms[is_sensor])
+
+        # heart beats, one by one (they are few)
+        for i in np.flatnonzero((syms == ord('B')) | (syms == ord('Q'))).tolist():
+            sym = chr(syms[i])
+            val = int(vals[i])
+            if not self._append(protocol.CFG_symbols[sym], vals[i:i+1], t_ms[i:i+1]): continue
+               
+            if sym=='Q':  # always a B and a Q together, so let's update only once
+                self.hrv_worker.add(val)
+                self.hrv_stream.add(val)
+                self.hrv_stream_all.add(val)
+                self.text_IBI.set_text(val)
+                self.text_HR.set_text(int(60000.0/val))
+                self.text_HR_mean_10.set_text(int(self.store['beats'].last))
+                self.text_HR_mean_all.set_text(int(self.hrv_stream_all.HR_mean))
+                self.texts_changed = True
+                
+                if self.num_points['IBI']>1:
+                    if (self.num_points['IBI'] % CFG_update_hrv_every ==0):
+                        self.update_descriptors()  # calculates and updates HRV descriptors
+                if self.num_points['IBI']==1:
+                    self.date_start_measurement=now
+                    self.ax['IBI'].lines[1].remove()  # remove dummy plots
+                    self.ax['sensor'].lines[1].remove()
+                    if CFG_render_blit: self.background = None
+        t = tm.lap('append', t)
+
+        if len(syms):
+            if self.num_points['IBI']>1:
+                elasped_measurement = (now-self.date_start_measurement).seconds
             else:
-                arduino_input = serialRead.strip().decode('ascii')
-            if CFG_save_dump: self.lines.append(arduino_input)
-            
-        except ValueError:
-            return update_artists
-        except UnicodeDecodeError:
-            return update_artists
-            
-        for line in arduino_input.split("\r\n"):
-            if len(line)<2: return update_artists
-            elapsed = (now-self.date_start).seconds
-            if elapsed<CFG_initial_wait: return update_artists
+                elasped_measurement = 0
+            if elapsed < 3600:
+                elapsed_str = '{:02}:{:02}'.format(elasped_measurement % 3600 // 60, elasped_measurement % 60)
+            else:
+                elapsed_str = '{:02}:{:02}:{:02}'.format(elasped_measurement // 3600, elasped_measurement % 3600 // 60, elasped_measurement % 60)
+            if self.text_time.get_text() != "Elapsed time: %s" % elapsed_str:
+                self.text_time.set_text("Elapsed time: %s" % elapsed_str)
+                self.texts_changed = True
             
-            sym = line[0]
-            if sym in symbols:
-                val = int(line[1:])
-                if sym=="S":
-                    if val==0 and self.num_points['sensor']==0: return update_artists   # for some reason the first value is always 0, just want to ignore this one
-
-                self.num_points[symbols[sym]] += 1
-                self.y[symbols[sym]][self.num_points[symbols[sym]]-1] = val
-                self.x[symbols[sym]][self.num_points[symbols[sym]]-1] = now_num
-                if not sym in ["S", "Q", "B"]:
-                    print("unexpected data: %s, %s "% (sym, val))
-                else:               
-                    if sym in ["S", "Q"]:
-                        x_data = self.x[symbols[sym]][:self.num_points[symbols[sym]]]
-                        y_data = self.y[symbols[sym]][:self.num_points[symbols[sym]]]
-                        self.plots[symbols[sym]].set_data(x_data, y_data)
-                   
-                    if sym=='Q':  # always a B and a Q together, so let's update only once
-                        self.text_IBI.set_text(self.y['IBI'][self.num_points['IBI']-1])
-                        self.text_HR.set_text(int(60000.0/self.y['IBI'][self.num_points['IBI']-1]))
-                        self.text_HR_mean_10.set_text(int(self.y['beats'][self.num_points['beats']-1]))
-                        self.text_HR_mean_all.set_text(int(np.mean(60000.0/self.y['IBI'][:self.num_points['IBI']])))
-                        
-                        if self.num_points['IBI']>1:
-                            if (self.num_points['IBI'] % CFG_update_hrv_every ==0):
-                                self.update_descriptors()  # calculates and updates HRV descriptors
-                        if self.num_points['IBI']==1:
-                            self.date_start_measurement=now
-                            self.ax['IBI'].lines.pop(1)  # remove dummy plots
-                            self.ax['sensor'].lines.pop(1)
-                   
-                    if self.num_points['IBI']>1:
-                        elasped_measurement = (now-self.date_start_measurement).seconds
-                    else:
-                        elasped_measurement = 0
-                    if elapsed < 3600:
-                        elapsed_str = '{:02}:{:02}'.format(elasped_measurement % 3600 // 60, elasped_measurement % 60)
-                    else:
-                        elapsed_str = '{:02}:{:02}:{:02}'.format(elasped_measurement // 3600, elasped_measurement % 3600 // 60, elasped_measurement % 60)
-                    self.text_time.set_text("Elapsed time: %s" % elapsed_str)
-                    
-                    maxpoints_exceeded=False
-                    for s in symbols.values():
-                        if self.num_points[s] >= CFG_maxpoints[s]:
-                            maxpoints_exceeded=True
-                    if  (elapsed > CFG_max_runtime or elasped_measurement > CFG_max_measurement_runtime or maxpoints_exceeded):
-                        self.update_descriptors()  # let's do it one last time
-                        self.run_ended = True
-                        if CFG_save_dump: pickle.dump({'IBI': self.y['IBI'][:self.num_points[symbols[sym]]], 'lines': self.lines}, open(CFG_temp_file, "wb" ))
-                        if CFG_save_history:
-                            self.save_history(CFG_filename_history)
-                        break
-                    
-        # update graph limits/scale
+            maxpoints_exceeded=False
+            for s in protocol.CFG_symbols.values():
+                if CFG_maxpoints[s] is not None and self.num_points[s] >= CFG_maxpoints[s]:
+                    maxpoints_exceeded=True
+            if  (elapsed > CFG_max_runtime or elasped_measurement > CFG_max_measurement_runtime or maxpoints_exceeded):
+                request_id = self.update_descriptors()  # let's do it one last time
+                self.run_ended = True
+                if CFG_save_dump: self.recorder.close()
+                if CFG_save_history:
+                    self.save_request = request_id  # saved with the final descriptors
+        tm.lap('status', t)
+
+
+    def update_lines(self):
+        """moves the x axis with the time, passes the data to the lines and scales the y axes"""
+        
+        update_artists = [self.ax['sensor'], self.ax['IBI'], self.ax['HRV_descriptors']]
         if self.num_points['sensor'] == 0: return update_artists
-        x_lim_start = now_num - CFG_graph_span_min/24/60
-        #if x_lim_start < self.x['sensor'][0]: x_lim_start = self.x['sensor'][0]
-        self.ax['sensor'].set_xlim([x_lim_start, now_num])
+        t = instrument.timings.now()
+        now_num = matplotlib.dates.date2num(datetime.datetime.now())
+        x_lim_end = now_num
+        if CFG_render_blit:  # move the x axis in steps, so that the axes do not have to be redrawn every frame
+            x_lim_step = CFG_blit_xstep * CFG_graph_span_min/24/60
+            x_lim_end = math.ceil(now_num / x_lim_step) * x_lim_step
+        x_lim_start = x_lim_end - CFG_graph_span_min/24/60
+        self.ax['sensor'].set_xlim([x_lim_start, x_lim_end])
+        self._set_line_data('sensor')
+        self._set_line_data('IBI')
+        t = instrument.timings.lap('lines', t)
+        points = (self.num_points['sensor'], self.num_points['IBI'])
+        if points != self.autoscaled_points:  # new samples can change the y range even if the x axis did not move (blit steps)
+            for a in self.fig.axes: a.xlim = None
+            self.autoscaled_points = points
         self._on_xlim_changed(self.ax['sensor'])
         self._on_xlim_changed(self.ax['IBI'])
+        instrument.timings.lap('autoscale', t)
         
         return update_artists
         
         
-    def save_history(self, filename):
-        """appends HRV data to an excel file. creates the file if it does not exist (also creates the header row in that case)"""
-        if not os.path.isfile(filename):  # create file with default header
-            wb = openpyxl.Workbook()
-            ws = wb.active
-            ws.title = 'HRV History'
-            ws.cell(row = 1, column = 1).value = 'datetime'
-            i = 2
-            for key in CFG_hrv_descriptors:
-                ws.cell(row = 1, column = i).value = "%s [%s]" % (CFG_hrv_descriptors_labels[key], CFG_hrv_descriptors_units[key])
-                i+=1
-            ws.cell(row = 1, column = i).value = 'IBI data'
-            wb.save(filename)
-
-        wb = openpyxl.load_workbook(filename)
-        ws = wb.active
-        r = ws.max_row + 1
-        ws.cell(row = r, column = 1).value = self.date_start
-        i = 2
-        for key in CFG_hrv_descriptors:
-            if key in self.hrv_descriptors:
-                ws.cell(row = r, column = i).value = self.hrv_descriptors[key]
-            i+=1
-        arrstr = np.char.mod('%0.0f', self.y['IBI'][:self.num_points['IBI']])
-        ws.cell(row = r, column = i).value = ",".join(arrstr)
-        try:
-            wb.save(filename)
-            print("Written data to file: %s" % filename)
-        except PermissionError:
-            filename_new = "%s_%s.%s" % (os.path.splitext(filename)[0], datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") ,os.path.splitext(filename)[1])
-            wb.save(filename_new)   # save under a different filename
-            print("Written data to file: %s" % filename_new)
+    def save_history(self):
+        """appends the session (HRV descriptors and IBI data) to the session store, the writing happens in the background"""
+        self.session_store.append(self.date_start, self.hrv_descriptors, self.store['IBI'].values())
         return True
 
     
     # clean up
     def close(self):
-        if not CFG_no_arduino:
+        if not CFG_no_arduino and self.reader is not None:
             # close serial
+            self.reader.stop()
             self.ser.flush()
             self.ser.close()    
+        if self.replay is not None: self.replay.close()
+        if self.reader is not None and self.reader.beats is not None and self.reader.beats.mode == 'check': print(self.reader.beats.report())
+        if self.recorder is not None: self.recorder.close()
+        deadline = time.time() + 10
+        while self.save_request is not None and time.time() < deadline:  # wait for the final descriptors of the session
+            self.poll_descriptors()
+            time.sleep(0.05)
+        self.hrv_worker.close()
+        if self.server is not None: self.server.close()
+        for store in self.store.values(): store.close()
+        if self.session_store is not None: self.session_store.close()
+        if CFG_instrument and CFG_instrument_file is not None: instrument.timings.dump(CFG_instrument_file)
  
 
+class PlotSink():
+    """sink for the headless pipeline (see pipeline.py) that shows the data in the live plot"""
+
+    def __init__(self):
+        self.hrvplot = HRVplot(CFG_comport, CFG_baudrate, CFG_serial_timeout, buffer=serial_reader.SampleRingBuffer(CFG_ringbuffer_size))
+
+
+    def samples(self, syms, vals, times):
+        if len(times) == 0: return
+        self.hrvplot.buffer.put(syms, vals, time.time() + (times - times[-1]))  # the plot shows the data as received now (also for replays)
+
+
+    def descriptors(self, t, result):
+        pass  # the plot calculates the descriptors itself
+
+
+    def close(self):
+        pass
+
+
+def show(hrvplot):
+    """runs the animation until the window is closed, we draw ourselves (see HRVplot.frame), the timer only triggers the frames"""
+    hrvplot.update(0)
+    timer = hrvplot.fig.canvas.new_timer(interval=CFG_update_intervall)
+    timer.add_callback(hrvplot.frame)
+    timer.start()
+    plt.show()
+
+
 # main() function
 def main():
     hrvplot = HRVplot(CFG_comport, CFG_baudrate, CFG_serial_timeout)
  
-    hrvplot.update(0)
-    anim = animation.FuncAnimation(hrvplot.fig, hrvplot.update, interval=CFG_update_intervall, blit=False)
-    plt.show()
+    show(hrvplot)
 
     hrvplot.close()
  
@@ -20,61 +20,187 @@ CFG_lfmax = 0.15
 CFG_hfmin = 0.15   # high frequency
 CFG_hfmax = 0.40
 
-CFG_interpolate_freq = 4  # Hz
+CFG_interpolate_freq = 4  # Hz, the inter-beat-intervals are resampled at this frequency for the spectrum
+
+CFG_spectrum = 'welch'    # 'welch': Welch's method on the resampled inter-beat-intervals, 'lombscargle': Lomb-Scargle periodogram of the (unevenly spaced) beats
+CFG_welch_segment = 1024  # samples per segment (256 s at 4 Hz, long enough for the VLF band), shorter series are one segment
+CFG_welch_overlap = 0.5   # overlap of the segments
+CFG_lomb_df = 0.001       # frequency resolution of the Lomb-Scargle periodogram (Hz)
+CFG_sliding_hop = 120     # HRVspectrogram: new band powers every so many samples (30 s at 4 Hz)
+CFG_sliding_segments = 4  # HRVspectrogram: the band powers are averaged over the last so many segments
+
+CFG_nonlinear_chunk = 2**20  # max number of pairwise distances held in memory at once for the non-linear analysis
+CFG_nonlinear_bins = 4096    # histogram bins used to locate the distance quantiles for the fractal dimension
+
+CFG_dfa_short = (4, 16)   # box sizes (beats) for the short-term scaling exponent of the detrended fluctuation analysis (DFA1)
+CFG_dfa_long = (16, 64)   # box sizes (beats) for the long-term scaling exponent (DFA2)
+CFG_dfa_min_boxes = 4     # a box size is only used if the series holds at least so many boxes of it
+CFG_dfa_chunk = 2**17     # calculate_batch: max number of beats per DFA call (the boxes of all series of a call are held in memory at once)
+
+CFG_bands = {'VLF': (CFG_vlfmin, CFG_vlfmax), 'LF': (CFG_lfmin, CFG_lfmax), 'HF': (CFG_hfmin, CFG_hfmax), 'Power': (0, CFG_hfmax)}  # Power: total power
     
     
-from scipy import interpolate
 import numpy as np
+import collections
+import functools
+
+
+def resample(IBI, freq=CFG_interpolate_freq):
+    """resamples inter-beat-intervals (in ms) at freq (Hz) by linear interpolation, each interval belongs to the time of the beat that ends it,
+    the samples start at the first beat"""
+    t = np.cumsum(IBI) / 1000.0
+    return np.interp(np.arange(t[0], t[-1], 1.0/freq), t, IBI)
+
+
+@functools.lru_cache(maxsize=64)
+def welch_plan(nseg, freq=CFG_interpolate_freq):
+    """window and band weights for segments of nseg samples, cached per length
+    returns the (periodic Hann) window and a (nseg//2+1 x len(CFG_bands)) matrix that turns the squared magnitudes of the rfft
+    of a windowed segment into the powers (ms2) of the bands (columns in the order of CFG_bands)"""
+    window = 0.5 - 0.5*np.cos(2*np.pi*np.arange(nseg)/nseg)
+    freqs = np.fft.rfftfreq(nseg, 1.0/freq)
+    scale = np.full(len(freqs), 2.0 / (freq * np.sum(window**2)))  # one-sided power spectral density
+    scale[0] /= 2
+    if nseg % 2 == 0: scale[-1] /= 2
+    masks = np.column_stack([(freqs >= fmin) & (freqs < fmax) for fmin, fmax in CFG_bands.values()])
+    weights = masks * (scale * freq / nseg)[:,None]  # times the width of a frequency bin
+    window.flags.writeable = False
+    weights.flags.writeable = False
+    return window, weights
+
+
+def welch_band_powers(x, nseg=None, step=None):
+    """powers (ms2) in the bands of CFG_bands (columns) of the rows of x (resampled series of the same length) with Welch's method
+    segments of nseg samples (default: CFG_welch_segment or the whole series if it is shorter), step samples apart"""
+    x = np.atleast_2d(x)
+    nseg = min(x.shape[1], CFG_welch_segment) if nseg is None else nseg
+    step = max(int(nseg * (1 - CFG_welch_overlap)), 1) if step is None else step
+    window, weights = welch_plan(nseg)
+    segs = np.lib.stride_tricks.sliding_window_view(x, nseg, axis=1)[:,::step,:]
+    segs = (segs - segs.mean(axis=2, keepdims=True)) * window  # without the mean of each segment
+    spec = np.mean(np.abs(np.fft.rfft(segs, axis=2))**2, axis=1)
+    return spec.dot(weights)
+
+
+def welch_band_powers_ragged(series, nseg=CFG_welch_segment):
+    """welch_band_powers() of several resampled series of different lengths (each at least nseg samples) in one FFT call:
+    the segments of all series are stacked, the band powers of the segments are averaged per series"""
+    step = max(int(nseg * (1 - CFG_welch_overlap)), 1)
+    window, weights = welch_plan(nseg)
+    counts = np.array([(len(x) - nseg) // step + 1 for x in series])
+    segs = np.concatenate([np.lib.stride_tricks.sliding_window_view(x, nseg)[::step] for x in series])
+    segs = (segs - segs.mean(axis=1, keepdims=True)) * window
+    powers = (np.abs(np.fft.rfft(segs, axis=1))**2).dot(weights)  # the band powers are linear in the spectrum, so average them instead
+    return np.add.reduceat(powers, np.cumsum(counts) - counts, axis=0) / counts[:,None]
+
+
+@functools.lru_cache(maxsize=1)
+def lomb_plan():
+    """angular frequencies of the Lomb-Scargle periodogram and the band weights (see welch_plan)"""
+    freqs = np.arange(CFG_lomb_df, CFG_hfmax + CFG_lomb_df/2, CFG_lomb_df)
+    weights = np.column_stack([(freqs >= fmin) & (freqs < fmax) for fmin, fmax in CFG_bands.values()]) * CFG_lomb_df
+    return 2*np.pi*freqs, weights
+
+
+def lomb_band_powers(IBI):
+    """powers (ms2) in the bands of CFG_bands of one series of inter-beat-intervals, from the Lomb-Scargle periodogram (without resampling)"""
+    from scipy import signal  # only needed here
+    t = np.cumsum(IBI) / 1000.0
+    w, weights = lomb_plan()
+    P = signal.lombscargle(t, IBI - np.mean(IBI), w)
+    return (P * 2 * (t[-1] - t[0]) / len(IBI)).dot(weights)  # power spectral density
+
+
+def dfa_fluctuations(IBI, scales):
+    """fluctuation function F(n) of the detrended fluctuation analysis for the box sizes n in scales (NaN where the series is too short)
+    the boxes do not overlap and are laid from both ends of the series, the integrated series is detrended linearly in each box.
+    all box sizes use the same cumulative sums (of y, y**2 and i*y, y: integrated series, i: index), so the residual of the fit in a box
+    takes a few operations whatever its size, and all boxes of all sizes are done at once.
+    IBI can also be a 2-D array with one series per row (all of the same length), then F has one row per series"""
+    x = np.asarray(IBI, dtype=float)
+    rows = np.atleast_2d(x)
+    N = rows.shape[1]
+    scales = np.asarray(scales, dtype=int)
+    F = np.full((len(rows), len(scales)), np.nan)
+    num = N // scales   # boxes from each end
+    use = np.flatnonzero(num >= CFG_dfa_min_boxes)
+    if len(use) == 0: return F if x.ndim == 2 else F[0]
+
+    y = np.cumsum(rows - rows.mean(axis=1, keepdims=True), axis=1)
+    sums = np.zeros((3, len(rows), N+1))
+    np.cumsum(y, axis=1, out=sums[0,:,1:])
+    np.cumsum(y*y, axis=1, out=sums[1,:,1:])
+    np.cumsum(np.arange(N)*y, axis=1, out=sums[2,:,1:])
+
+    first = np.cumsum(num[use]) - num[use]   # first box of every box size
+    k = np.arange(num[use].sum()) - np.repeat(first, num[use])   # number of the box
+    n = np.repeat(scales[use], num[use])
+    starts = np.concatenate([k*n, N - (k+1)*n])
+    n = np.tile(n, 2).astype(float)
+    Sy, Syy, Siy = sums[:,:,starts + n.astype(int)] - sums[:,:,starts]
+    Sky = Siy - (starts + (n-1)/2) * Sy   # with the index centred in the box, the fit of the offset and the slope are independent
+    rss = np.maximum(Syy - Sy*Sy/n - Sky*Sky/(n*(n*n-1)/12), 0)
+    rss = rss[:,:len(k)] + rss[:,len(k):]   # boxes from the start and from the end
+    F[:,use] = np.sqrt(np.add.reduceat(rss, first, axis=1) / (2*num[use]*scales[use]))
+    return F if x.ndim == 2 else F[0]
+
+
+def dfa_alpha(IBI):
+    """short-term (box sizes CFG_dfa_short) and long-term (CFG_dfa_long) scaling exponents of the detrended fluctuation analysis,
+    the slopes of log F(n) over log n (NaN if less than two box sizes can be used).
+    IBI can also be a 2-D array with one series per row (all of the same length), then the exponents are arrays"""
+    scales = np.arange(min(CFG_dfa_short[0], CFG_dfa_long[0]), max(CFG_dfa_short[1], CFG_dfa_long[1]) + 1)
+    logn = np.log(scales)
+    alphas = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logF = np.log(dfa_fluctuations(IBI, scales))
+        for n_min, n_max in (CFG_dfa_short, CFG_dfa_long):
+            sel = (scales >= n_min) & (scales <= n_max) & np.isfinite(logF)
+            count = np.count_nonzero(sel, axis=-1)
+            dx = np.where(sel, logn - np.sum(sel*logn, axis=-1, keepdims=True) / count[...,None], 0)  # least squares slope of every row
+            slope = np.sum(dx * np.where(sel, logF, 0), axis=-1) / np.sum(dx*dx, axis=-1)
+            alphas.append(np.where(count >= 2, slope, np.nan)[()])
+    return alphas
 
 
 class HRVdescriptors():
-    def power(self,spec,freq,fmin,fmax):
-        band = [spec[i] for i in range(len(spec)) if freq[i] >= fmin and freq[i]<fmax]
-        powerinband = np.sum(band)/(2*len(spec)**2)
-        return powerinband
+    def band_powers(self, IBI):
+        """powers (ms2) in the bands of CFG_bands (in this order) of a series of inter-beat-intervals, with the method of CFG_spectrum"""
+        if CFG_spectrum == 'lombscargle': return lomb_band_powers(IBI)
+        x = resample(IBI)
+        if len(x) < 2: return np.full(len(CFG_bands), np.nan)
+        return welch_band_powers(x)[0]
 
 
-    def calculate(self, IBI):
+    def calculate(self, IBI, nonlinear=False):
         """ calculates HRV descriptors from an array of inter-beat-intervals (in ms)
         returns a dictionary with:
-            VLF:    power of very low frequency components
-            LF:     power of low frequency components
-            HF:     power of high frequency components
+            VLF:    power of very low frequency components (ms2)
+            LF:     power of low frequency components (ms2)
+            HF:     power of high frequency components (ms2)
             LFHF:   ratio of LF to HF
-            Power:  total power
+            Power:  total power (up to the end of the HF band, ms2)
             HRMean: heart rate mean
             HRSTD:  heart rate standard devaiation
             pNN50
             rMSSD
-            ApEn
-            FracDim
+            SD1:    standard deviation of the Poincare plot across the identity line (short-term variability, ms)
+            SD2:    standard deviation of the Poincare plot along the identity line (long-term variability, ms)
+            DFA1:   short-term scaling exponent of the detrended fluctuation analysis (alpha1)
+            DFA2:   long-term scaling exponent of the detrended fluctuation analysis (alpha2, only the box sizes that fit CFG_dfa_min_boxes times are used, NaN for short series)
+            ApEn:   approximate entropy (only if nonlinear is True, from the whole series, O(N^2))
+            FracDim: fractal dimension (only if nonlinear is True, from the whole series, O(N^2))
         """
         
         if len(IBI)<2: return False
         
         result = {}
         
-        time_axis = np.cumsum(IBI)-IBI[0]  # time in ms, starts at 0
+        IBI = np.asarray(IBI, dtype=float)
         HR = 60.0 / (IBI / 1000)
-        
-        step=1.0/CFG_interpolate_freq
-        time_axis_interp = np.arange(time_axis[0],time_axis[-1],step)
 
-        interp_IBI = interpolate.interp1d(time_axis, IBI)
-        interp_HR = interpolate.interp1d(time_axis, HR)
-        IBI_interp = interp_IBI(time_axis_interp)
-        HR_interp = interp_HR(time_axis_interp)
-
-        #spec_tmp = np.absolute(np.fft.fft(IBI_interp))**2
-        spec_tmp = np.absolute(np.fft.fft(IBI))**2
-        spec = spec_tmp[0:(len(spec_tmp)/2)] # Only positive half of spectrum
-
-        freqs = np.linspace(start=0,stop=CFG_interpolate_freq/2,num=len(spec),endpoint=True)
-
-        result['VLF'] = self.power(spec,freqs,CFG_vlfmin,CFG_vlfmax)
-        result['LF'] = self.power(spec,freqs,CFG_lfmin,CFG_lfmax)
-        result['HF'] = self.power(spec,freqs,CFG_hfmin,CFG_hfmax)
-        result['Power'] = self.power(spec,freqs,0,CFG_interpolate_freq/2.0)
+        for k, p in zip(CFG_bands, self.band_powers(IBI)):
+            result[k] = p
 
         #print("ULF+VLF+LF+HF power: "+str(ulfpower+vlfpower+lfpower+hfpower))
         result['LFHF'] = result['LF']/result['HF']
@@ -86,58 +212,143 @@ class HRVdescriptors():
         #frameRR = 1000.0*np.diff(BeatsFrame)   # that is our IBI  / Alex
             
         RRDiffs = np.diff(IBI)
-        RRDiffs50 = [x for x in np.abs(RRDiffs) if x>50]
-        result["pNN50"] = 100.0*len(RRDiffs50)/len(RRDiffs)
+        result["pNN50"] = 100.0*np.count_nonzero(np.abs(RRDiffs)>50)/len(RRDiffs)
         result["rMSSD"] = np.sqrt(np.mean(RRDiffs**2))
 
-        if False:  # non-linear stuff does not work yet, let's deal with it later / Alex
-            BeatsFrame = time_axis / 1000  # I think that should be the BeatsFrame / Alex
-            ApEn, FracDim = self.CalculateNonLinearAnalysis(BeatsFrame)
+        # Poincare plot (each IBI against the next one)
+        SDSD2 = np.var(RRDiffs, ddof=1) if len(RRDiffs) > 1 else np.nan
+        result['SD1'] = np.sqrt(SDSD2 / 2)
+        result['SD2'] = np.sqrt(np.maximum(2*np.var(IBI, ddof=1) - SDSD2/2, 0))
+
+        result['DFA1'], result['DFA2'] = dfa_alpha(IBI)
+
+        if nonlinear:
+            ApEn, FracDim = self.CalculateNonLinearAnalysis(IBI)  # calculated from the inter-beat-intervals (the beat times are not stationary)
             result["ApEn"] = ApEn
             result["FracDim"] = FracDim
         return result
         
         
-    def CalculateNonLinearAnalysis(self,Data=None, N=1000):
+    def calculate_batch(self, IBIs, lengths=None, nonlinear=False):
+        """ calculates HRV descriptors for many series of inter-beat-intervals (in ms) at once
+        IBIs is either a list of (ragged) 1-D arrays, or a padded 2-D array (one series per row) together with the lengths of the series
+        returns a dictionary with the same descriptors as calculate(), each one a numpy array with one entry per series
+        (NaN for series with less than 2 beats)
+        the spectra (Welch) of all series that fill at least one segment (CFG_welch_segment) are calculated in one FFT call,
+        whatever their lengths, the shorter ones in one FFT call per resampled length (a segment is the whole series there).
+        the DFA is calculated in one go for all series of the same length (up to CFG_dfa_chunk beats), series of different lengths
+        take one call each,
+        the non-linear descriptors (only if nonlinear is True) are still calculated series by series and use the whole series, as in calculate()
+        """
+
+        if lengths is None:
+            lengths = np.array([len(x) for x in IBIs], dtype=int)
+            IBI = np.full((len(lengths), max(lengths.max(initial=0), 1)), np.nan)
+            if lengths.sum() > 0:
+                rows = np.repeat(np.arange(len(lengths)), lengths)
+                cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths)-lengths, lengths)
+                IBI[rows, cols] = np.concatenate([np.asarray(x, dtype=float) for x in IBIs])
+        else:
+            lengths = np.asarray(lengths, dtype=int)
+            IBI = np.array(IBIs, dtype=float)  # copy, so we can overwrite the padding
+            IBI[np.arange(IBI.shape[1]) >= lengths[:,None]] = np.nan
+
+        num = len(lengths)
+        valid = lengths >= 2
+        result = {}
+        for k in list(CFG_bands) + ['LFHF', 'HRMean', 'HRSTD', 'pNN50', 'rMSSD', 'SD1', 'SD2', 'DFA1', 'DFA2'] + (['ApEn', 'FracDim'] if nonlinear else []):
+            result[k] = np.full(num, np.nan)
+        if not valid.any(): return result
+
+        # frequency domain
+        rows = np.flatnonzero(valid)
+        if CFG_spectrum == 'lombscargle':
+            powers = np.array([lomb_band_powers(IBI[i,:lengths[i]]) for i in rows])
+            for j, k in enumerate(CFG_bands):
+                result[k][rows] = powers[:,j]
+        else:
+            series = [resample(IBI[i,:lengths[i]]) for i in rows]
+            n_resampled = np.array([len(x) for x in series])
+            group = np.flatnonzero(n_resampled >= CFG_welch_segment)
+            if len(group):   # same segment length, one FFT call for all
+                powers = welch_band_powers_ragged([series[g] for g in group])
+                for j, k in enumerate(CFG_bands):
+                    result[k][rows[group]] = powers[:,j]
+            for n in np.unique(n_resampled[(n_resampled >= 2) & (n_resampled < CFG_welch_segment)]):  # one FFT call per resampled length
+                group = np.flatnonzero(n_resampled == n)
+                powers = welch_band_powers(np.array([series[g] for g in group]))
+                for j, k in enumerate(CFG_bands):
+                    result[k][rows[group]] = powers[:,j]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['LFHF'] = result['LF']/result['HF']
+
+        # time domain
+        IBI = IBI[valid]
+        n = lengths[valid]
+        HR = 60.0 / (IBI / 1000)
+        result['HRMean'][valid] = np.nanmean(HR, axis=1)
+        result['HRSTD'][valid] = np.sqrt(np.nansum((HR - result['HRMean'][valid,None])**2, axis=1) / (n-1))
+
+        RRDiffs = np.diff(IBI, axis=1)  # NaN beyond the end of each series
+        result['pNN50'][valid] = 100.0*np.count_nonzero(np.abs(np.nan_to_num(RRDiffs))>50, axis=1)/(n-1)
+        result['rMSSD'][valid] = np.sqrt(np.nansum(RRDiffs**2, axis=1)/(n-1))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            SDSD2 = np.nansum((RRDiffs - np.nansum(RRDiffs, axis=1, keepdims=True)/(n[:,None]-1))**2, axis=1) / (n-2)
+            SDSD2[n < 3] = np.nan
+            IBIvar = np.nansum((IBI - np.nanmean(IBI, axis=1, keepdims=True))**2, axis=1) / (n-1)
+        result['SD1'][valid] = np.sqrt(SDSD2 / 2)
+        result['SD2'][valid] = np.sqrt(np.maximum(2*IBIvar - SDSD2/2, 0))
+        for length in np.unique(n):
+            group = np.flatnonzero(n == length)
+            step = max(CFG_dfa_chunk // length, 1)
+            for block in (group[i:i+step] for i in range(0, len(group), step)):
+                result['DFA1'][rows[block]], result['DFA2'][rows[block]] = dfa_alpha(IBI[block,:length])
+
+        if nonlinear:
+            for i, row in zip(np.flatnonzero(valid), IBI):
+                result['ApEn'][i], result['FracDim'][i] = self.CalculateNonLinearAnalysis(row[:lengths[i]])
+
+        return result
 
-        def BuildTakensVector(Data,m,tau):
-            # DataInt = range(1001)
-            N = len(Data)
-            jump = tau
-            maxjump=(m-1)*jump
-            jumpsvect=range(0,maxjump+1,jump)
-            # print("jumpsvect: "+str(jumpsvect))
-            numjumps=len(jumpsvect)
-            numelem=N-maxjump
-            # print("Building matrix "+str(numelem)+"x"+str(numjumps))
-            DataExp = np.zeros(shape=(numelem,numjumps))
-            for i in range(numelem):
-                for j in range(numjumps):
-                    DataExp[i,j]=Data[jumpsvect[j]+i]
-
-            # print("DataExp first row: "+str(DataExp[0]))
-            # print("DataExp last row: "+str(DataExp[-1]))
 
+    def CalculateNonLinearAnalysis(self,Data=None, N=None):
+        """calculates approximate entropy and fractal dimension of Data
+        memory stays bounded (roughly CFG_nonlinear_chunk distances at once), so there is no need to crop long recordings,
+        N can still be given to only use the centered N points"""
+
+        def BuildTakensVector(Data,m,tau):
+            # zero-copy view: row i is Data[i], Data[i+tau], ..., Data[i+(m-1)*tau]
+            maxjump=(m-1)*tau
+            DataExp = np.lib.stride_tricks.sliding_window_view(Data, maxjump+1)[:,::tau]
             return DataExp
             # --------------------
 
 
+        def PairDistances(DataExp):
+            # yields the chebyshev distances of all pairs of rows (i<j), in chunks of about CFG_nonlinear_chunk values
+            numelem=DataExp.shape[0]
+            numrows=max(1, CFG_nonlinear_chunk//numelem)
+            for start in range(0, numelem-1, numrows):
+                stop=min(start+numrows, numelem-1)
+                d=np.abs(DataExp[start:stop,0,None]-DataExp[None,start+1:,0])
+                for j in range(1, DataExp.shape[1]):
+                    np.maximum(d, np.abs(DataExp[start:stop,j,None]-DataExp[None,start+1:,j]), out=d)
+                yield d[np.arange(numelem-start-1)[None,:] >= np.arange(stop-start)[:,None]]  # upper triangle only
+            # --------------------
+
+
         def AvgIntegralCorrelation(Data,m,tau,r):
 
-            from scipy.spatial.distance import cdist
+            from scipy.spatial import cKDTree
 
             DataExp = BuildTakensVector(Data, m, tau)
             numelem=DataExp.shape[0]
             # print("Number of rows: "+str(numelem))
-            mutualDistance=cdist(DataExp,DataExp,'chebyshev')
-
-            Cmr=np.zeros(numelem)
 
-            for i in range(numelem):
-                vector=mutualDistance[i]
-                Cmr[i]=float((vector <=r).sum())/numelem
+            # number of neighbours (including the point itself) within r, without building the full distance matrix
+            Cmr=cKDTree(DataExp).query_ball_point(DataExp, r, p=np.inf, return_length=True)/float(numelem)
 
-            print(Cmr)
             Phi=(np.log(Cmr)).sum()/len(Cmr)
 
             # if self.data["Verbose"]:
@@ -151,6 +362,7 @@ class HRVdescriptors():
 
         def CalculateApEn(Data,m=2,tau=1,r=0.2):
 
+            if len(Data) < m+2: return np.nan
             r=r*np.std(Data,ddof=1)
             # print("r: "+str(r))
             Phi1 = AvgIntegralCorrelation(Data,m,tau,r)
@@ -161,24 +373,49 @@ class HRVdescriptors():
 
         def CalculateFracDim(Data, m=10, tau=3, Cra=0.005, Crb=0.75):
 
-            from scipy.spatial.distance import pdist
-            from scipy.stats.mstats import mquantiles
+            if len(Data) < (m-1)*tau+3: return np.nan
 
             DataExp=BuildTakensVector(Data,m,tau)
             # print("Number of rows: "+str(DataExp.shape[0]))
             # print("Number of columns: "+str(DataExp.shape[1]))
 
-            mutualDistance=pdist(DataExp,'chebyshev')
-
-            numelem=len(mutualDistance)
+            numelem=DataExp.shape[0]*(DataExp.shape[0]-1)//2
             # print("numelem: "+str(numelem))
-            
-            rr=mquantiles(mutualDistance,prob=[Cra,Crb])
-            ra=rr[0]
-            rb=rr[1]
 
-            Cmra= float(((mutualDistance <= ra).sum()))/numelem
-            Cmrb= float(((mutualDistance <= rb).sum()))/numelem
+            # the quantiles (same definition as scipy.stats.mstats.mquantiles) are found in two passes over the distances:
+            # a histogram locates the bins of the needed order statistics, then only the values in these bins are kept
+            dmax=np.ptp(Data)
+            scale=CFG_nonlinear_bins/dmax if dmax>0 else 0.0
+            def binof(d): return np.minimum((d*scale).astype(int), CFG_nonlinear_bins-1)
+
+            counts=np.zeros(CFG_nonlinear_bins, dtype=np.int64)
+            for d in PairDistances(DataExp):
+                counts+=np.bincount(binof(d), minlength=CFG_nonlinear_bins)
+            cum_before=np.cumsum(counts)-counts
+
+            p=np.array([Cra,Crb])
+            aleph=numelem*p+0.4+0.2*p
+            k=np.floor(aleph.clip(1, numelem-1)).astype(int)
+            gamma=(aleph-k).clip(0,1)
+            ranks=np.concatenate([k-1, k])
+            bins=np.searchsorted(np.cumsum(counts), ranks, side='right')
+
+            inbin={b: [] for b in np.unique(bins)}
+            for d in PairDistances(DataExp):
+                b=binof(d)
+                for key in inbin:
+                    inbin[key].append(d[b==key])
+            inbin={key: np.sort(np.concatenate(v)) for key, v in inbin.items()}
+
+            x=np.array([inbin[b][rank-cum_before[b]] for rank, b in zip(ranks, bins)])
+            ra, rb=(1.-gamma)*x[:2]+gamma*x[2:]
+
+            def countbelow(r):
+                b=binof(np.array([r]))[0]
+                return cum_before[b] + (np.searchsorted(inbin[b], r, side='right') if b in inbin else counts[b])
+
+            Cmra= float(countbelow(ra))/numelem
+            Cmrb= float(countbelow(rb))/numelem
 
             # if self.data["Verbose"]:
             #     print("      ra: "+str(ra))
@@ -186,7 +423,8 @@ class HRVdescriptors():
             #     print("      Cmra: "+str(100.0*Cmra)+"%")
             #     print("      Cmrb: "+str(100.0*Cmrb)+"%")
 
-            FracDim = (np.log(Cmrb)-np.log(Cmra))/(np.log(rb)-np.log(ra))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                FracDim = (np.log(Cmrb)-np.log(Cmra))/(np.log(rb)-np.log(ra))
 
             return FracDim
             # --------------------
@@ -195,11 +433,13 @@ class HRVdescriptors():
         # if self.data["Verbose"]:
         #     print("** Calculating non-linear parameters")
 
+        Data=np.asarray(Data, dtype=float)
         npoints=len(Data)
 
         # print ("Number of points: "+str(npoints))
-        if npoints > N:
-            DataInt=Data[(npoints/2-N/2)-1:(npoints/2+N/2)]
+        if N is not None and npoints > N:
+            start=(npoints-N)//2
+            DataInt=Data[start:start+N]
         else:
             DataInt=Data
 
@@ -221,4 +461,162 @@ class HRVdescriptors():
 
         return ApEn,FracDim
         
-                        
\ No newline at end of file
+                        
+
+class HRVstream():
+    """incremental time-domain HRV descriptors, updated one inter-beat-interval (in ms) at a time
+
+    keeps running sums (Welford for the heart rate variance) so that every added beat costs O(1),
+    independent of the length of the session. the results match HRVdescriptors.calculate() on the same data.
+    optionally only a sliding window is considered: the last window_beats beats and/or the last window_ms milliseconds.
+    """
+    def __init__(self, window_beats=None, window_ms=None):
+        self.window_beats = window_beats
+        self.window_ms = window_ms
+        self.reset()
+
+
+    def reset(self):
+        self.count = 0         # number of beats in the current window
+        self.count_total = 0   # number of beats seen since start
+        self.HR_mean = 0.0     # running mean of the heart rate (Welford)
+        self.HR_M2 = 0.0       # running sum of squared deviations of the heart rate (Welford)
+        self.diff_sq_sum = 0.0 # sum of squared successive IBI differences
+        self.nn50 = 0          # number of successive differences > 50 ms
+        self.time_ms = 0.0     # sum of IBIs in the window
+        self.IBI_window = collections.deque()  # only filled in sliding window mode
+        self.IBI_last = None
+
+
+    def _add_diff(self, d, sign):
+        self.diff_sq_sum += sign * d * d
+        if abs(d) > 50: self.nn50 += sign
+
+
+    def add(self, IBI):
+        """adds one inter-beat-interval (in ms)"""
+        IBI = float(IBI)
+        HR = 60000.0 / IBI
+
+        self.count += 1
+        self.count_total += 1
+        delta = HR - self.HR_mean
+        self.HR_mean += delta / self.count
+        self.HR_M2 += delta * (HR - self.HR_mean)
+        if self.IBI_last is not None:
+            self._add_diff(IBI - self.IBI_last, 1)
+        self.IBI_last = IBI
+        self.time_ms += IBI
+
+        if self.window_beats is None and self.window_ms is None: return
+
+        self.IBI_window.append(IBI)
+        while self.count > 1 and ((self.window_beats is not None and self.count > self.window_beats) or (self.window_ms is not None and self.time_ms > self.window_ms)):
+            self._remove_oldest()
+
+
+    def _remove_oldest(self):
+        IBI = self.IBI_window.popleft()
+        HR = 60000.0 / IBI
+        self._add_diff(self.IBI_window[0] - IBI, -1)
+        self.time_ms -= IBI
+
+        self.count -= 1
+        delta = HR - self.HR_mean
+        self.HR_mean -= delta / self.count
+        self.HR_M2 -= delta * (HR - self.HR_mean)
+        if self.count == 1:
+            self.HR_M2 = 0.0
+            self.diff_sq_sum = 0.0   # get rid of accumulated rounding errors
+
+
+    def extend(self, IBIs):
+        """adds several inter-beat-intervals (in ms)"""
+        for IBI in IBIs:
+            self.add(IBI)
+
+
+    def calculate(self):
+        """returns a dictionary with HRMean, HRSTD, rMSSD and pNN50 (same definitions as HRVdescriptors.calculate),
+        returns False if there are less than 2 beats in the window"""
+        if self.count < 2: return False
+
+        result = {}
+        result['HRMean'] = self.HR_mean
+        result['HRSTD'] = np.sqrt(max(self.HR_M2, 0.0) / (self.count - 1))
+        result['pNN50'] = 100.0 * self.nn50 / (self.count - 1)
+        result['rMSSD'] = np.sqrt(max(self.diff_sq_sum, 0.0) / (self.count - 1))
+        return result
+
+
+class HRVspectrogram():
+    """band powers over a sliding window, updated as the beats arrive (Welch's method on the resampled inter-beat-intervals)
+
+    the resampled series is extended with every beat (the linear interpolation only needs the previous beat). every hop samples
+    the spectrum of the newest segment is calculated, the band powers are the mean over the last num_segments segments.
+    so every beat costs the same, independent of the length of the session. results holds (time in s, band powers) of every step,
+    the same as welch_band_powers(x, segment, hop) on the samples of the last num_segments segments.
+    """
+    def __init__(self, segment=CFG_welch_segment, hop=CFG_sliding_hop, num_segments=CFG_sliding_segments, freq=CFG_interpolate_freq):
+        self.segment = segment
+        self.hop = hop
+        self.num_segments = num_segments
+        self.freq = freq
+        self.reset()
+
+
+    def reset(self):
+        self.time = 0.0         # time of the last beat (s)
+        self.time_first = None  # time of the first beat, the first sample
+        self.IBI_last = None
+        self.num_samples = 0    # number of resampled samples
+        self.samples = collections.deque(maxlen=self.segment)  # the newest resampled samples
+        self.powers = collections.deque(maxlen=self.num_segments)  # band powers of the newest segments
+        self.results = []
+
+
+    def add(self, IBI):
+        """adds one inter-beat-interval (in ms), returns the new results (a list of (time, band powers))"""
+        IBI = float(IBI)
+        t = self.time + IBI / 1000.0
+        new = []
+        if self.IBI_last is None:
+            self.time_first = t
+        else:
+            k = np.arange(self.num_samples, int(np.ceil((t - self.time_first) * self.freq)))
+            ts = self.time_first + k / self.freq
+            k = k[ts < t]  # same samples as resample()
+            ts = ts[:len(k)]
+            values = self.IBI_last + (ts - self.time) / (t - self.time) * (IBI - self.IBI_last)
+            for ts_i, v in zip(ts.tolist(), values.tolist()):
+                self.samples.append(v)
+                self.num_samples += 1
+                if self.num_samples >= self.segment and (self.num_samples - self.segment) % self.hop == 0:
+                    new.append((ts_i, self._step()))
+        self.time = t
+        self.IBI_last = IBI
+        self.results.extend(new)
+        return new
+
+
+    def _step(self):
+        window, weights = welch_plan(self.segment, self.freq)
+        x = np.array(self.samples)
+        self.powers.append((np.abs(np.fft.rfft((x - x.mean()) * window))**2).dot(weights))
+        powers = np.mean(self.powers, axis=0)
+        result = dict(zip(CFG_bands, powers.tolist()))
+        result['LFHF'] = result['LF'] / result['HF'] if result['HF'] > 0 else np.nan
+        return result
+
+
+    def extend(self, IBIs):
+        """adds several inter-beat-intervals (in ms), returns the new results"""
+        new = []
+        for IBI in IBIs:
+            new.extend(self.add(IBI))
+        return new
+
+
+    def calculate(self):
+        """returns the newest band powers (dictionary with VLF, LF, HF, Power and LFHF), False if there are none yet"""
+        return self.results[-1][1] if self.results else False
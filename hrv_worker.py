@@ -0,0 +1,102 @@
+####
+# calculation of the HRV descriptors in a worker process
+#
+# the inter-beat-intervals are written to a ring buffer in shared memory, a request only says up to which beat and
+# over how many beats the descriptors should be calculated. requests that arrive while the worker is busy replace
+# each other (only the latest one is calculated), the results come back through a queue. so the GUI never waits
+# and never competes for the GIL with the calculation.
+#
+####
+
+CFG_capacity = 65536   # beats in the shared ring buffer (the window of a calculation is limited to this minus CFG_margin)
+CFG_margin = 1024      # beats that can be added while the worker copies a window
+
+
+import numpy as np
+import multiprocessing
+import multiprocessing.shared_memory
+import queue
+import sys
+
+import hrv_analysis
+
+
+def run_worker(shm_name, capacity, request, wakeup, results, nonlinear):
+    """main loop of the worker process: waits for a request, calculates the descriptors of the latest one, puts (id, result) into results
+    (the result is False if the calculation failed, the worker goes on with the next request)"""
+    shm = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+    IBI = np.ndarray((capacity,), dtype=np.float64, buffer=shm.buf)
+    hrv = hrv_analysis.HRVdescriptors()
+    while True:
+        wakeup.wait()
+        with request.get_lock():
+            wakeup.clear()
+            request_id, num, window = request[:]
+        if request_id < 0: break  # stop
+        try:
+            idx = np.arange(num - window, num) % capacity
+            r = hrv.calculate(IBI[idx], nonlinear=nonlinear)  # fancy indexing copies the window
+        except Exception as e:
+            print("error calculating the HRV descriptors: %r" % e, file=sys.stderr)
+            r = False
+        results.put((request_id, r))
+    del IBI
+    shm.close()
+
+
+class HRVworker():
+    """worker process for the HRV descriptors, add() the inter-beat-intervals, request() calculations, poll() the results"""
+
+    def __init__(self, capacity=CFG_capacity, nonlinear=True):
+        self.capacity = capacity
+        self.count = 0        # number of added beats
+        self.request_id = 0   # id of the latest request
+        self.shm = multiprocessing.shared_memory.SharedMemory(create=True, size=capacity * 8)
+        self.IBI = np.ndarray((capacity,), dtype=np.float64, buffer=self.shm.buf)
+        self.latest = multiprocessing.Array('q', 3)   # id, number of beats, window
+        self.wakeup = multiprocessing.Event()
+        self.results = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=run_worker, args=(self.shm.name, capacity, self.latest, self.wakeup, self.results, nonlinear), daemon=True)
+        self.process.start()
+
+
+    def add(self, IBI):
+        """adds an inter-beat-interval (in ms)"""
+        self.IBI[self.count % self.capacity] = IBI
+        self.count += 1
+
+
+    def request(self, window=None):
+        """requests the descriptors of the last window beats (None: all), returns the id of the request"""
+        window = self.count if window is None else min(window, self.count)
+        window = min(window, self.capacity - CFG_margin)
+        self.request_id += 1
+        with self.latest.get_lock():
+            self.latest[:] = [self.request_id, self.count, window]
+            self.wakeup.set()
+        return self.request_id
+
+
+    def poll(self):
+        """returns the finished results as a list of (id, result), does not block"""
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+
+    def close(self):
+        """stops the worker process and frees the shared memory"""
+        if self.shm is None: return
+        if self.process.is_alive():
+            with self.latest.get_lock():
+                self.latest[0] = -1
+                self.wakeup.set()
+            self.process.join(timeout=5)
+            if self.process.is_alive(): self.process.terminate()
+        del self.IBI
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
@@ -0,0 +1,133 @@
+####
+# timing instrumentation
+#
+# durations (and other values, e.g. the backlog of the serial port) are collected in histograms with fixed, logarithmic bins,
+# so the memory stays bounded. counters count events (e.g. skipped frames).
+# everything goes to the module-wide store `timings`, which is disabled by default. when disabled the hooks return immediately:
+#
+#   t = instrument.timings.now()         # 0 when disabled
+#   ...
+#   t = instrument.timings.lap('parse', t)  # records the time since t as 'parse', returns the current time
+#
+####
+
+CFG_bins_per_decade = 20    # resolution of the histograms (about 12% per bin)
+CFG_min_value = 1e-7        # values below this go to the first bin
+CFG_max_value = 1e7         # values above this go to the last bin
+
+
+import numpy as np
+import json
+import math
+import time
+
+
+class Histogram():
+    """histogram with logarithmic bins, with count, sum, min and max"""
+
+    num_bins = int(round(math.log10(CFG_max_value / CFG_min_value) * CFG_bins_per_decade)) + 1
+    edges = CFG_min_value * 10**(np.arange(num_bins + 1) / CFG_bins_per_decade)  # upper edge of bin i: edges[i+1]
+
+    def __init__(self, unit='s'):
+        self.unit = unit
+        self.counts = np.zeros(self.num_bins, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+
+    def add(self, value):
+        if value > CFG_min_value:
+            i = min(int(math.log10(value / CFG_min_value) * CFG_bins_per_decade), self.num_bins - 1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min: self.min = value
+        if value > self.max: self.max = value
+
+
+    def percentile(self, q):
+        """approximate percentile (upper edge of the bin, limited by the maximum), q in 0..100"""
+        if self.count == 0: return math.nan
+        i = int(np.searchsorted(np.cumsum(self.counts), q / 100.0 * self.count))
+        return min(self.edges[min(i, self.num_bins - 1) + 1], self.max)
+
+
+    def to_dict(self):
+        nonzero = np.flatnonzero(self.counts)
+        return {'unit': self.unit, 'count': self.count, 'mean': self.sum / self.count if self.count else None, 'min': self.min if self.count else None, 'max': self.max if self.count else None,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'bins': {'%.3g' % self.edges[i+1]: int(self.counts[i]) for i in nonzero}}
+
+
+class Timings():
+    """store of the histograms and counters, the hooks do nothing as long as enabled is False"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.time_start = time.time()
+
+
+    def now(self):
+        """current time (perf_counter) or 0 if disabled"""
+        return time.perf_counter() if self.enabled else 0
+
+
+    def lap(self, name, t):
+        """records the time since t (from now() or lap()) as name, returns the current time"""
+        if not self.enabled: return 0
+        now = time.perf_counter()
+        self.add(name, now - t)
+        return now
+
+
+    def add(self, name, value, unit='s'):
+        """records a value (by default a duration in seconds)"""
+        if not self.enabled: return
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram(unit)
+        h.add(value)
+
+
+    def count(self, name, n=1):
+        """increases a counter"""
+        if not self.enabled: return
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def reset(self):
+        self.histograms = {}
+        self.counters = {}
+        self.time_start = time.time()
+
+
+    def to_dict(self):
+        return {'duration': time.time() - self.time_start, 'histograms': {k: h.to_dict() for k, h in self.histograms.items()}, 'counters': dict(self.counters)}
+
+
+    def dump(self, filename):
+        """writes the histograms and counters as JSON"""
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        print("Written timings to file: %s" % filename)
+
+
+    def summary(self, names=None):
+        """one line per histogram with p50/p99/max (durations in ms), and the counters"""
+        lines = []
+        for name in (self.histograms if names is None else names):
+            h = self.histograms.get(name)
+            if h is None or h.count == 0: continue
+            scale, unit = (1000.0, 'ms') if h.unit == 's' else (1, h.unit)
+            lines.append('%-10s p50 %7.2f  p99 %7.2f  max %7.2f %s' % (name, h.percentile(50)*scale, h.percentile(99)*scale, h.max*scale, unit))
+        lines += ['%-10s %d' % (k, v) for k, v in self.counters.items()]
+        return '\n'.join(lines)
+
+
+timings = Timings()   # the store used by all modules
@@ -0,0 +1,282 @@
+####
+#
+# headless acquisition from several arduinos (serial ports) at once, in one process
+#
+# all ports are read by one loop (a selector on the file descriptors of the ports, or polling where this is not
+# possible, e.g. on Windows). each device has its own parser, sample store and HRV analysis (see pipeline.py),
+# the HRV descriptors are calculated in a pool of processes, so they are spread across the cores. each device has at most
+# one calculation in flight, updates that come in meanwhile are coalesced into one calculation of the newest window.
+# at the end the throughput and the latencies of each device are reported.
+#
+# examples:
+#   python multidevice.py --port COM3 --port COM4 --json
+#   python multidevice.py --port /dev/ttyACM0 --port /dev/ttyACM1 --binary --duration 600
+#
+####
+
+
+# config
+
+CFG_baudrate = 115200
+CFG_workers = None          # processes for the HRV calculation (None: number of cores)
+CFG_poll_interval = 0.005   # seconds between two polls of the ports (if they cannot be used with a selector)
+CFG_select_timeout = 0.1    # seconds
+
+
+import numpy as np
+import argparse
+import concurrent.futures
+import os
+import queue
+import selectors
+import sys
+import time
+
+import hrv_analysis
+import instrument
+import pipeline
+import protocol
+import sample_store
+
+
+def calculate_descriptors(IBI, nonlinear=True):
+    """HRV descriptors of IBI (runs in a worker process)"""
+    return hrv_analysis.HRVdescriptors().calculate(IBI, nonlinear=nonlinear)
+
+
+class ParallelAnalysis(pipeline.Analysis):
+    """like pipeline.Analysis, but the descriptors are calculated by an executor (calculate returns a future)
+    only one calculation is in flight: while it runs, calculate returns None, call done() when it has finished"""
+
+    def __init__(self, executor, **kwargs):
+        pipeline.Analysis.__init__(self, **kwargs)
+        self.executor = executor
+        self.future = None   # the calculation in flight
+
+
+    def calculate(self):
+        if self.future is not None: return None
+        IBI = np.array(self.IBI.values()[self.IBI.count-self.stream.count:], dtype=float)
+        r_stream = self.stream.calculate()
+        self.future = self.executor.submit(calculate_descriptors, IBI, self.nonlinear)
+        self.future.r_stream = r_stream  # the time-domain descriptors are taken from the incremental calculation
+        return self.future
+
+
+    def done(self):
+        self.future = None
+
+
+class Device():
+    """one arduino: serial port, parser, sample store, HRV analysis and sinks"""
+
+    def __init__(self, name, ser, executor, binary=False, sinks=None, store_directory=None):
+        self.name = name
+        self.ser = ser
+        self.parser = protocol.Parser(binary)
+        self.store = sample_store.SampleStore(np.int16, None if store_directory is None else os.path.join(store_directory, '%s_sensor' % name))
+        self.analysis = ParallelAnalysis(executor)
+        self.sinks = [] if sinks is None else sinks
+        self.time_start = None
+        self.latency = instrument.Histogram()      # from the arrival of a chunk until it is processed
+        self.hrv_latency = instrument.Histogram()  # from the arrival of a beat until its HRV descriptors are calculated
+        self.pending = None   # (time of the beat, arrival time) of the newest update that waits for the calculation in flight
+        self.failed = False   # no more calculations can be submitted (e.g. broken process pool), the device is removed
+
+
+    def fileno(self):
+        return self.ser.fileno()
+
+
+    def read(self):
+        """reads what is waiting (without blocking), returns the data"""
+        return self.ser.read(self.ser.in_waiting or 1)
+
+
+    def process(self, data, t, results):
+        """decodes a chunk (received at time t), the finished futures of the HRV descriptors are put into results"""
+        if self.time_start is None: self.time_start = t
+        syms, vals, times = self.parser.decode(data, t)
+        is_sensor = syms == ord('S')
+        self.store.append(vals[is_sensor], np.round((times[is_sensor] - self.time_start) * 1000))
+        for sink in self.sinks: sink.samples(syms, vals, times)
+        try:
+            updates = self.analysis.process(syms, vals, times)
+        except RuntimeError as e:   # BrokenProcessPool is one too
+            self._fail(e)
+            updates = []
+        for t_result, future in updates:
+            if future is None:   # a calculation is in flight, the newest window is calculated when it is done
+                self.pending = (t_result, t)
+            else:
+                self._watch(future, t_result, t, results)
+        self.latency.add(time.time() - t)
+
+
+    def _watch(self, future, t_result, t, results):
+        future.add_done_callback(lambda f: results.put((self, t_result, t, f)))
+
+
+    def _fail(self, e):
+        print("error submitting the HRV calculation of %s, the device is stopped: %s" % (self.name, e), file=sys.stderr)
+        self.failed = True
+        self.pending = None
+
+
+    def descriptors(self, t_result, t, future, results):
+        """passes finished HRV descriptors to the sinks, then submits the newest window if updates came in meanwhile"""
+        self.analysis.done()
+        self.hrv_latency.add(time.time() - t)
+        try:
+            r = future.result()
+        except Exception as e:   # e.g. a broken worker process
+            print("error calculating the HRV descriptors of %s: %s" % (self.name, e), file=sys.stderr)
+            r = False
+        if r and future.r_stream: r.update(future.r_stream)
+        for sink in self.sinks: sink.descriptors(t_result, r)
+        if self.pending is not None:
+            t_result, t = self.pending
+            self.pending = None
+            try:
+                future = self.analysis.calculate()
+            except RuntimeError as e:
+                self._fail(e)
+                return
+            self._watch(future, t_result, t, results)
+
+
+    def counters(self):
+        counters = {'samples': self.store.count, 'beats': self.analysis.IBI.count}
+        counters.update(self.parser.counters())
+        return counters
+
+
+    def close(self):
+        self.ser.close()
+        self.store.close()
+        for sink in self.sinks: sink.close()
+
+
+class MultiDevice():
+    """reads several devices in one loop"""
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.removed = []   # devices that failed
+        self.results = queue.Queue()  # finished HRV descriptors (from the threads of the executor)
+        self.running = False
+        try:
+            self.selector = selectors.DefaultSelector()
+            for dev in devices: self.selector.register(dev, selectors.EVENT_READ)
+        except (AttributeError, OSError, ValueError):  # no file descriptors (e.g. Windows), poll instead
+            self.selector = None
+
+
+    def _ready(self):
+        """returns the devices with waiting data"""
+        if self.selector is not None:
+            return [key.fileobj for key, events in self.selector.select(timeout=CFG_select_timeout)]
+        ready = [dev for dev in self.devices if dev.ser.in_waiting]
+        if not ready: time.sleep(CFG_poll_interval)
+        return ready
+
+
+    def run(self, duration=None):
+        """reads and processes the data until stop() is called or duration (in seconds) is over"""
+        self.running = True
+        self.time_start = time.time()
+        try:
+            while self.running and self.devices and (duration is None or time.time() - self.time_start < duration):
+                for dev in self._ready():
+                    try:
+                        data = dev.read()
+                    except (OSError, ValueError) as e:  # port closed or device unplugged
+                        print("error reading from %s: %s" % (dev.name, e), file=sys.stderr)
+                        self._remove(dev)
+                        continue
+                    if data: dev.process(data, time.time(), self.results)
+                    if dev.failed: self._remove(dev)
+                self._collect()
+        finally:
+            self.time_end = time.time()
+
+
+    def _collect(self):
+        while True:
+            try:
+                dev, t_result, t, future = self.results.get_nowait()
+            except queue.Empty:
+                return
+            dev.descriptors(t_result, t, future, self.results)
+            if dev.failed and dev in self.devices: self._remove(dev)
+
+
+    def finish(self):
+        """waits for the HRV calculations in flight (and the newest windows that wait for them)"""
+        while any(dev.analysis.future is not None for dev in self.devices + self.removed):
+            dev, t_result, t, future = self.results.get()
+            dev.descriptors(t_result, t, future, self.results)
+
+
+    def _remove(self, dev):
+        if self.selector is not None: self.selector.unregister(dev)
+        self.devices.remove(dev)
+        self.removed.append(dev)
+
+
+    def stop(self):
+        self.running = False
+
+
+    def report(self, devices):
+        """throughput and latencies of all devices (as text)"""
+        duration = max(self.time_end - self.time_start, 1e-9)
+        lines = []
+        total_bytes = total_samples = 0
+        for dev in devices:
+            c = dev.counters()
+            total_bytes += c['bytes_read']
+            total_samples += c['samples']
+            lines.append('%-12s %9d bytes %9d samples %6d beats %5d errors %5d lost frames  latency p50 %6.2f p99 %6.2f ms  HRV latency p50 %7.1f p99 %7.1f ms' % (
+                dev.name, c['bytes_read'], c['samples'], c['beats'], c['decode_errors'], c.get('lost_frames', 0),
+                dev.latency.percentile(50)*1000, dev.latency.percentile(99)*1000, dev.hrv_latency.percentile(50)*1000, dev.hrv_latency.percentile(99)*1000))
+        lines.append('%-12s %9.0f bytes/s %7.0f samples/s (%d devices, %.1f s)' % ('total', total_bytes / duration, total_samples / duration, len(devices), duration))
+        return '\n'.join(lines)
+
+
+# main() function
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='headless acquisition from several arduinos at once')
+    parser.add_argument('--port', action='append', required=True, help='serial port (give it once for every device)')
+    parser.add_argument('--baudrate', type=int, default=CFG_baudrate)
+    parser.add_argument('--binary', action='store_true', help='the arduinos send the binary protocol')
+    parser.add_argument('--json', action='store_true', help='write beats and HRV descriptors as JSON lines (with the device) to stdout')
+    parser.add_argument('--store', help='keep the sensor data in files in this directory')
+    parser.add_argument('--workers', type=int, default=CFG_workers, help='processes for the HRV calculation')
+    parser.add_argument('--duration', type=float, help='stop after so many seconds')
+    args = parser.parse_args(argv)
+
+    import serial
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+    devices = []
+    for port in args.port:
+        name = os.path.basename(port)
+        sinks = [pipeline.JsonSink(tags={'device': name})] if args.json else []
+        devices.append(Device(name, serial.Serial(port, args.baudrate, timeout=0), executor, args.binary, sinks, args.store))
+    all_devices = list(devices)
+
+    md = MultiDevice(devices)
+    print('reading from %d devices...' % len(devices), file=sys.stderr)
+    try:
+        md.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    md.finish()
+    executor.shutdown(wait=True)
+    for dev in all_devices: dev.close()
+    print(md.report(all_devices), file=sys.stderr)
+
+
+# call main
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+####
+#
+# headless acquisition and analysis of heart rate data (does not need matplotlib)
+#
+# the data flows through these stages:
+#   source:   chunks of raw bytes together with their receive time (serial port, recorded dump)
+#   parser:   decoded samples (protocol.Parser), optionally with the beats detected on the host (beat_detector.HostBeats)
+#   analysis: inter-beat-intervals and HRV descriptors (Analysis)
+#   sinks:    consumers of the samples and descriptors (stdout/JSON, file, live plot from heartex.py, streaming server from stream_server.py)
+#
+# examples:
+#   python pipeline.py --port COM3 --json                  # print beats and HRV descriptors as JSON lines
+#   python pipeline.py --port COM3 --file session.tsv      # write all samples to a file
+#   python pipeline.py --port COM3 --record session.hrx    # record the raw data (for later replay with --dump)
+#   python pipeline.py --dump temp.txt --json              # reprocess a recorded dump as fast as possible
+#   python pipeline.py --dump temp.txt --speed 1 --plot    # replay a recorded dump in real time in the live plot
+#   python pipeline.py --dump temp.txt --beats host --json # with the beats detected on the host from the sensor data
+#   python pipeline.py --port COM3 --serve 8765            # publish the data to viewers (see stream_server.py)
+#
+####
+
+
+# config
+
+CFG_comport = 'COM3'
+CFG_baudrate = 115200
+CFG_serial_timeout = 1
+
+CFG_update_hrv_every = 10   # update hrv descriptors every n heart beats
+CFG_initial_wait = 5        # ignore the first seconds of data
+
+
+import numpy as np
+import argparse
+import json
+import sys
+import threading
+import time
+
+import beat_detector
+import hrv_analysis
+import protocol
+import recorder
+import sample_store
+
+
+# sources
+
+class SerialSource():
+    """raw data from the serial port"""
+
+    def __init__(self, comport, baudrate, timeout=CFG_serial_timeout):
+        import serial  # only needed if we read from the serial port
+        print('reading from serial port %s...' % comport, file=sys.stderr)
+        self.ser = serial.Serial(comport, baudrate, timeout=timeout)
+        self.running = True
+
+
+    def __iter__(self):
+        while self.running:
+            try:
+                data = self.ser.read(max(1, self.ser.in_waiting))  # blocks until there is data (or the timeout is reached)
+            except (OSError, ValueError) as e:  # port closed or device unplugged
+                print("error reading from serial port: %s" % e, file=sys.stderr)
+                break
+            if data: yield data, time.time()
+
+
+    def close(self):
+        self.running = False
+        self.ser.close()
+
+
+class DumpSource():
+    """raw data from a recording (see recorder.py, also older dumps recorded with heartex.py), read block by block from disk
+    speed: 1 replays in real time, 10 ten times faster and so on, None as fast as possible. the chunks keep their recorded times"""
+
+    def __init__(self, filename, speed=None):
+        self.filename = filename
+        self.speed = speed
+        self.running = True
+
+
+    def __iter__(self):
+        t_first = None
+        start = time.monotonic()
+        for chunk, t in recorder.read_dump(self.filename):
+            if not self.running: break
+            if self.speed:
+                if t_first is None: t_first = t
+                delay = (t - t_first) / self.speed - (time.monotonic() - start)
+                if delay > 0: time.sleep(delay)
+            yield chunk, t
+
+
+    def close(self):
+        self.running = False
+
+
+# analysis
+
+class Analysis():
+    """collects the inter-beat-intervals and calculates the HRV descriptors every update_every beats
+    the non-linear descriptors are O(N^2) in the number of beats (see HRVdescriptors.calculate), window_beats bounds their cost"""
+
+    def __init__(self, update_every=CFG_update_hrv_every, window_beats=None, window_ms=None, initial_wait=CFG_initial_wait, nonlinear=True):
+        self.update_every = update_every
+        self.initial_wait = initial_wait
+        self.nonlinear = nonlinear
+        self.stream = hrv_analysis.HRVstream(window_beats=window_beats, window_ms=window_ms)
+        self.hrv = hrv_analysis.HRVdescriptors()
+        self.IBI = sample_store.SampleStore(np.int32)  # times in milliseconds since time_start
+        self.time_start = None
+
+
+    def process(self, syms, vals, times):
+        """processes decoded samples, returns a list of (time, descriptors) for every update of the HRV descriptors"""
+        if len(times) and self.time_start is None: self.time_start = times[0]
+
+        results = []
+        for i in np.flatnonzero(syms == ord('Q')).tolist():
+            if times[i] - self.time_start < self.initial_wait: continue
+            self.IBI.append(vals[i:i+1], [round((times[i] - self.time_start) * 1000)])
+            self.stream.add(vals[i])
+            if self.IBI.count > 1 and self.IBI.count % self.update_every == 0:
+                results.append((times[i], self.calculate()))
+        return results
+
+
+    def calculate(self):
+        """calculates the HRV descriptors of the current window, the time-domain descriptors are taken from the incremental calculation"""
+        r = self.hrv.calculate(self.IBI.values()[self.IBI.count-self.stream.count:].astype(float), nonlinear=self.nonlinear)
+        if not r: return r
+        r.update(self.stream.calculate())
+        return r
+
+
+# sinks
+
+class Sink():
+    """base class for sinks, they get all decoded samples and all updates of the HRV descriptors"""
+
+    def samples(self, syms, vals, times):
+        pass
+
+
+    def descriptors(self, t, result):
+        pass
+
+
+    def close(self):
+        pass
+
+
+class JsonSink(Sink):
+    """writes beats and HRV descriptors (and optionally the raw sensor data) as JSON lines, to stdout by default
+    tags are added to every line (e.g. the name of the device)"""
+
+    def __init__(self, stream=None, sensor=False, tags=None):
+        self.stream = sys.stdout if stream is None else stream
+        self.sensor = sensor
+        self.tags = {} if tags is None else tags
+        self.BPM = None
+
+
+    def _write(self, obj):
+        obj.update(self.tags)
+        self.stream.write(json.dumps(obj) + '\n')
+
+
+    def samples(self, syms, vals, times):
+        if self.sensor:
+            is_sensor = syms == ord('S')
+            if is_sensor.any(): self._write({'type': 'sensor', 't': times[is_sensor].tolist(), 'sensor': vals[is_sensor].tolist()})
+        for i in np.flatnonzero((syms == ord('B')) | (syms == ord('Q'))).tolist():
+            if syms[i] == ord('B'):
+                self.BPM = int(vals[i])
+            else:
+                self._write({'type': 'beat', 't': float(times[i]), 'IBI': int(vals[i]), 'BPM': self.BPM})
+        self.stream.flush()
+
+
+    def descriptors(self, t, result):
+        if not result: return
+        self._write({'type': 'descriptors', 't': float(t), 'descriptors': {k: (None if np.isnan(v) else float(v)) for k, v in result.items()}})
+        self.stream.flush()
+
+
+class FileSink(Sink):
+    """writes all samples as tab-separated lines (time, symbol, value) to a file, and the HRV descriptors to a second file (if given)"""
+
+    def __init__(self, filename, filename_descriptors=None):
+        self.f = open(filename, 'w')
+        self.f.write('time\tsymbol\tvalue\n')
+        self.f_descriptors = None
+        self.keys = None
+        if filename_descriptors is not None:
+            self.f_descriptors = open(filename_descriptors, 'w')
+
+
+    def samples(self, syms, vals, times):
+        if len(syms) == 0: return
+        rows = np.rec.fromarrays([times, syms, vals])
+        np.savetxt(self.f, rows, fmt='%.6f\t%c\t%d')
+
+
+    def descriptors(self, t, result):
+        if self.f_descriptors is None or not result: return
+        if self.keys is None:
+            self.keys = list(result)
+            self.f_descriptors.write('\t'.join(['time'] + self.keys) + '\n')
+        self.f_descriptors.write('\t'.join(['%.6f' % t] + ['%g' % result.get(k, np.nan) for k in self.keys]) + '\n')
+
+
+    def close(self):
+        self.f.close()
+        if self.f_descriptors is not None: self.f_descriptors.close()
+
+
+# pipeline
+
+class Pipeline():
+    """connects a source with the parser, the analysis and the sinks"""
+
+    def __init__(self, source, sinks, binary=False, analysis=None, recorder=None, beats=None):
+        self.source = source
+        self.recorder = recorder  # records the raw data (recorder.Recorder)
+        self.sinks = sinks
+        self.parser = protocol.Parser(binary)
+        self.beats = beats        # beats detected on the host (beat_detector.HostBeats)
+        self.analysis = Analysis() if analysis is None else analysis
+        self.running = False
+
+
+    def process(self, data, t):
+        """passes one chunk of raw bytes through all stages"""
+        if self.recorder is not None: self.recorder.record(data, t)
+        syms, vals, times = self.parser.decode(data, t)
+        if self.beats is not None: syms, vals, times = self.beats.filter(syms, vals, times)
+        for sink in self.sinks: sink.samples(syms, vals, times)
+        for t_result, result in self.analysis.process(syms, vals, times):
+            for sink in self.sinks: sink.descriptors(t_result, result)
+
+
+    def run(self, duration=None):
+        """processes the data until the source is exhausted, stop() is called or duration (in seconds) is over"""
+        self.running = True
+        time_start = time.time()
+        for data, t in self.source:
+            self.process(data, t)
+            if not self.running or (duration is not None and time.time() - time_start > duration): break
+        self.close()
+
+
+    def stop(self):
+        self.running = False
+
+
+    def close(self):
+        self.source.close()
+        if self.recorder is not None: self.recorder.close()
+        for sink in self.sinks: sink.close()
+        if self.beats is not None and self.beats.mode == 'check': print(self.beats.report(), file=sys.stderr)
+
+
+# main() function
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='headless acquisition and analysis of heart rate data')
+    parser.add_argument('--port', default=CFG_comport, help='serial port (default: %(default)s)')
+    parser.add_argument('--baudrate', type=int, default=CFG_baudrate)
+    parser.add_argument('--binary', action='store_true', help='the arduino sends the binary protocol')
+    parser.add_argument('--beats', choices=['device', 'host', 'check'], default='device', help='beats from the arduino, detected on the host from the sensor data, or both compared (default: %(default)s)')
+    parser.add_argument('--dump', help='read a recorded dump instead of the serial port')
+    parser.add_argument('--speed', type=float, help='replay the dump at this speed (1: real time, default: as fast as possible)')
+    parser.add_argument('--record', help='record the raw data to this file (can be read with --dump)')
+    parser.add_argument('--json', action='store_true', help='write beats and HRV descriptors as JSON lines to stdout')
+    parser.add_argument('--sensor', action='store_true', help='also write the raw sensor data as JSON')
+    parser.add_argument('--file', help='write all samples to this file (tab-separated)')
+    parser.add_argument('--file-descriptors', help='write the HRV descriptors to this file (tab-separated)')
+    parser.add_argument('--plot', action='store_true', help='show the live plot (needs matplotlib)')
+    parser.add_argument('--serve', help='publish the data to viewers on [host:]port (see stream_server.py)')
+    parser.add_argument('--duration', type=float, help='stop after so many seconds')
+    args = parser.parse_args(argv)
+
+    sinks = []
+    if args.json: sinks.append(JsonSink(sensor=args.sensor))
+    if args.file: sinks.append(FileSink(args.file, args.file_descriptors))
+    if args.serve:
+        import stream_server
+        sinks.append(stream_server.StreamServer(*stream_server.parse_address(args.serve)))
+    if args.plot:
+        import heartex  # imports matplotlib
+        sinks.append(heartex.PlotSink())
+
+    source = DumpSource(args.dump, args.speed) if args.dump else SerialSource(args.port, args.baudrate)
+    beats = beat_detector.HostBeats(args.beats, args.binary) if args.beats != 'device' else None
+    pipeline = Pipeline(source, sinks, binary=args.binary, recorder=recorder.Recorder(args.record) if args.record else None, beats=beats)
+
+    if args.plot:  # the plot needs the main thread
+        thread = threading.Thread(target=pipeline.run, args=(args.duration,), daemon=True)
+        thread.start()
+        heartex.show(sinks[-1].hrvplot)
+        pipeline.stop()
+        thread.join()
+        sinks[-1].hrvplot.close()
+    else:
+        try:
+            pipeline.run(args.duration)
+        except KeyboardInterrupt:
+            pipeline.close()
+
+
+# call main
+if __name__ == '__main__':
+    main()
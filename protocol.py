@@ -0,0 +1,243 @@
+####
+# decoding of the data sent by the Arduino (see PulseSensorAmped_Arduino)
+#
+# each value is sent as one line: a symbol followed by an integer, e.g. "S512\r\n"
+#   S: raw sensor data
+#   B: heart rate (average of last 10 beats)
+#   Q: inter beat interval in ms
+#
+####
+
+import numpy as np
+
+
+CFG_symbols = {"S":"sensor", "B":"beats", "Q":"IBI"}   # these are the symbols that come form the arduino program
+CFG_max_digits = 9   # longer values do not fit into int32 and are counted as errors
+
+_is_symbol = np.zeros(256, dtype=bool)
+_is_symbol[[ord(sym) for sym in CFG_symbols]] = True
+_is_digit = np.zeros(256, dtype=bool)
+_is_digit[ord('0'):ord('9')+1] = True
+
+
+class LineDecoder():
+    """incremental decoder for the line protocol, a line that is split over two reads is carried over to the next call
+    whole chunks are decoded at once with numpy (no python loop over the lines)"""
+
+    device_time = False  # the text protocol does not contain timestamps
+
+    def __init__(self):
+        self.remainder = b''   # incomplete line from the last call
+        self.errors = 0        # number of lines that could not be decoded
+
+
+    def decode(self, data):
+        """decodes a chunk of bytes, returns the symbols (as uint8 character codes) and the values of all complete lines,
+        lines with unknown symbols or values that are no integers are skipped (and counted in self.errors)"""
+        buf = self.remainder + bytes(data)
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        nl = np.flatnonzero(arr == ord('\n'))
+        if len(nl) == 0:
+            self.remainder = buf
+            return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int32)
+        self.remainder = buf[nl[-1]+1:]
+        arr = arr[:nl[-1]+1]
+
+        # line boundaries: the symbol is at starts, the value (with optional minus sign) goes from first to ends (without "\r")
+        starts = np.empty_like(nl)
+        starts[0] = 0
+        starts[1:] = nl[:-1] + 1
+        ends = nl - ((nl > starts) & (arr[nl-1] == ord('\r')))
+        neg = (ends - starts >= 3) & (arr[np.minimum(starts+1, nl)] == ord('-'))
+        first = starts + 1 + neg
+        num_digits = ends - first
+
+        digits_cumsum = np.zeros(len(arr)+1, dtype=np.int64)
+        np.cumsum(_is_digit[arr], out=digits_cumsum[1:])
+        valid = _is_symbol[arr[starts]] & (num_digits >= 1) & (num_digits <= CFG_max_digits) & (digits_cumsum[ends] - digits_cumsum[np.minimum(first, ends)] == num_digits)
+        self.errors += int(np.count_nonzero(~valid & (ends - starts >= 2)))  # empty (or too short) lines are no errors
+
+        # value of each digit depending on its position within the line, summed per line
+        line = np.repeat(np.arange(len(nl)), nl - starts + 1)
+        pos = np.arange(len(arr))
+        sel = valid[line] & (pos >= first[line]) & (pos < ends[line])
+        line = line[sel]
+        weights = (arr[sel] - ord('0')) * 10.0**(ends[line] - 1 - pos[sel])
+        vals = np.bincount(line, weights=weights, minlength=len(nl))[valid].astype(np.int64)
+        vals[neg[valid]] *= -1
+
+        return arr[starts[valid]], vals.astype(np.int32)
+
+
+    def decode_channels(self, data):
+        """decodes a chunk of bytes, returns a dictionary with an int32 array of values for each channel (see CFG_symbols)"""
+        syms, vals = self.decode(data)
+        return {name: vals[syms == ord(sym)] for sym, name in CFG_symbols.items()}
+
+
+# binary protocol (see PulseSensorAmped_Arduino.ino, BINARY_PROTOCOL)
+
+CFG_frame_sync = b'\xa5\x5a'
+CFG_frame_samples = 16      # sensor samples per frame
+CFG_sample_us = 2000        # sample period of the arduino in microseconds (500Hz)
+CFG_frame_us = CFG_frame_samples * CFG_sample_us
+CFG_no_beat = 0xFF
+
+frame_dtype = np.dtype([('sync', 'u1', 2), ('seq', 'u1'), ('t_us', '<u4'), ('packed', 'u1', 20), ('beat', 'u1'), ('bpm', 'u1'), ('IBI', '<u2'), ('checksum', 'u1')])
+CFG_frame_size = frame_dtype.itemsize   # 32 bytes
+
+
+def frame_checksums(raw):
+    """checksums of frames given as a (num x CFG_frame_size) uint8 array"""
+    return (raw[:,2:-1].sum(axis=1, dtype=np.uint32) & 0xFF).astype(np.uint8)
+
+
+def unpack_samples(packed):
+    """unpacks (num x 20) bytes into (num x 16) 10-bit sensor samples"""
+    groups = packed.reshape(len(packed), -1, 5).astype(np.uint16)
+    high = (groups[:,:,4:5] >> (2*np.arange(4, dtype=np.uint16))) & 0x03
+    return (groups[:,:,:4] | (high << 8)).reshape(len(packed), -1)
+
+
+def encode_frames(seq, t_us, samples, beat=None, bpm=None, IBI=None):
+    """builds binary frames (as bytes), e.g. for tests or simulations
+    samples is a (num x 16) array, beat holds the sample index of a beat in each frame (CFG_no_beat: no beat)"""
+    samples = np.asarray(samples, dtype=np.uint16).reshape(-1, CFG_frame_samples)
+    num = len(samples)
+    frames = np.zeros(num, dtype=frame_dtype)
+    frames['sync'] = np.frombuffer(CFG_frame_sync, dtype=np.uint8)
+    frames['seq'] = np.asarray(seq) & 0xFF
+    frames['t_us'] = np.asarray(t_us) & 0xFFFFFFFF
+    groups = samples.reshape(num, -1, 4)
+    packed = np.zeros((num, groups.shape[1], 5), dtype=np.uint8)
+    packed[:,:,:4] = groups & 0xFF
+    packed[:,:,4] = ((groups >> 8) << (2*np.arange(4, dtype=np.uint16))).sum(axis=2)
+    frames['packed'] = packed.reshape(num, -1)
+    frames['beat'] = CFG_no_beat if beat is None else beat
+    if bpm is not None: frames['bpm'] = bpm
+    if IBI is not None: frames['IBI'] = IBI
+    raw = frames.view(np.uint8).reshape(num, CFG_frame_size)
+    frames['checksum'] = frame_checksums(raw)
+    return frames.tobytes()
+
+
+class FrameDecoder():
+    """incremental decoder for the binary protocol, returns the same symbols as LineDecoder plus device timestamps
+    frames are located by their sync bytes and checked by their checksum, lost frames are detected from the sequence numbers and timestamps"""
+
+    device_time = True   # decode() also returns the time of each sample
+
+    def __init__(self):
+        self.remainder = b''
+        self.errors = 0         # number of bytes that had to be skipped (garbage or frames with a wrong checksum)
+        self.frames = 0         # number of decoded frames
+        self.lost_frames = 0    # number of frames that did not arrive
+        self.seq_last = None
+        self.t_last = None      # unwrapped timestamp of the last frame in microseconds
+
+
+    def _find_frames(self, arr):
+        """returns the start positions of all valid frames in arr"""
+        if len(arr) >= CFG_frame_size and arr[0] == CFG_frame_sync[0] and arr[1] == CFG_frame_sync[1]:
+            # fast path: the stream is aligned, check all frames at once
+            num = len(arr) // CFG_frame_size
+            raw = arr[:num*CFG_frame_size].reshape(num, CFG_frame_size)
+            ok = (raw[:,0] == CFG_frame_sync[0]) & (raw[:,1] == CFG_frame_sync[1]) & (frame_checksums(raw) == raw[:,-1])
+            if ok.all():
+                return np.arange(num) * CFG_frame_size
+
+        cand = np.flatnonzero((arr[:-1] == CFG_frame_sync[0]) & (arr[1:] == CFG_frame_sync[1]))
+        cand = cand[cand + CFG_frame_size <= len(arr)]
+        if len(cand) == 0: return cand
+        raw = arr[cand[:,None] + np.arange(CFG_frame_size)]
+        cand = cand[frame_checksums(raw) == raw[:,-1]]
+        if len(cand) > 1 and np.diff(cand).min() < CFG_frame_size:  # overlapping candidates (sync bytes inside a frame), take them in order
+            starts = []
+            for c in cand.tolist():
+                if not starts or c >= starts[-1] + CFG_frame_size: starts.append(c)
+            cand = np.array(starts)
+        return cand
+
+
+    def decode(self, data):
+        """decodes a chunk of bytes, returns the symbols (as uint8 character codes), values and device times (in microseconds) of all samples
+        in all complete frames, the beats (B and Q) are placed right after the sensor sample at which they were detected"""
+        buf = self.remainder + bytes(data)
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        starts = self._find_frames(arr)
+
+        # keep the end of the buffer that could still be the beginning of a frame
+        end = starts[-1] + CFG_frame_size if len(starts) else 0
+        keep = max(end, len(arr) - CFG_frame_size + 1)
+        self.errors += int((starts - np.concatenate([[0], starts[:-1] + CFG_frame_size])).sum() + keep - end)
+        self.remainder = buf[keep:]
+
+        if len(starts) == 0:
+            return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+        if np.array_equal(starts, starts[0] + CFG_frame_size*np.arange(len(starts))):
+            frames = np.frombuffer(buf, dtype=frame_dtype, count=len(starts), offset=int(starts[0]))   # zero-copy
+        else:
+            frames = arr[starts[:,None] + np.arange(CFG_frame_size)].copy().view(frame_dtype).ravel()
+        num = len(frames)
+        self.frames += num
+
+        # unwrap the timestamps (micros() overflows after ~71 minutes) and detect lost frames
+        t = frames['t_us'].astype(np.int64)
+        seq = frames['seq'].astype(np.int64)
+        t_prev = t[0] if self.t_last is None else self.t_last & 0xFFFFFFFF
+        dt = np.diff(t, prepend=t_prev) & 0xFFFFFFFF
+        t = (t[0] if self.t_last is None else self.t_last) + np.cumsum(dt)
+        if self.seq_last is not None or num > 1:
+            seq_prev = np.concatenate([[seq[0]-1 if self.seq_last is None else self.seq_last], seq[:-1]])
+            lost_seq = (seq - seq_prev - 1) % 256
+            lost_time = np.round(dt / float(CFG_frame_us)).astype(np.int64) - 1
+            if self.t_last is None: lost_time[0] = 0
+            # the timestamps only count when the sequence numbers wrapped around, a pause of the device (sensor switched off) keeps the sequence numbers
+            wrapped = (lost_time > 255) & ((lost_time - lost_seq) % 256 == 0)
+            self.lost_frames += int(np.where(wrapped, lost_time, lost_seq).sum())
+        self.seq_last = int(seq[-1])
+        self.t_last = int(t[-1])
+
+        # sensor samples, with their own time
+        sensor = unpack_samples(frames['packed']).ravel().astype(np.int32)
+        sensor_t = (t[:,None] + CFG_sample_us*np.arange(CFG_frame_samples)).ravel()
+        sensor_order = 3*np.arange(len(sensor))   # position in the output (leaves room for B and Q after each sample)
+
+        has_beat = frames['beat'] < CFG_frame_samples
+        beat_pos = np.flatnonzero(has_beat)*CFG_frame_samples + frames['beat'][has_beat]
+        syms = np.concatenate([np.full(len(sensor), ord('S'), dtype=np.uint8), np.full(len(beat_pos), ord('B'), dtype=np.uint8), np.full(len(beat_pos), ord('Q'), dtype=np.uint8)])
+        vals = np.concatenate([sensor, frames['bpm'][has_beat].astype(np.int32), frames['IBI'][has_beat].astype(np.int32)])
+        times = np.concatenate([sensor_t, sensor_t[beat_pos], sensor_t[beat_pos]])
+        order = np.argsort(np.concatenate([sensor_order, 3*beat_pos+1, 3*beat_pos+2]), kind='stable')
+
+        return syms[order], vals[order], times[order]
+
+
+class Parser():
+    """decodes raw chunks of bytes (text or binary protocol) into samples with times (in seconds since the epoch)
+    for the text protocol all samples of a chunk get its receive time, for the binary protocol the device time is mapped onto the receive time"""
+
+    def __init__(self, binary=False):
+        self.decoder = FrameDecoder() if binary else LineDecoder()
+        self.time_offset = None   # device time -> receive time (binary protocol only)
+        self.bytes_read = 0
+
+
+    def decode(self, data, t):
+        """decodes a chunk of bytes received at time t, returns the symbols, values and times of the samples"""
+        self.bytes_read += len(data)
+        if self.decoder.device_time:
+            syms, vals, t_us = self.decoder.decode(data)
+            if len(t_us) and self.time_offset is None: self.time_offset = t - t_us[-1] / 1e6   # the newest sample was received just now
+            times = (self.time_offset if len(t_us) else t) + t_us / 1e6
+        else:
+            syms, vals = self.decoder.decode(data)
+            times = np.full(len(syms), t)
+        return syms, vals, times
+
+
+    def counters(self):
+        """returns a dictionary with statistics about the decoding"""
+        counters = {'bytes_read': self.bytes_read, 'decode_errors': self.decoder.errors}
+        if hasattr(self.decoder, 'lost_frames'): counters['lost_frames'] = self.decoder.lost_frames
+        return counters
@@ -0,0 +1,196 @@
+####
+# streaming recorder of the raw data from the serial port (for later offline testing and replay)
+#
+# the raw chunks are written together with their receive times by a background thread, in blocks:
+#   file header:  magic (8 bytes), flags (1 byte, 1: zlib compressed blocks)
+#   block:        header (magic, payload size, raw size, crc32 of the payload, number of chunks, time of the first and last chunk)
+#                 payload (possibly compressed): for each chunk its receive time (double), size (uint32) and the raw bytes
+#   index:        at the end of a complete recording the offsets and times of all blocks, followed by the offset of the index
+# a block is written when it reaches CFG_block_size bytes or is CFG_block_interval seconds old, so a crash loses at most
+# this much data. a recording without index (e.g. after a crash) is read by following the block headers up to the first incomplete block.
+#
+# older dumps (pickled lists of the raw lines, the original CFG_save_dump format) can be read as well.
+#
+####
+
+CFG_block_size = 65536      # write a block when it has this many raw bytes
+CFG_block_interval = 1.0    # or when it is this many seconds old
+CFG_fsync = True            # make sure that the blocks are on disk (not only in the file cache of the OS)
+CFG_legacy_interval = 0.02  # time between two chunks of an older dump (they have no receive times, they were recorded every animation frame)
+
+
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+
+file_magic = b'HRXDUMP1'
+block_magic = b'HRXB'
+index_magic = b'HRXI'
+block_header = struct.Struct('<4sIIIIdd')   # magic, payload size, raw size, crc32, number of chunks, first time, last time
+chunk_header = struct.Struct('<dI')         # receive time, size
+index_entry = struct.Struct('<Qdd')         # block offset, first time, last time
+index_trailer = struct.Struct('<4sQ')       # magic, offset of the index
+
+FLAG_COMPRESSED = 1
+
+
+class Recorder():
+    """writes raw chunks (with their receive times) to a file, record() only queues the data, the writing happens in a background thread"""
+
+    def __init__(self, filename, compress=True):
+        self.filename = filename
+        self.compress = compress
+        self.f = open(filename, 'wb')
+        self.f.write(file_magic + bytes([FLAG_COMPRESSED if compress else 0]))
+        self.index = []           # offset, first time, last time of the written blocks
+        self.bytes_recorded = 0   # raw bytes
+        self.bytes_written = 0    # bytes in the file
+        self.queue = queue.SimpleQueue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def record(self, data, t):
+        """queues a raw chunk received at time t (seconds since the epoch), may be called from any thread"""
+        if not self.closed and data:
+            self.queue.put((bytes(data), t))
+
+
+    def _run(self):
+        block = []
+        size = 0
+        block_start = 0
+        while True:
+            timeout = None if not block else max(0.0, block_start + CFG_block_interval - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False  # the block is old enough
+            if item:
+                if not block: block_start = time.monotonic()
+                block.append(item)
+                size += len(item[0])
+            if block and (item is None or item is False or size >= CFG_block_size):
+                self._write_block(block)
+                block = []
+                size = 0
+            if item is None: break
+
+
+    def _write_block(self, block):
+        raw = b''.join(chunk_header.pack(t, len(data)) + data for data, t in block)
+        payload = zlib.compress(raw, 1) if self.compress else raw
+        offset = self.f.tell()
+        self.f.write(block_header.pack(block_magic, len(payload), len(raw), zlib.crc32(payload), len(block), block[0][1], block[-1][1]) + payload)
+        self.f.flush()
+        if CFG_fsync: os.fsync(self.f.fileno())
+        self.index.append((offset, block[0][1], block[-1][1]))
+        self.bytes_recorded += len(raw) - len(block) * chunk_header.size
+        self.bytes_written = self.f.tell()
+
+
+    def close(self):
+        """writes the remaining data and the index"""
+        if self.closed: return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        offset = self.f.tell()
+        self.f.write(b''.join(index_entry.pack(*e) for e in self.index) + index_trailer.pack(index_magic, offset))
+        self.f.close()
+
+
+class DumpReader():
+    """reads a recording (see Recorder), the blocks are found with the index, or by following the block headers if there is none"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'rb')
+        if self.f.read(len(file_magic)) != file_magic:
+            raise ValueError("%s is not a recording" % filename)
+        self.compressed = bool(self.f.read(1)[0] & FLAG_COMPRESSED)
+        self.complete = True   # False if the recording was not closed properly
+        self.blocks = self._read_index()
+        if self.blocks is None:
+            self.complete = False
+            self.blocks = self._scan()
+
+
+    def _read_index(self):
+        self.f.seek(0, os.SEEK_END)
+        end = self.f.tell()
+        if end < len(file_magic) + 1 + index_trailer.size: return None
+        self.f.seek(end - index_trailer.size)
+        magic, offset = index_trailer.unpack(self.f.read(index_trailer.size))
+        if magic != index_magic or not len(file_magic) + 1 <= offset <= end - index_trailer.size or (end - index_trailer.size - offset) % index_entry.size: return None
+        self.f.seek(offset)
+        data = self.f.read(end - index_trailer.size - offset)
+        return [index_entry.unpack_from(data, i) for i in range(0, len(data), index_entry.size)]
+
+
+    def _scan(self):
+        blocks = []
+        offset = len(file_magic) + 1
+        while True:
+            self.f.seek(offset)
+            header = self.f.read(block_header.size)
+            if len(header) < block_header.size: break
+            magic, size, raw_size, crc, num, t_first, t_last = block_header.unpack(header)
+            if magic != block_magic: break
+            payload = self.f.read(size)
+            if len(payload) < size or zlib.crc32(payload) != crc: break  # incomplete block
+            blocks.append((offset, t_first, t_last))
+            offset += block_header.size + size
+        return blocks
+
+
+    def read_block(self, i):
+        """returns the chunks (data, time) of block i"""
+        self.f.seek(self.blocks[i][0])
+        magic, size, raw_size, crc, num, t_first, t_last = block_header.unpack(self.f.read(block_header.size))
+        raw = self.f.read(size)
+        if self.compressed: raw = zlib.decompress(raw)
+        chunks = []
+        pos = 0
+        for _ in range(num):
+            t, n = chunk_header.unpack_from(raw, pos)
+            pos += chunk_header.size
+            chunks.append((raw[pos:pos+n], t))
+            pos += n
+        return chunks
+
+
+    def __iter__(self):
+        for i in range(len(self.blocks)):
+            yield from self.read_block(i)
+
+
+    def close(self):
+        self.f.close()
+
+
+def read_dump(filename, interval=CFG_legacy_interval):
+    """yields the raw chunks (data, time) of a recording, older dumps (pickles) get consecutive times, interval seconds apart, from now on"""
+    with open(filename, 'rb') as f:
+        is_recording = f.read(len(file_magic)) == file_magic
+    if is_recording:
+        reader = DumpReader(filename)
+        try:
+            yield from reader
+        finally:
+            reader.close()
+        return
+    import pickle  # only for older dumps
+    with open(filename, 'rb') as f:
+        lines = pickle.load(f)['lines']
+    t = time.time()
+    for chunk in lines:
+        if not isinstance(chunk, bytes):  # text protocol, the chunks were stripped before they were stored
+            chunk = chunk.encode('ascii') + b'\r\n'
+        yield chunk, t
+        t += interval
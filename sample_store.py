@@ -0,0 +1,106 @@
+####
+# append-only storage of the samples of one channel
+#
+# values are stored as integers, times as integer milliseconds (offsets from the start of the session).
+# without a filename everything stays in memory (in an array that grows in chunks).
+# with a filename the data goes to two files (filename.time, filename.value) that are memory-mapped, so the resident memory
+# stays bounded for sessions of any length. the files are extended by one chunk at a time and mapped once per chunk,
+# the samples are written directly into the mapping (the files hold zeros after the last sample).
+# in both cases the whole history can be read as contiguous arrays without copying.
+#
+####
+
+CFG_chunk_size = 65536   # samples per chunk
+
+
+import numpy as np
+
+
+class SampleStore():
+    """append-only storage of the samples (integer values with integer millisecond times) of one channel"""
+
+    def __init__(self, dtype=np.int16, filename=None, chunk_size=CFG_chunk_size):
+        self.dtype = np.dtype(dtype)
+        self.time_dtype = np.dtype(np.int32)   # milliseconds, enough for 24 days
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.count = 0
+        self.last = None   # last appended value
+
+        self.chunk_start = 0   # index of the first sample in self.time/self.value
+        if filename is None:
+            self.time = np.zeros(chunk_size, dtype=self.time_dtype)
+            self.value = np.zeros(chunk_size, dtype=self.dtype)
+        else:
+            self.files = {'time': open(filename + '.time', 'w+b'), 'value': open(filename + '.value', 'w+b')}
+            self.mapped = {}   # memory-mapped files up to the end of the current chunk
+            self._map(chunk_size)
+
+
+    def append(self, values, times):
+        """appends samples, times in milliseconds"""
+        n = len(values)
+        if n == 0: return
+        values = np.asarray(values)
+        times = np.asarray(times)
+        pos = 0
+        while pos < n:
+            if self.count - self.chunk_start == len(self.time):
+                self._next_chunk()
+            i = self.count - self.chunk_start
+            k = min(n - pos, len(self.time) - i)
+            self.time[i:i+k] = times[pos:pos+k]
+            self.value[i:i+k] = values[pos:pos+k]
+            self.count += k
+            pos += k
+        self.last = values[-1]
+
+
+    def _next_chunk(self):
+        if self.filename is None:  # grow in memory (by one chunk, or by half of the current size for long sessions)
+            size = len(self.time) + max(self.chunk_size, len(self.time)//2)
+            for k in ['time', 'value']:
+                new = np.zeros(size, dtype=getattr(self, k).dtype)
+                new[:self.count] = getattr(self, k)
+                setattr(self, k, new)
+        else:  # extend the files by a chunk
+            self.chunk_start = self.count
+            self._map(self.count + self.chunk_size)
+
+
+    def _map(self, size):
+        """extends the files to size samples and maps them, the current chunk (self.time/self.value) is a view of the mapping"""
+        for k, f in self.files.items():
+            dtype = self.time_dtype if k == 'time' else self.dtype
+            f.truncate(size * dtype.itemsize)
+            self.mapped[k] = np.memmap(f, dtype=dtype, mode='r+', shape=(size,))
+            setattr(self, k, self.mapped[k][self.chunk_start:])
+
+
+    def flush(self):
+        """writes the mapped data to the files"""
+        if self.filename is None: return
+        for m in self.mapped.values(): m.flush()
+
+
+    def _views(self):
+        if self.filename is None:
+            return self.time[:self.count], self.value[:self.count]
+        return self.mapped['time'][:self.count], self.mapped['value'][:self.count]
+
+
+    def times(self):
+        """all times (in milliseconds) as one contiguous array (without copying)"""
+        return self._views()[0]
+
+
+    def values(self):
+        """all values as one contiguous array (without copying)"""
+        return self._views()[1]
+
+
+    def close(self):
+        if self.filename is None: return
+        self.flush()
+        self.mapped = {}
+        for f in self.files.values(): f.close()
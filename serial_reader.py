@@ -0,0 +1,116 @@
+####
+# background reading of the serial port
+#
+# a thread continuously drains the serial port, decodes the data and stores the samples in a preallocated ring buffer,
+# the GUI only takes what is new since the last frame
+#
+####
+
+import numpy as np
+import threading
+import time
+
+import instrument
+import protocol
+
+
+class SampleRingBuffer():
+    """preallocated ring buffer of decoded samples (symbol, value and receive time), one writer and one reader"""
+
+    def __init__(self, size):
+        self.size = size
+        self.sym = np.zeros(size, dtype=np.uint8)
+        self.val = np.zeros(size, dtype=np.int32)
+        self.time = np.zeros(size, dtype=np.float64)   # receive time (seconds since the epoch)
+
+        self.written = 0     # total number of samples written
+        self.read = 0        # total number of samples read (or lost)
+        self.high_water = 0  # maximum number of unread samples in the buffer
+        self.overruns = 0    # number of samples that were overwritten before they were read
+        self.lock = threading.Lock()
+
+
+    def put(self, sym, val, t):
+        """appends samples (arrays of symbols and values, received at time t: one value for all or an array)"""
+        n = len(sym)
+        if n == 0: return
+        with self.lock:
+            if n > self.size:  # more than fits into the buffer, only the newest samples are kept
+                sym, val = sym[-self.size:], val[-self.size:]
+                if np.ndim(t): t = t[-self.size:]
+                self.written += n - self.size
+                n = self.size
+            idx = (self.written + np.arange(n)) % self.size
+            self.sym[idx] = sym
+            self.val[idx] = val
+            self.time[idx] = t
+            self.written += n
+            self.high_water = max(self.high_water, min(self.written - self.read, self.size))
+
+
+    def get(self):
+        """returns copies of all samples written since the last call (symbols, values, receive times)"""
+        with self.lock:
+            if self.written - self.read > self.size:
+                self.overruns += self.written - self.size - self.read
+                self.read = self.written - self.size
+            idx = np.arange(self.read, self.written) % self.size
+            self.read = self.written
+            return self.sym[idx], self.val[idx], self.time[idx]
+
+
+class SerialReader():
+    """reads from the serial port in a background thread and puts the decoded samples into a ring buffer"""
+
+    def __init__(self, ser, size, on_raw=None, binary=False, beats=None):
+        self.ser = ser
+        self.buffer = SampleRingBuffer(size)
+        self.parser = protocol.Parser(binary)
+        self.on_raw = on_raw      # called with every raw chunk of bytes and its receive time (e.g. for dumping)
+        self.beats = beats        # beats detected on the host (beat_detector.HostBeats)
+        self.time_first_data = None   # when the first data arrived (perf_counter)
+        self.running = False
+        self.thread = None
+
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+    def run(self):
+        while self.running:
+            try:
+                waiting = self.ser.in_waiting
+                instrument.timings.add('serial_backlog', waiting, 'bytes')
+                data = self.ser.read(max(1, waiting))  # blocks until there is data (or the timeout is reached)
+            except (OSError, ValueError) as e:  # port closed or device unplugged
+                print("error reading from serial port: %s" % e)
+                self.running = False
+                break
+            if data: self.feed(data, time.time())
+
+
+    def feed(self, data, t):
+        """decodes a chunk of raw bytes and puts the samples into the ring buffer"""
+        if self.time_first_data is None: self.time_first_data = time.perf_counter()
+        if self.on_raw is not None: self.on_raw(data, t)
+        t_parse = instrument.timings.now()
+        decoded = self.parser.decode(data, t)
+        if self.beats is not None: decoded = self.beats.filter(*decoded)
+        instrument.timings.lap('parse', t_parse)
+        self.buffer.put(*decoded)
+
+
+    def counters(self):
+        """returns a dictionary with statistics about the ingestion"""
+        counters = {'samples': self.buffer.written, 'high_water': self.buffer.high_water, 'overruns': self.buffer.overruns}
+        counters.update(self.parser.counters())
+        return counters
@@ -0,0 +1,183 @@
+####
+# append-only store of the measured sessions (SQLite)
+#
+# each session is one row: start time, HRV descriptors (one column each, new descriptors get new columns)
+# and the inter-beat-intervals as a binary blob (int32), with an index on the start time.
+# the rows are written by a background thread, so appending never blocks the GUI.
+# the sessions can be exported to an excel file on demand:
+#   python session_store.py hrv_sessions.db --export hrv_data.xlsx
+#
+####
+
+CFG_table = 'sessions'
+CFG_labels = {'HRMean': 'HR Mean [Hz]', 'HRSTD': 'HR STD [Hz]', 'rMSSD': 'rMSSD [ms]', 'pNN50': 'pNN50 [%]', 'SD1': 'SD1 [ms]', 'SD2': 'SD2 [ms]',
+              'VLF': 'VLF [ms2]', 'LF': 'LF [ms2]', 'HF': 'HF [ms2]', 'LFHF': 'LFHF', 'Power': 'Power [ms2]', 'DFA1': 'DFA alpha1', 'DFA2': 'DFA alpha2',
+              'ApEn': 'ApEn', 'FracDim': 'FracDim'}   # column headers of the export ("Label [unit]", as in heartex.py), other descriptors keep their name
+
+
+import numpy as np
+import argparse
+import datetime
+import queue
+import sqlite3
+import threading
+
+
+class SessionStore():
+    """append-only store of the sessions, the appends are written by a background thread"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.queue = queue.Queue()
+        self.errors = 0   # number of sessions that could not be written
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename)
+        db.execute('CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, start TEXT NOT NULL, IBI BLOB)' % CFG_table)
+        db.execute('CREATE INDEX IF NOT EXISTS %s_start ON %s (start)' % (CFG_table, CFG_table))
+        return db
+
+
+    def _run(self):
+        db = self._connect()
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            try:
+                self._write(db, *item)
+            except sqlite3.Error as e:
+                self.errors += 1
+                print("error writing session to %s: %s" % (self.filename, e))
+        db.close()
+
+
+    def _write(self, db, start, descriptors, IBI):
+        columns = set(self.columns(db))
+        for k in descriptors:
+            if k not in columns:
+                db.execute('ALTER TABLE %s ADD COLUMN "%s" REAL' % (CFG_table, k))
+        keys = list(descriptors)
+        db.execute('INSERT INTO %s (start, IBI%s) VALUES (?, ?%s)' % (CFG_table, ''.join(', "%s"' % k for k in keys), ', ?' * len(keys)),
+                   [start.isoformat(' '), np.asarray(IBI, dtype='<i4').tobytes()] + [float(descriptors[k]) for k in keys])
+        db.commit()
+
+
+    def append(self, start, descriptors, IBI):
+        """appends a session (start as datetime, descriptors as dict, IBI in ms), returns immediately"""
+        self.queue.put((start, dict(descriptors), np.array(IBI)))
+
+
+    def close(self):
+        """writes the remaining sessions and stops the background thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+    # reading (from the calling thread)
+
+    @staticmethod
+    def columns(db):
+        """names of the descriptor columns"""
+        return [row[1] for row in db.execute('PRAGMA table_info(%s)' % CFG_table) if row[1] not in ('id', 'start', 'IBI')]
+
+
+    def sessions(self, start=None, end=None):
+        """returns the sessions (dicts with id, start, the descriptors and IBI) that started between start and end (datetimes or None)"""
+        db = self._connect()
+        query, args = 'SELECT * FROM %s WHERE 1' % CFG_table, []
+        if start is not None:
+            query += ' AND start >= ?'
+            args.append(start.isoformat(' '))
+        if end is not None:
+            query += ' AND start < ?'
+            args.append(end.isoformat(' '))
+        cursor = db.execute(query + ' ORDER BY start', args)
+        names = [d[0] for d in cursor.description]
+        result = []
+        for row in cursor:
+            session = dict(zip(names, row))
+            session['start'] = datetime.datetime.fromisoformat(session['start'])
+            session['IBI'] = np.frombuffer(session['IBI'] or b'', dtype='<i4')
+            result.append(session)
+        db.close()
+        return result
+
+
+    def export_xlsx(self, filename, start=None, end=None, keys=None, labels=None):
+        """writes the sessions to an excel file: one row per session in the first sheet, the IBIs one column per session in the second sheet
+        the columns are headed by labels (default: CFG_labels)"""
+        import openpyxl  # only needed for the export
+        sessions = self.sessions(start, end)
+        if keys is None:
+            db = self._connect()
+            keys = self.columns(db)
+            db.close()
+        labels = CFG_labels if labels is None else labels
+
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.title = 'HRV History'
+        ws.append(['datetime'] + [labels.get(k, k) for k in keys])
+        for s in sessions:
+            ws.append([s['start']] + [s.get(k) for k in keys])
+
+        ws = wb.create_sheet('IBI data')
+        for col, s in enumerate(sessions, 1):
+            ws.cell(row=1, column=col).value = s['start']
+            for row, v in enumerate(s['IBI'].tolist(), 2):
+                ws.cell(row=row, column=col).value = v
+        wb.save(filename)
+        print("Written data to file: %s" % filename)
+
+
+# reading without a SessionStore (e.g. in other processes)
+
+def list_sessions(filename, start=None, end=None):
+    """returns (id, start, number of beats) of the sessions that started between start and end (datetimes or None), without the IBIs"""
+    db = sqlite3.connect('file:%s?mode=ro' % filename, uri=True)
+    query, args = 'SELECT id, start, length(IBI) / 4 FROM %s WHERE 1' % CFG_table, []
+    if start is not None:
+        query += ' AND start >= ?'
+        args.append(start.isoformat(' '))
+    if end is not None:
+        query += ' AND start < ?'
+        args.append(end.isoformat(' '))
+    result = [(row[0], datetime.datetime.fromisoformat(row[1]), row[2] or 0) for row in db.execute(query + ' ORDER BY start', args)]
+    db.close()
+    return result
+
+
+def read_IBI(filename, ids):
+    """returns the IBIs of the sessions with the given ids (dict id -> int32 array)"""
+    db = sqlite3.connect('file:%s?mode=ro' % filename, uri=True)
+    ids = list(ids)
+    rows = db.execute('SELECT id, IBI FROM %s WHERE id IN (%s)' % (CFG_table, ','.join('?' * len(ids))), ids).fetchall()
+    db.close()
+    return {i: np.frombuffer(blob or b'', dtype='<i4') for i, blob in rows}
+
+
+# main() function
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='show or export the stored sessions')
+    parser.add_argument('filename', help='session store (SQLite file)')
+    parser.add_argument('--export', help='write the sessions to this excel file')
+    parser.add_argument('--start', type=datetime.datetime.fromisoformat, help='only sessions from this date on (e.g. 2015-06-01)')
+    parser.add_argument('--end', type=datetime.datetime.fromisoformat, help='only sessions before this date')
+    args = parser.parse_args(argv)
+
+    store = SessionStore(args.filename)
+    if args.export:
+        store.export_xlsx(args.export, args.start, args.end)
+    else:
+        for s in store.sessions(args.start, args.end):
+            print('%s  %5d beats  %s' % (s['start'], len(s['IBI']), '  '.join('%s=%g' % (k, v) for k, v in s.items() if k not in ('id', 'start', 'IBI') and v is not None)))
+    store.close()
+
+
+# call main
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+####
+#
+# streaming server: publishes the decoded samples, beats and HRV descriptors of one acquisition to any number of viewers
+#
+# the server is a sink (see pipeline.py). everything that arrives during one tick (CFG_tick seconds) is sent as one message,
+# each message is encoded once and queued for all clients. every client has a bounded queue, when a client is too slow the
+# oldest messages are dropped (and counted), so a slow viewer never holds up the acquisition or the other viewers.
+# the messages of the last CFG_history seconds are kept, a client that connects later gets them first.
+# the protocol is one JSON object per line over TCP:
+#   {"type": "hello", "history": 120}                                   # number of messages from the history that follow
+#   {"type": "samples", "sym": "SSSBQS", "val": [...], "t": [...]}      # symbols (see protocol.py), values, times (seconds since the epoch)
+#   {"type": "descriptors", "t": 1434105000.5, "descriptors": {...}}
+#
+# examples:
+#   python pipeline.py --port COM3 --serve 8765                    # acquisition, serves on localhost:8765
+#   python stream_server.py --connect localhost:8765                # prints the messages
+#   python stream_server.py --connect 192.168.1.5:8765 --plot       # live plot of the acquisition on another computer (served with --serve 0.0.0.0:8765)
+#
+####
+
+
+# config
+
+CFG_host = '127.0.0.1'      # serve on this address ('0.0.0.0': on the LAN)
+CFG_port = 8765
+CFG_tick = 0.05             # seconds, the data of one tick is sent as one message
+CFG_client_queue = 1000     # messages per client (50 s at CFG_tick), the oldest ones are dropped when a client is too slow
+CFG_history = 30            # seconds of messages that a new client gets first
+CFG_max_clients = 64
+
+
+import numpy as np
+import argparse
+import collections
+import json
+import selectors
+import socket
+import sys
+import threading
+import time
+
+import pipeline
+
+
+def parse_address(address, default_host=CFG_host):
+    """'host:port' or 'port' -> (host, port)"""
+    host, _, port = address.rpartition(':')
+    return host or default_host, int(port)
+
+
+class Client():
+    """a connected viewer, with its queue of encoded messages"""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.queue = collections.deque()
+        self.sending = None   # the rest of the message that is being sent (memoryview)
+        self.dropped = 0      # messages dropped because the client was too slow
+
+
+    def put(self, message):
+        if len(self.queue) >= CFG_client_queue:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(message)
+
+
+class StreamServer(pipeline.Sink):
+    """publishes the samples and descriptors to the connected clients, the network runs in a background thread"""
+
+    def __init__(self, host=CFG_host, port=CFG_port):
+        self.sock = socket.create_server((host, port))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.lock = threading.Lock()
+        self.pending = []              # (syms, vals, times) since the last tick
+        self.pending_descriptors = []  # messages since the last tick
+        self.history = collections.deque()   # (time, message) of the last CFG_history seconds
+        self.last_descriptors = None   # the newest descriptors (also for clients that connect later than CFG_history)
+        self.clients = {}
+        self.messages = 0              # number of published messages
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print('serving on %s:%d' % self.address[:2], file=sys.stderr)
+
+
+    # publishing (from the acquisition thread)
+
+    def samples(self, syms, vals, times):
+        if len(syms) == 0: return
+        with self.lock:
+            self.pending.append((np.array(syms, dtype=np.uint8), np.array(vals), np.array(times)))
+
+
+    def descriptors(self, t, result):
+        if not result: return
+        message = {'type': 'descriptors', 't': float(t), 'descriptors': {k: (None if np.isnan(v) else float(v)) for k, v in result.items()}}
+        with self.lock:
+            self.pending_descriptors.append(message)
+
+
+    # network (background thread)
+
+    def _run(self):
+        next_tick = time.monotonic() + CFG_tick
+        while self.running:
+            for key, events in self.selector.select(timeout=max(0.0, next_tick - time.monotonic())):
+                if key.fileobj is self.sock:
+                    self._accept()
+                elif key.fileobj is self.wakeup_r:
+                    self.wakeup_r.recv(64)
+                else:
+                    client = key.data
+                    if events & selectors.EVENT_READ: self._receive(client)
+                    if events & selectors.EVENT_WRITE and client.sock in self.clients: self._send(client)
+            now = time.monotonic()
+            if now >= next_tick:
+                self._tick(now)
+                next_tick = max(next_tick + CFG_tick, now)
+        for client in list(self.clients.values()): self._remove(client)
+        self.selector.close()
+        self.sock.close()
+
+
+    def _accept(self):
+        try:
+            sock, address = self.sock.accept()
+        except (BlockingIOError, ConnectionError):
+            return
+        if len(self.clients) >= CFG_max_clients:
+            sock.close()
+            return
+        sock.setblocking(False)
+        client = Client(sock, address)
+        self.clients[sock] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        # late joiners first get the recent history
+        history = [message for t, message in self.history]
+        if self.last_descriptors is not None: history.append(self.last_descriptors)
+        history = history[len(history)-CFG_client_queue+1:] if len(history) >= CFG_client_queue else history   # the hello must not be dropped
+        client.put(self._encode({'type': 'hello', 'history': len(history)}))
+        for message in history: client.put(message)
+        self._send(client)
+
+
+    def _receive(self, client):
+        try:
+            data = client.sock.recv(4096)   # the clients do not send anything, this only detects that they disconnected
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data: self._remove(client)
+
+
+    def _send(self, client):
+        """sends as much as possible without blocking, waits for the socket to become writable if there is more"""
+        while True:
+            if client.sending is None:
+                if not client.queue: break
+                client.sending = memoryview(client.queue.popleft())
+            try:
+                n = client.sock.send(client.sending)
+            except BlockingIOError:
+                break
+            except OSError:
+                self._remove(client)
+                return
+            client.sending = client.sending[n:] if n < len(client.sending) else None
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.sending is not None or client.queue else 0)
+        self.selector.modify(client.sock, events, client)
+
+
+    def _remove(self, client):
+        if self.clients.pop(client.sock, None) is None: return
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+
+    def _encode(self, obj):
+        return (json.dumps(obj, separators=(',', ':')) + '\n').encode('ascii')
+
+
+    def _tick(self, now):
+        """sends everything that was published since the last tick"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            pending_descriptors, self.pending_descriptors = self.pending_descriptors, []
+        messages = []
+        if pending:
+            syms, vals, times = [np.concatenate(a) for a in zip(*pending)]
+            messages.append(self._encode({'type': 'samples', 'sym': syms.tobytes().decode('ascii'), 'val': vals.tolist(), 't': np.round(times, 3).tolist()}))
+        for message in pending_descriptors:
+            messages.append(self._encode(message))
+            self.last_descriptors = messages[-1]
+        if not messages: return
+
+        self.messages += len(messages)
+        self.history.extend((now, message) for message in messages)
+        while self.history and self.history[0][0] < now - CFG_history: self.history.popleft()
+        for client in list(self.clients.values()):
+            for message in messages: client.put(message)
+            self._send(client)
+
+
+    def counters(self):
+        """returns a dictionary with statistics about the clients"""
+        clients = list(self.clients.values())
+        return {'clients': len(clients), 'messages': self.messages, 'dropped': sum(c.dropped for c in clients), 'queued': sum(len(c.queue) for c in clients)}
+
+
+    def close(self):
+        if not self.running: return
+        self.running = False
+        self.wakeup_w.send(b'x')
+        self.thread.join()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+
+class StreamClient():
+    """connects to a StreamServer, iterating yields the messages (dicts), the samples as numpy arrays (like protocol.Parser.decode)"""
+
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.f = self.sock.makefile('rb')
+
+
+    def __iter__(self):
+        for line in self.f:
+            message = json.loads(line)
+            if message['type'] == 'samples':
+                message['sym'] = np.frombuffer(message['sym'].encode('ascii'), dtype=np.uint8)
+                message['val'] = np.array(message['val'], dtype=np.int32)
+                message['t'] = np.array(message['t'])
+            yield message
+
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.f.close()
+        self.sock.close()
+
+
+# main() function
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='viewer for a streaming server (see pipeline.py --serve)')
+    parser.add_argument('--connect', default='%s:%d' % (CFG_host, CFG_port), help='address of the server (default: %(default)s)')
+    parser.add_argument('--plot', action='store_true', help='show the live plot (needs matplotlib)')
+    args = parser.parse_args(argv)
+
+    client = StreamClient(*parse_address(args.connect))
+    if not args.plot:
+        try:
+            for line in client.f:
+                sys.stdout.write(line.decode('ascii'))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        client.close()
+        return
+
+    import heartex  # imports matplotlib
+    hrvplot = heartex.HRVplot(heartex.CFG_comport, heartex.CFG_baudrate, heartex.CFG_serial_timeout, buffer=heartex.serial_reader.SampleRingBuffer(heartex.CFG_ringbuffer_size))
+    def receive():
+        skip = 0
+        offset = None   # server time -> local time, fixed at the first live message
+        for message in client:
+            if message['type'] == 'hello':
+                skip = message['history'] + 1   # the plot starts now, it does not show the history
+            elif message['type'] == 'samples' and skip <= 0:
+                if offset is None: offset = time.time() - message['t'][-1]
+                hrvplot.buffer.put(message['sym'], message['val'], message['t'] + offset)
+            skip -= 1
+    thread = threading.Thread(target=receive, daemon=True)
+    thread.start()
+    heartex.show(hrvplot)  # the plot needs the main thread
+    client.close()
+    hrvplot.close()
+
+
+# call main
+if __name__ == '__main__':
+    main()
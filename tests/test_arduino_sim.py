@@ -0,0 +1,38 @@
+# short soak of the serial ingestion of heartex.py against the simulated arduino: nothing may be lost
+
+import sys
+
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.skipif(sys.platform.startswith('win'), reason='the simulator needs a pseudo-terminal')   # arduino_sim imports pty
+
+
+def test_pulse_model():
+    import arduino_sim
+    model = arduino_sim.PulseModel(500, heart_rate=60, seed=0)
+    sensor, pos, BPM, IBI = model.generate(500 * 60)
+    assert sensor.min() >= 0 and sensor.max() <= 1023
+    assert 55 <= len(pos) <= 65
+    assert abs(np.mean(IBI) - 1000) < 50
+
+
+@pytest.mark.parametrize('binary, rate', [(False, 2000), (True, 500)])
+def test_soak(binary, rate):
+    pytest.importorskip('serial')
+    pytest.importorskip('matplotlib')
+    import arduino_sim
+    import heartex
+    comport, maxpoints = heartex.CFG_comport, heartex.CFG_maxpoints
+    sim = arduino_sim.ArduinoSimulator(rate, binary, seed=0)
+    try:
+        sent, received = arduino_sim.soak(sim, 3, report_every=1)
+    finally:
+        sim.close()
+    assert heartex.CFG_comport == comport and heartex.CFG_maxpoints is maxpoints   # the settings of heartex are restored
+    assert sent['values'] > rate * 2
+    assert sent['overflow'] == 0
+    assert received['samples'] == sent['values']
+    assert received['decode_errors'] == 0
+    assert received['overruns'] == 0
+    assert received.get('lost_frames', 0) == 0
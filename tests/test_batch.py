@@ -0,0 +1,87 @@
+# batch reprocessing: results, errors of single sessions and of whole chunks, resuming
+
+import datetime
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+import batch
+import recorder
+import session_store
+
+
+def make_recording(filename, num_beats, t0=1.7e9):
+    rec = recorder.Recorder(filename)
+    t = t0
+    for i in range(num_beats):
+        rec.record(b'S512\r\nB75\r\nQ%d\r\n' % (800 + 30 * (i % 5)), t)
+        t += 0.8
+    rec.close()
+
+
+@pytest.fixture
+def sources(tmp_path):
+    """two recordings, a broken file and a session store with two sessions"""
+    make_recording(str(tmp_path / 'a.hrx'), 200)
+    make_recording(str(tmp_path / 'b.hrx'), 300)
+    make_recording(str(tmp_path / 'broken.hrx'), 100)
+    raw = bytearray((tmp_path / 'broken.hrx').read_bytes())
+    raw[len(recorder.file_magic) + 1 + recorder.block_header.size + 10] ^= 0xFF   # the compressed block cannot be read
+    (tmp_path / 'broken.hrx').write_bytes(bytes(raw))
+    history = str(tmp_path / 'sessions.db')
+    store = session_store.SessionStore(history)
+    for day in (1, 2):
+        store.append(datetime.datetime(2026, 1, day), {'HRMean': 70.0}, 800 + 20 * np.sin(np.arange(400) / 3.0))
+    store.close()
+    return [str(tmp_path / f) for f in ('a.hrx', 'b.hrx', 'broken.hrx')], history
+
+
+@pytest.mark.parametrize('output', ['results.db', 'results.tsv'])
+def test_run(tmp_path, sources, output, capsys):
+    paths, history = sources
+    output = str(tmp_path / output)
+    batch.main(paths + ['--history', history, '--output', output, '--workers', '2', '--chunk-size', '2'])
+    result = batch.ResultFile(output)
+    done = result.done()
+    assert len(done) == 4                        # the broken file is not done
+    assert not any('broken' in key for key in done)
+    assert 'error in dump:' in capsys.readouterr().err
+
+    # a second run only tries the broken file again
+    jobs = batch.find_jobs(paths, history)
+    assert [job[0] for job in jobs if job[0] not in result.done()] == [job[0] for job in jobs if 'broken' in job[0]]
+    batch.main(paths + ['--history', history, '--output', output])
+    assert '5 sessions, 4 already done' in capsys.readouterr().err
+    assert result.done() == done
+
+
+def test_missing_session(tmp_path, sources):
+    paths, history = sources
+    jobs = [job for job in batch.find_jobs([], history)]
+    jobs.append(('session:%s:99' % history, 'session', history, 99, None, 0))   # not in the store
+    rows = batch.process_chunk(jobs, nonlinear=False)
+    assert [row['error'] is None for row in rows] == [True, True, False]
+    assert rows[0]['beats'] == 400 and rows[0]['descriptors']['HRMean'] > 0
+
+
+def crash(filename, *args):
+    if filename.endswith('b.hrx'): os._exit(1)   # the worker process dies
+    return original_read_dump_IBI(filename, *args)
+
+original_read_dump_IBI = batch.read_dump_IBI
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='the crash is patched into the forked workers')
+def test_worker_dies(tmp_path, sources, monkeypatch):
+    paths, history = sources
+    monkeypatch.setattr(batch, 'read_dump_IBI', crash)
+    output = batch.ResultFile(str(tmp_path / 'results.db'))
+    chunks = [[job] for job in batch.find_jobs(paths[:2])]
+    rows = batch.run(chunks, workers=1, progress=False, output=output, nonlinear=False)
+    assert len(rows) == 2
+    errors = [row for row in rows if row['error']]
+    assert errors and all('BrokenProcessPool' in row['error'] for row in errors)
+    assert all(np.isnan(v) for row in errors for v in row['descriptors'].values())
+    assert output.done() == {row['key'] for row in rows if not row['error']}   # written as they came in
@@ -0,0 +1,42 @@
+# beats detected on the host in the samples of the simulated pulse wave
+
+import numpy as np
+
+import arduino_sim
+import beat_detector
+
+
+def chunks(seconds, chunk=0.1, seed=0):
+    """decoded samples (symbols, values, times) as from protocol.Parser with the binary protocol, one chunk per call"""
+    model = arduino_sim.PulseModel(beat_detector.CFG_sample_rate, seed=seed)
+    num = int(chunk * beat_detector.CFG_sample_rate)
+    for i in range(int(seconds / chunk)):
+        sensor, pos, BPM, IBI = model.generate(num)
+        t = (model.num - num + np.arange(num)) / float(beat_detector.CFG_sample_rate)
+        syms = np.full(num, ord('S'), dtype=np.uint8)
+        order = np.argsort(np.concatenate([3*np.arange(num), 3*pos+1, 3*pos+2]), kind='stable')
+        yield (np.concatenate([syms, np.full(len(pos), ord('B'), dtype=np.uint8), np.full(len(pos), ord('Q'), dtype=np.uint8)])[order],
+               np.concatenate([sensor, BPM, IBI]).astype(np.int32)[order], np.concatenate([t, t[pos], t[pos]])[order])
+
+
+def test_host_mode():
+    beats = beat_detector.HostBeats('host', binary=True)
+    num_beats = 0
+    for syms, vals, times in chunks(60):
+        out_syms, out_vals, out_times = beats.filter(syms, vals, times)
+        assert np.count_nonzero(out_syms == ord('S')) == np.count_nonzero(syms == ord('S'))
+        num_beats += np.count_nonzero(out_syms == ord('Q'))
+    assert 60 <= num_beats <= 80   # about 70 per minute
+    assert beats.host == [] and beats.device == []   # nothing is collected
+
+
+def test_check_mode():
+    beats = beat_detector.HostBeats('check', binary=True)
+    for syms, vals, times in chunks(60):
+        out = beats.filter(syms, vals, times)
+        assert out[0] is syms   # the beats from the arduino are kept
+    assert all(len(IBI) for t, IBI in beats.host + beats.device)   # no empty chunks
+    c = beats.compare()
+    assert c['device_beats'] >= 60
+    assert c['matched'] >= c['device_beats'] - 2
+    assert c['IBI_difference_ms'] < 20
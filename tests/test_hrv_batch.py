@@ -0,0 +1,51 @@
+# HRVdescriptors.calculate_batch against calculate() series by series
+
+import numpy as np
+import pytest
+
+import hrv_analysis
+
+pytestmark = pytest.mark.filterwarnings("ignore:invalid value encountered:RuntimeWarning")  # LFHF of very short series
+
+
+def synthetic_IBIs(lengths, seed=0):
+    rng = np.random.default_rng(seed)
+    return [800 + 60 * np.sin(np.arange(n) / 5.0) + rng.normal(0, 40, n) for n in lengths]
+
+
+def assert_matches(result, IBIs, nonlinear=False):
+    hrv = hrv_analysis.HRVdescriptors()
+    for i, IBI in enumerate(IBIs):
+        expected = hrv.calculate(IBI, nonlinear=nonlinear)
+        if expected is False:
+            assert all(np.isnan(v[i]) for v in result.values())
+            continue
+        for k, v in expected.items():
+            assert result[k][i] == pytest.approx(v, rel=1e-9, abs=1e-12, nan_ok=True), (i, k)
+
+
+def test_ragged():
+    # short series (one segment each), long series (several segments of CFG_welch_segment), too short ones
+    IBIs = synthetic_IBIs([0, 1, 2, 3, 50, 50, 200, 400, 1000, 1000, 2345, 4000])
+    assert_matches(hrv_analysis.HRVdescriptors().calculate_batch(IBIs), IBIs)
+
+
+def test_padded():
+    IBIs = synthetic_IBIs([300, 700, 700, 1500])
+    padded = np.zeros((len(IBIs), 1600))
+    for i, IBI in enumerate(IBIs):
+        padded[i,:len(IBI)] = IBI
+    result = hrv_analysis.HRVdescriptors().calculate_batch(padded, lengths=[len(x) for x in IBIs])
+    assert_matches(result, IBIs)
+
+
+def test_dfa_blocks(monkeypatch):
+    monkeypatch.setattr(hrv_analysis, 'CFG_dfa_chunk', 1000)   # several DFA calls for the series of the same length
+    IBIs = synthetic_IBIs([300] * 7 + [1200])
+    assert_matches(hrv_analysis.HRVdescriptors().calculate_batch(IBIs), IBIs)
+
+
+def test_nonlinear():
+    # longer than 1000 beats, calculate() and calculate_batch() both use the whole series
+    IBIs = synthetic_IBIs([2, 100, 250, 1500])
+    assert_matches(hrv_analysis.HRVdescriptors().calculate_batch(IBIs, nonlinear=True), IBIs, nonlinear=True)
@@ -0,0 +1,90 @@
+# HRVstream against HRVdescriptors.calculate() on the same beats
+
+import numpy as np
+import pytest
+
+import hrv_analysis
+
+pytestmark = pytest.mark.filterwarnings("ignore:invalid value encountered:RuntimeWarning")  # LFHF of very short series
+
+KEYS = ['HRMean', 'HRSTD', 'pNN50', 'rMSSD']
+
+
+def synthetic_IBI(num, seed=0):
+    rng = np.random.default_rng(seed)
+    return 800 + 60 * np.sin(np.arange(num) / 5.0) + rng.normal(0, 40, num)
+
+
+def window_by_ms(IBI, window_ms):
+    """the last beats that fit into window_ms (at least one), the same rule as HRVstream"""
+    start, total = len(IBI) - 1, IBI[-1]
+    while start > 0 and total + IBI[start-1] <= window_ms:
+        start -= 1
+        total += IBI[start]
+    return IBI[start:]
+
+
+def assert_matches(stream, IBI):
+    expected = hrv_analysis.HRVdescriptors().calculate(IBI)
+    result = stream.calculate()
+    if expected is False:
+        assert result is False
+        return
+    for k in KEYS:
+        assert result[k] == pytest.approx(expected[k], rel=1e-9, abs=1e-9), k
+
+
+def test_whole_session():
+    IBI = synthetic_IBI(500)
+    stream = hrv_analysis.HRVstream()
+    for i, x in enumerate(IBI):
+        stream.add(x)
+        if i % 50 == 1: assert_matches(stream, IBI[:i+1])
+    assert stream.count == len(IBI)
+
+
+@pytest.mark.parametrize('window_beats', [2, 30, 300])
+def test_window_beats(window_beats):
+    IBI = synthetic_IBI(1000)
+    stream = hrv_analysis.HRVstream(window_beats=window_beats)
+    for i, x in enumerate(IBI):
+        stream.add(x)
+        if i % 37 == 1: assert_matches(stream, IBI[max(i+1-window_beats, 0):i+1])
+    assert stream.count == window_beats
+    assert stream.count_total == len(IBI)
+
+
+@pytest.mark.parametrize('window_ms', [5000, 60000])
+def test_window_ms(window_ms):
+    IBI = synthetic_IBI(1000)
+    stream = hrv_analysis.HRVstream(window_ms=window_ms)
+    for i, x in enumerate(IBI):
+        stream.add(x)
+        if i % 37 == 1: assert_matches(stream, window_by_ms(IBI[:i+1], window_ms))
+
+
+def test_window_ms_shorter_than_one_beat():
+    IBI = synthetic_IBI(100)
+    stream = hrv_analysis.HRVstream(window_ms=IBI.min() / 2)
+    stream.extend(IBI)
+    assert stream.count == 1   # the newest beat is always kept
+    assert stream.calculate() is False
+    assert hrv_analysis.HRVdescriptors().calculate(window_by_ms(IBI, IBI.min() / 2)) is False
+
+
+def test_window_beats_and_ms():
+    IBI = synthetic_IBI(1000)
+    stream = hrv_analysis.HRVstream(window_beats=50, window_ms=30000)
+    stream.extend(IBI)
+    by_ms = window_by_ms(IBI, 30000)
+    assert_matches(stream, by_ms[-50:])
+
+
+def test_reset():
+    IBI = synthetic_IBI(200)
+    stream = hrv_analysis.HRVstream(window_beats=20)
+    stream.extend(IBI[:100])
+    stream.reset()
+    stream.extend(IBI[100:])
+    assert stream.count_total == 100
+    assert_matches(stream, IBI[-20:])
@@ -0,0 +1,55 @@
+# HRVworker: results from the worker process, failed calculations
+
+import multiprocessing
+import time
+
+import numpy as np
+import pytest
+
+import hrv_analysis
+import hrv_worker
+
+
+def wait_for(worker, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        results = worker.poll()
+        if results: return results
+        time.sleep(0.01)
+    raise AssertionError('no result from the worker')
+
+
+def test_results():
+    IBI = 800 + 50 * np.sin(np.arange(500) / 3.0)
+    worker = hrv_worker.HRVworker(capacity=2048)
+    try:
+        for x in IBI: worker.add(x)
+        request_id = worker.request(window=300)
+        (got_id, r), = wait_for(worker)
+        assert got_id == request_id
+        expected = hrv_analysis.HRVdescriptors().calculate(IBI[-300:])
+        for k, v in expected.items():
+            assert r[k] == pytest.approx(v, nan_ok=True), k
+    finally:
+        worker.close()
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='the failure is patched into the forked worker')
+def test_failure(monkeypatch):
+    calculate = hrv_analysis.HRVdescriptors.calculate
+    def failing(self, IBI, nonlinear=False):
+        if len(IBI) == 13: raise ValueError('broken window')
+        return calculate(self, IBI, nonlinear)
+    monkeypatch.setattr(hrv_analysis.HRVdescriptors, 'calculate', failing)
+
+    worker = hrv_worker.HRVworker(capacity=2048)
+    try:
+        for x in 800 + np.arange(50): worker.add(x)
+        request_id = worker.request(window=13)
+        assert wait_for(worker) == [(request_id, False)]
+        request_id = worker.request(window=20)   # the worker goes on
+        (got_id, r), = wait_for(worker)
+        assert got_id == request_id and r['HRMean'] > 0
+        assert worker.process.is_alive()
+    finally:
+        worker.close()
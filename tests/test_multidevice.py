@@ -0,0 +1,133 @@
+# coalescing of the HRV calculations and several simulated arduinos read at once
+
+import concurrent.futures
+import concurrent.futures.process
+import queue
+import sys
+import time
+
+import pytest
+
+import multidevice
+import pipeline
+
+
+class ManualExecutor():
+    """the futures are finished by the test"""
+
+    def __init__(self):
+        self.submitted = []   # (future, args)
+        self.broken = False
+
+
+    def submit(self, fn, *args):
+        if self.broken: raise concurrent.futures.process.BrokenProcessPool('pool is broken')
+        future = concurrent.futures.Future()
+        self.submitted.append((future, args))
+        return future
+
+
+class ListSink(pipeline.Sink):
+    def __init__(self):
+        self.results = []
+
+
+    def descriptors(self, t, result):
+        self.results.append((t, result))
+
+
+def beats(num, IBI=800):
+    return b''.join(b'S512\r\nB75\r\nQ%d\r\n' % (IBI + i % 7) for i in range(num))
+
+
+def test_one_calculation_in_flight():
+    executor = ManualExecutor()
+    sink = ListSink()
+    dev = multidevice.Device('dev', None, executor, sinks=[sink])
+    dev.analysis.initial_wait = 0
+    results = queue.Queue()
+
+    for i in range(10):   # 100 beats, an update every 10 beats
+        dev.process(beats(10), 100.0 + i, results)
+    assert len(executor.submitted) == 1          # the other updates wait
+    assert len(executor.submitted[0][1][0]) == 10
+    assert dev.pending[0] == 109.0               # the newest update
+
+    future, args = executor.submitted[0]
+    future.set_result(multidevice.calculate_descriptors(*args))
+    dev.descriptors(*results.get_nowait()[1:], results)
+    assert len(sink.results) == 1 and sink.results[0][1]['HRMean'] > 0
+    assert len(executor.submitted) == 2          # the newest window, all 100 beats
+    assert len(executor.submitted[1][1][0]) == 100
+    assert dev.pending is None
+
+    future, args = executor.submitted[1]
+    future.set_exception(concurrent.futures.process.BrokenProcessPool('worker died'))
+    dev.descriptors(*results.get_nowait()[1:], results)
+    assert sink.results[-1][1] is False          # the error is passed on, the device goes on
+    assert dev.analysis.future is None
+    dev.process(beats(10), 120.0, results)
+    assert len(executor.submitted) == 3
+
+
+def test_broken_executor():
+    executor = ManualExecutor()
+    sink = ListSink()
+    dev = multidevice.Device('dev', None, executor, sinks=[sink])
+    dev.analysis.initial_wait = 0
+    md = multidevice.MultiDevice([dev])
+    dev.process(beats(10), 100.0, md.results)
+    dev.process(beats(10), 101.0, md.results)   # waits for the calculation in flight
+    assert len(executor.submitted) == 1 and dev.pending is not None
+
+    executor.broken = True
+    executor.submitted[0][0].set_exception(concurrent.futures.process.BrokenProcessPool('worker died'))
+    md._collect()   # the newest window cannot be submitted any more
+    assert sink.results[-1][1] is False
+    assert dev.failed and md.removed == [dev] and not md.devices
+    md.finish()     # nothing in flight, returns at once
+
+    other = multidevice.Device('other', None, executor)
+    other.analysis.initial_wait = 0
+    other.process(beats(10), 100.0, md.results)   # the first submit fails
+    assert other.failed and other.analysis.future is None
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason='the simulator needs a pseudo-terminal')
+@pytest.mark.parametrize('num_devices', [1, 4])
+def test_simulated_devices(num_devices):
+    serial = pytest.importorskip('serial')
+    import arduino_sim
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=2)
+    sims = [arduino_sim.ArduinoSimulator(binary=(i % 2 == 1), model=arduino_sim.PulseModel(500, 150, seed=i), seed=i) for i in range(num_devices)]
+    sinks = [ListSink() for sim in sims]
+    devices = [multidevice.Device('dev%d' % i, serial.Serial(sim.port, 115200, timeout=0), executor, sim.binary, [sink]) for i, (sim, sink) in enumerate(zip(sims, sinks))]
+    for dev in devices:
+        dev.analysis.initial_wait = 0
+        dev.analysis.update_every = 2
+    md = multidevice.MultiDevice(list(devices))
+    try:
+        for sim in sims: sim.start()   # after the ports are opened (opening them clears the input)
+        md.run(3.0)
+        for sim in sims: sim.stop()
+        deadline = time.monotonic() + 5
+        while any(sim.pending for sim in sims) and time.monotonic() < deadline:
+            for sim in sims: sim._write()
+            md.run(0.1)
+        md.run(0.3)
+        md.finish()
+    finally:
+        executor.shutdown(wait=True)
+        for dev in devices: dev.close()
+        for sim in sims: sim.close()
+
+    for sim, dev, sink in zip(sims, devices, sinks):
+        sent, received = sim.counters(), dev.counters()
+        assert sent['overflow'] == 0
+        assert received['samples'] + 2*received['beats'] == sent['values']   # nothing is lost (S, and B and Q for every beat)
+        assert received['decode_errors'] == 0
+        assert received.get('lost_frames', 0) == 0
+        assert len(sink.results) >= 2 and all(r for t, r in sink.results)
+        assert dev.analysis.future is None and dev.pending is None
+    assert not md.removed
@@ -0,0 +1,138 @@
+# round trips of the text and binary protocol, with split reads, garbage and lost frames
+
+import numpy as np
+import pytest
+
+import protocol
+
+
+def split(data, sizes):
+    """data in chunks of the given sizes (repeated), the rest in the last chunk"""
+    chunks, pos, i = [], 0, 0
+    while pos < len(data):
+        chunks.append(data[pos:pos+sizes[i % len(sizes)]])
+        pos += sizes[i % len(sizes)]
+        i += 1
+    return chunks
+
+
+def text_lines(num, seed=0):
+    rng = np.random.default_rng(seed)
+    syms = rng.choice([b'S', b'S', b'S', b'B', b'Q'], num)
+    vals = rng.integers(-1000, 100000, num)
+    data = b''.join(s + b'%d' % v + (b'\r\n' if i % 3 else b'\n') for i, (s, v) in enumerate(zip(syms, vals)))
+    return data, np.array([ord(s) for s in syms], dtype=np.uint8), vals
+
+
+def decode_text(decoder, chunks):
+    out = [decoder.decode(c) for c in chunks]
+    return np.concatenate([o[0] for o in out]), np.concatenate([o[1] for o in out])
+
+
+@pytest.mark.parametrize('sizes', [[1], [7], [3, 50, 1], [100000]])
+def test_lines_split(sizes):
+    data, syms, vals = text_lines(1000)
+    decoder = protocol.LineDecoder()
+    got_syms, got_vals = decode_text(decoder, split(data, sizes))
+    np.testing.assert_array_equal(got_syms, syms)
+    np.testing.assert_array_equal(got_vals, vals)
+    assert decoder.errors == 0
+    assert decoder.remainder == b''
+
+
+def test_lines_garbage():
+    data = b'S512\r\nX12\r\nS1x2\r\n\r\nB\r\nS-\r\nQ1234567890\r\n\xff\xfe\r\nB75\r\nQ800\r\nS5'
+    decoder = protocol.LineDecoder()
+    syms, vals = decode_text(decoder, split(data, [5]))
+    assert bytes(syms) == b'SBQ'
+    np.testing.assert_array_equal(vals, [512, 75, 800])
+    assert decoder.errors == 5      # X12, S1x2, S-, too many digits, binary garbage (the empty line and "B" are too short to count)
+    assert decoder.remainder == b'S5'
+    channels = protocol.LineDecoder().decode_channels(data)
+    np.testing.assert_array_equal(channels['sensor'], [512])
+    np.testing.assert_array_equal(channels['IBI'], [800])
+
+
+def frames(num, seq0=0, t0=0, seed=0):
+    """num frames with random samples and a beat in every third frame, returns the bytes, samples, beat positions, BPM and IBI"""
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, 1024, (num, protocol.CFG_frame_samples))
+    beat = np.where(np.arange(num) % 3 == 0, rng.integers(0, protocol.CFG_frame_samples, num), protocol.CFG_no_beat)
+    bpm = rng.integers(40, 200, num)
+    IBI = rng.integers(300, 1500, num)
+    seq = seq0 + np.arange(num)
+    data = protocol.encode_frames(seq, t0 + seq * protocol.CFG_frame_us, samples, beat, bpm, IBI)
+    return data, samples, beat, bpm, IBI
+
+
+def decode_frames(decoder, chunks):
+    out = [decoder.decode(c) for c in chunks]
+    return tuple(np.concatenate([o[i] for o in out]) for i in range(3))
+
+
+@pytest.mark.parametrize('sizes', [[1], [31], [32], [5, 77, 200], [100000]])
+def test_frames_split(sizes):
+    data, samples, beat, bpm, IBI = frames(200, t0=2**32 - 50 * protocol.CFG_frame_us)   # micros() wraps around
+    decoder = protocol.FrameDecoder()
+    syms, vals, times = decode_frames(decoder, split(data, sizes))
+
+    np.testing.assert_array_equal(vals[syms == ord('S')], samples.ravel())
+    has_beat = beat != protocol.CFG_no_beat
+    np.testing.assert_array_equal(vals[syms == ord('B')], bpm[has_beat])
+    np.testing.assert_array_equal(vals[syms == ord('Q')], IBI[has_beat])
+    t_sensor = times[syms == ord('S')]
+    np.testing.assert_array_equal(np.diff(t_sensor), protocol.CFG_sample_us)   # unwrapped
+    # the beats follow the sample they were detected at
+    sample_index = np.cumsum(syms == ord('S')) - 1
+    np.testing.assert_array_equal(sample_index[syms == ord('B')], (np.flatnonzero(has_beat) * protocol.CFG_frame_samples + beat[has_beat]))
+    assert decoder.frames == 200
+    assert decoder.errors == 0
+    assert decoder.lost_frames == 0
+
+
+def test_frames_garbage():
+    data, samples, beat, bpm, IBI = frames(50)
+    raw = bytearray(data)
+    raw[10*32 + 12] ^= 0x01                       # wrong checksum: the frame is skipped
+    garbage = b'\xa5\x5a\x00garbage\xa5'
+    data = bytes(raw[:20*32]) + garbage + bytes(raw[20*32:])
+    decoder = protocol.FrameDecoder()
+    syms, vals, times = decode_frames(decoder, split(data, [13, 64]))
+    keep = np.arange(50) != 10
+    np.testing.assert_array_equal(vals[syms == ord('S')], samples[keep].ravel())
+    assert decoder.frames == 49
+    assert decoder.errors == 32 + len(garbage)
+    assert decoder.lost_frames == 1               # the corrupted frame
+
+
+def test_frames_lost():
+    data, samples, _, _, _ = frames(600)
+    frame = [data[i*32:(i+1)*32] for i in range(600)]
+    decoder = protocol.FrameDecoder()
+    decoder.decode(b''.join(frame[:10]) + b''.join(frame[13:20]))         # 3 lost
+    assert decoder.lost_frames == 3
+    decoder.decode(b''.join(frame[20:30]))
+    decoder.decode(b''.join(frame[330:340]))                               # 300 lost, the sequence numbers wrapped around
+    assert decoder.lost_frames == 303
+    assert decoder.frames == 37
+
+
+def test_frames_pause():
+    """a device that pauses (sensor switched off) keeps counting the sequence numbers, that is no loss"""
+    first, _, _, _, _ = frames(20)
+    second, _, _, _, _ = frames(20, seq0=20, t0=1234567 * protocol.CFG_frame_us)
+    decoder = protocol.FrameDecoder()
+    decoder.decode(first)
+    decoder.decode(second)
+    assert decoder.lost_frames == 0
+    assert decoder.frames == 40
+
+
+def test_parser_times():
+    data, _, _, _, _ = frames(10)
+    parser = protocol.Parser(binary=True)
+    syms, vals, times = parser.decode(data, 1000.0)
+    assert times[syms == ord('S')][-1] == pytest.approx(1000.0)       # the newest sample was received just now
+    assert parser.counters() == {'bytes_read': len(data), 'decode_errors': 0, 'lost_frames': 0}
+    syms, vals, times = protocol.Parser().decode(b'S1\r\nS2\r\n', 5.0)
+    np.testing.assert_array_equal(times, [5.0, 5.0])
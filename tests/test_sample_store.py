@@ -0,0 +1,36 @@
+# SampleStore in memory and memory-mapped to files
+
+import numpy as np
+
+import sample_store
+
+
+def test_file_matches_memory(tmp_path):
+    in_file = sample_store.SampleStore(np.int16, str(tmp_path / 'sensor'), chunk_size=100)
+    in_memory = sample_store.SampleStore(np.int16, chunk_size=100)
+    rng = np.random.default_rng(0)
+    count = 0
+    for k in rng.integers(0, 70, 100).tolist() + [250]:   # appends that cross one or more chunk boundaries
+        values = rng.integers(0, 1024, k)
+        times = count + np.arange(k)
+        in_file.append(values, times)
+        in_memory.append(values, times)
+        count += k
+        np.testing.assert_array_equal(in_file.values(), in_memory.values())
+        np.testing.assert_array_equal(in_file.times(), in_memory.times())
+    assert in_file.count == count
+    assert in_file.last == in_memory.last
+
+    # within a chunk the views come from the same mapping (no remapping per call)
+    if count % 100 == 0:
+        in_file.append([1], [count])
+        count += 1
+    before = in_file.values()
+    in_file.append([1], [count])
+    assert np.shares_memory(before, in_file.values())
+    assert in_file.values()[-1] == 1
+
+    in_file.close()
+    stored = np.fromfile(str(tmp_path / 'sensor.value'), dtype=np.int16)
+    np.testing.assert_array_equal(stored[:len(in_memory.values())], in_memory.values())
+    assert not stored[count+1:].any()
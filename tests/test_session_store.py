@@ -0,0 +1,30 @@
+# SessionStore round trip and excel export
+
+import datetime
+
+import numpy as np
+import pytest
+
+import session_store
+
+
+def test_export_labels(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    filename = str(tmp_path / 'sessions.db')
+    store = session_store.SessionStore(filename)
+    store.append(datetime.datetime(2026, 1, 1, 12), {'HRMean': 70.5, 'LFHF': 1.2, 'DFA1': 1.0, 'Other': 3.0}, [800, 810, 790])
+    store.close()
+
+    store = session_store.SessionStore(filename)
+    sessions = store.sessions()
+    store.close()
+    assert len(sessions) == 1
+    np.testing.assert_array_equal(sessions[0]['IBI'], [800, 810, 790])
+
+    session_store.main([filename, '--export', str(tmp_path / 'sessions.xlsx')])
+    ws = openpyxl.load_workbook(str(tmp_path / 'sessions.xlsx'))['HRV History']
+    header = [c.value for c in ws[1]]
+    assert header[0] == 'datetime'
+    assert set(header[1:]) == {'HR Mean [Hz]', 'LFHF', 'DFA alpha1', 'Other'}
+    row = dict(zip(header, [c.value for c in ws[2]]))
+    assert row['HR Mean [Hz]'] == 70.5
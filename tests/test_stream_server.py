@@ -0,0 +1,100 @@
+# StreamServer over loopback: live clients, a late joiner and a stalled client
+
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import stream_server
+
+
+def publish(server, num, size, seed=0):
+    """publishes num chunks of size samples, one per tick, returns all values"""
+    rng = np.random.default_rng(seed)
+    values = []
+    for i in range(num):
+        vals = rng.integers(0, 1024, size)
+        server.samples(np.full(size, ord('S'), dtype=np.uint8), vals, 1000.0 + i + np.arange(size) / size)
+        values.append(vals)
+        time.sleep(2 * stream_server.CFG_tick)
+    return np.concatenate(values)
+
+
+def receive(client, until_values, timeout=20):
+    """reads messages until the samples hold until_values values, returns the messages"""
+    messages = []
+    num = 0
+    deadline = time.monotonic() + timeout
+    for message in client:
+        messages.append(message)
+        if message['type'] == 'samples': num += len(message['val'])
+        if num >= until_values or time.monotonic() > deadline: break
+    return messages
+
+
+def values(messages):
+    return np.concatenate([m['val'] for m in messages if m['type'] == 'samples'])
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(stream_server, 'CFG_tick', 0.005)
+    server = stream_server.StreamServer('127.0.0.1', 0)
+    yield server
+    server.close()
+
+
+def test_live_and_late_joiner(server):
+    host, port = server.address[:2]
+    first = stream_server.StreamClient(host, port, timeout=10)
+    time.sleep(0.1)   # accepted
+    sent = publish(server, 20, 100)
+    server.descriptors(1020.0, {'HRMean': 70.0, 'LF': np.nan})
+    time.sleep(0.1)
+
+    messages = receive(first, len(sent))
+    assert messages[0] == {'type': 'hello', 'history': 0}
+    np.testing.assert_array_equal(values(messages), sent)
+
+    # the late joiner gets the history (and the newest descriptors) first, then the live data
+    late = stream_server.StreamClient(host, port, timeout=10)
+    hello = next(iter(late))
+    assert hello['type'] == 'hello' and hello['history'] == server.messages + 1
+    history = [message for _, message in zip(range(hello['history']), late)]
+    np.testing.assert_array_equal(values(history), sent)
+    assert history[-1] == {'type': 'descriptors', 't': 1020.0, 'descriptors': {'HRMean': 70.0, 'LF': None}}
+
+    more = publish(server, 5, 100, seed=1)
+    np.testing.assert_array_equal(values(receive(late, len(more))), more)
+    np.testing.assert_array_equal(values(receive(first, len(more)))[-len(more):], more)
+    first.close()
+    late.close()
+
+
+def test_stalled_client(server, monkeypatch):
+    monkeypatch.setattr(stream_server, 'CFG_client_queue', 10)
+    host, port = server.address[:2]
+    stalled = socket.socket()
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled.connect((host, port))   # never reads
+    reader = stream_server.StreamClient(host, port, timeout=10)
+    time.sleep(0.1)
+
+    received = []
+    thread = threading.Thread(target=lambda: received.extend(receive(reader, 100 * 20000)))
+    thread.start()
+    start = time.monotonic()
+    sent = publish(server, 100, 20000)   # about 200 kB per message
+    thread.join()
+
+    # the stalled client lost the oldest messages, the other one got everything in time
+    np.testing.assert_array_equal(values(received), sent)
+    counters = server.counters()
+    assert counters['clients'] == 2
+    assert counters['dropped'] > 0
+    assert counters['queued'] <= stream_server.CFG_client_queue
+    assert time.monotonic() - start < 15
+    stalled.close()
+    reader.close()